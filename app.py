@@ -12,10 +12,11 @@ import argparse
 
 import falcon
 
-from sikr.middleware import json, https, headers, handle_404
+from sikr.middleware import json, https, headers, handle_404, session, timing
 # from sikr.resources import categories, items, services, main, tests, sharing
-# from sikr.resources.auth import github, facebook, google, twitter, linkedin
-from sikr.resources import main
+from sikr.resources.auth import github, facebook, google, twitter, linkedin
+from sikr.resources import (main, items, services, categories, files,
+                            imports, export, metrics, sharing)
 from sikr.utils.logs import logger
 from sikr.utils.checks import check_python
 from sikr import settings
@@ -37,6 +38,30 @@ if __name__ == "__main__":
     parser.add_argument("-g", "--generate",
                         help="Fill the database with random data",
                         action="store_true")
+    generate = parser.add_argument_group("generate options")
+    generate.add_argument("--users", type=int, default=1000,
+                          help="Users to generate (default: %(default)s)")
+    generate.add_argument("--usergroups", type=int, default=100,
+                          help="User groups to generate (default: %(default)s)")
+    generate.add_argument("--categories", type=int, default=2000,
+                          help="Categories to generate (default: %(default)s)")
+    generate.add_argument("--items", type=int, default=20000,
+                          help="Items to generate (default: %(default)s)")
+    generate.add_argument("--seed", type=int, default=0,
+                          help="Seed of the random data (default: %(default)s)")
+    generate.add_argument("--batch-size", type=int, default=10000,
+                          help="Rows per transaction (default: %(default)s)")
+    generate.add_argument("--no-copy", action="store_true",
+                          help="Use INSERT instead of COPY in PostgreSQL")
+    parser.add_argument("-r", "--rotate-keys",
+                        help="Encrypt the stored secrets with the current key",
+                        action="store_true")
+    parser.add_argument("-e", "--send-emails",
+                        help="Send the emails of the outbox until interrupted",
+                        action="store_true")
+    parser.add_argument("-p", "--rebuild-permissions",
+                        help="Build the permissions table again from the shares",
+                        action="store_true")
     args = parser.parse_args()
 
     # If there's no input print help
@@ -53,21 +78,66 @@ if __name__ == "__main__":
                   " mode is disabled. Please set DEBUG=True in the "
                   "settings to use it.\n")
         else:
-            print('In development')
+            from sikr.db.generate import generate_data
+            generate_data(users=args.users, usergroups=args.usergroups,
+                          groups=args.categories, entries=args.items,
+                          seed=args.seed, batch_size=args.batch_size,
+                          use_copy=False if args.no_copy else None)
+
+    if args.rotate_keys:
+        from sikr.db.rotate import rotate_keys
+        rotate_keys()
+
+    if args.rebuild_permissions:
+        from sikr.db.syncdb import rebuild_permission_table
+        rebuild_permission_table()
+
+    if args.send_emails:
+        from sikr.utils.email import run_dispatcher
+        run_dispatcher()
 # Else create the API instance, referenced as api
 else:
+    middleware = [
+        headers.BaseHeaders(),
+        session.DBSession(),
+        json.RequireJSON(),
+        json.JSONTranslator(),
+        https.RequireHTTPS(),
+        handle_404.WrongURL()
+    ]
+    if settings.TIMING_ACTIVE:
+        # They must wrap the rest of the middleware, even BaseHeaders: the
+        # observability middleware is the only one allowed ahead of it
+        middleware = ([timing.RequestTiming()] + middleware +
+                      [timing.ResourceTiming()])
+    if settings.METRICS_ACTIVE:
+        # Also ahead of BaseHeaders, so preflights are counted too
+        middleware.insert(0, timing.RequestMetrics())
     api = falcon.API(
         media_type='application/json; charset=UTF-8',
-        middleware=[
-            json.RequireJSON(),
-            json.JSONTranslator(),
-            https.RequireHTTPS(),
-            headers.BaseHeaders(),
-            handle_404.WrongURL()
-        ]
+        middleware=middleware
     )
 
     # URLs
     api_version = '/' + settings.DEFAULT_API
     api.add_route(api_version, main.APIInfo())
+    if settings.METRICS_ACTIVE:
+        api.add_route(api_version + '/metrics', metrics.Metrics())
+    api.add_route(api_version + '/items', items.Items())
+    api.add_route(api_version + '/items/{id}', items.DetailItem())
+    api.add_route(api_version + '/services', services.Services())
+    api.add_route(api_version + '/services/{id}', services.DetailService())
+    api.add_route(api_version + '/services/{id}/file', files.ServiceFile())
+    api.add_route(api_version + '/categories', categories.Categories())
+    api.add_route(api_version + '/categories/{id}', categories.DetailCategory())
+    api.add_route(api_version + '/import', imports.Import())
+    api.add_route(api_version + '/export', export.Export())
+    api.add_route(api_version + '/share', sharing.Share())
+    api.add_route(api_version + '/share/accept', sharing.AcceptShare())
+    api.add_route(api_version + '/share/bulk', sharing.BulkShare())
+    api.add_route(api_version + '/auth/github', github.GithubAuth())
+    api.add_route(api_version + '/auth/google', google.GoogleAuth())
+    api.add_route(api_version + '/auth/facebook', facebook.FacebookAuth())
+    api.add_route(api_version + '/auth/twitter', twitter.TwitterAuth())
+    api.add_route(api_version + '/auth/linkedin', linkedin.LinkedinAuth())
     logger.debug("API service started")
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+"""Benchmarks of the hot endpoints of the API.
+
+Builds the ``api`` of ``app.py`` against a database fixture and sends the
+requests through Falcon's testing client, so the whole middleware chain, the
+authentication and the JSON encoding are measured without a network or an
+application server in between. The results, throughput and latency
+percentiles of every scenario, are saved as JSON.
+
+Run the benchmarks against a temporary SQLite fixture, or against the
+database of the settings (``--settings-db``, it must have the schema and data
+already, see ``app.py --generate``):
+
+    python benchmarks/bench_api.py run -o before.json
+    python benchmarks/bench_api.py run -o after.json
+
+And compare two runs, the command fails if a scenario got slower than the
+threshold:
+
+    python benchmarks/bench_api.py compare before.json after.json
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sikr import settings  # noqa: E402
+
+# Name, method, path (formatted with the fixture ids, with its query string),
+# authenticated, body and expected status of every scenario
+SCENARIOS = (
+    ("api_info", "GET", "/{api}", False, None, 200),
+    ("preflight", "OPTIONS", "/{api}/items", False, None, 200),
+    ("unauthorized", "GET", "/{api}/items", False, None, 401),
+    ("items_list", "GET", "/{api}/items?limit=100", True, None, 200),
+    ("items_list_fields", "GET", "/{api}/items?limit=100&fields=id,name", True, None, 200),
+    ("item_detail", "GET", "/{api}/items/{item}", True, None, 200),
+    ("services_list", "GET", "/{api}/services?limit=100", True, None, 200),
+    ("categories_list", "GET", "/{api}/categories?limit=100", True, None, 200),
+    ("item_create", "POST", "/{api}/items", True,
+     {"name": "Benchmark item", "description": "Created by the benchmarks"}, 200),
+)
+PERCENTILES = (50, 90, 99)
+
+
+def setup_sqlite(path, scale, seed):
+    """Point the settings to a new SQLite database and fill it."""
+    settings.DATABASE.clear()
+    settings.DATABASE.update({'ENGINE': 'sqlite', 'NAME': path, 'REPLICAS': []})
+
+    from sikr.db.connector import Base, engine
+    from sikr.db.generate import generate_data
+    from sikr.models import users, entries  # noqa: F401
+
+    Base.metadata.create_all(engine)
+    generate_data(users=10 * scale, usergroups=scale, groups=20 * scale,
+                  entries=200 * scale, seed=seed, batch_size=10000)
+
+
+def get_fixture_ids():
+    """Get the busiest user of the fixture and one of their items."""
+    from sqlalchemy import func, select
+    from sikr.db.connector import engine
+    from sikr.models.entries import entry_user_table
+
+    with engine.connect() as connection:
+        row = connection.execute(
+            select([entry_user_table.c.sikr_user,
+                    func.min(entry_user_table.c.sikr_entry)])
+            .group_by(entry_user_table.c.sikr_user)
+            .order_by(func.count().desc())
+            .limit(1)).first()
+    if row is None:
+        sys.exit("The database has no items, fill it with app.py --generate")
+    return row[0], row[1]
+
+
+def percentile(values, percent):
+    """Percentile of a sorted list, by nearest rank."""
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def run_scenario(client, method, path, headers, body, expected, requests, warmup):
+    """Send the requests of a scenario and measure them.
+
+    Requests answered with another status than ``expected`` are counted as
+    errors.
+    """
+    # Falcon's testing client takes the query string apart from the path
+    path, _, query_string = path.partition('?')
+    kwargs = {'headers': headers, 'query_string': query_string}
+    if body is not None:
+        kwargs['body'] = json.dumps(body)
+    for _ in range(warmup):
+        client.simulate_request(method, path, **kwargs)
+
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    for _ in range(requests):
+        request_start = time.perf_counter()
+        result = client.simulate_request(method, path, **kwargs)
+        latencies.append(time.perf_counter() - request_start)
+        if result.status_code != expected:
+            errors += 1
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    stats = {
+        "requests": requests,
+        "errors": errors,
+        "throughput": round(requests / elapsed, 2),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+    }
+    for percent in PERCENTILES:
+        stats["p{0}_ms".format(percent)] = round(
+            percentile(latencies, percent) * 1000, 3)
+    return stats
+
+
+def run(args):
+    """Run the benchmarks and save the results."""
+    tmp_dir = None
+    if not args.settings_db:
+        tmp_dir = tempfile.TemporaryDirectory()
+        setup_sqlite(os.path.join(tmp_dir.name, 'bench.db'), args.scale, args.seed)
+
+    import falcon
+    import falcon.testing
+    import sqlalchemy
+    import app
+    from sikr.resources.auth.utils import create_jwt_token
+
+    user_id, item_id = get_fixture_ids()
+    token = create_jwt_token(types.SimpleNamespace(id=user_id))
+    base_headers = {'Accept': 'application/json',
+                    'Content-Type': 'application/json',
+                    'Origin': settings.SITE_DOMAIN}
+    client = falcon.testing.TestClient(app.api)
+
+    results = {}
+    for name, method, path, auth, body, expected in SCENARIOS:
+        if args.scenario and name not in args.scenario:
+            continue
+        headers = dict(base_headers)
+        if auth:
+            headers['Authorization'] = 'Bearer ' + token
+        path = path.format(api=settings.DEFAULT_API, item=item_id)
+        results[name] = run_scenario(client, method, path, headers, body,
+                                     expected, args.requests, args.warmup)
+        print("{0:<20} {1[throughput]:>10.1f} req/s  p50 {1[p50_ms]:>8.3f}ms  "
+              "p99 {1[p99_ms]:>8.3f}ms  errors {1[errors]}".format(name, results[name]))
+
+    report = {
+        "meta": {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "falcon": falcon.__version__,
+            "sqlalchemy": sqlalchemy.__version__,
+            "database": settings.DATABASE['ENGINE'],
+            "scale": None if args.settings_db else args.scale,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print("Results saved in {0}".format(args.output))
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+    # The timings of requests that fail are not comparable
+    failed = [name for name, stats in results.items() if stats["errors"]]
+    if failed:
+        print("Unexpected status in {0}".format(", ".join(failed)))
+        sys.exit(1)
+
+
+def compare(args):
+    """Compare two runs and fail if any scenario regressed."""
+    with open(args.base) as base_file, open(args.new) as new_file:
+        base = json.load(base_file)["results"]
+        new = json.load(new_file)["results"]
+
+    threshold = args.threshold / 100
+    regressions = 0
+    for name in sorted(set(base) & set(new)):
+        changes = []
+        for metric in ["p{0}_ms".format(percent) for percent in PERCENTILES]:
+            change = ((new[name][metric] - base[name][metric]) /
+                      max(base[name][metric], 0.001))
+            changes.append((metric, change, change > threshold))
+        change = (base[name]["throughput"] - new[name]["throughput"]) / base[name]["throughput"]
+        changes.append(("throughput", -change, change > threshold))
+        if new[name]["errors"] > base[name]["errors"]:
+            changes.append(("errors", new[name]["errors"] - base[name]["errors"], True))
+
+        regressed = any(flag for _, _, flag in changes)
+        regressions += regressed
+        print("{0:<20} {1:<10} {2}".format(
+            name, "REGRESSED" if regressed else "ok",
+            "  ".join("{0} {1:+.1%}".format(metric, change) if metric != "errors"
+                      else "errors +{0}".format(change)
+                      for metric, change, _ in changes)))
+
+    for name in sorted(set(base) ^ set(new)):
+        print("{0:<20} only in {1}".format(name, "base" if name in base else "new"))
+
+    if regressions:
+        print("{0} scenarios regressed more than {1}%".format(regressions, args.threshold))
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the hot endpoints of the API")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    run_parser = commands.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument("-o", "--output", default="benchmark.json",
+                            help="File for the results (default: %(default)s)")
+    run_parser.add_argument("-n", "--requests", type=int, default=1000,
+                            help="Requests per scenario (default: %(default)s)")
+    run_parser.add_argument("--warmup", type=int, default=50,
+                            help="Requests before measuring (default: %(default)s)")
+    run_parser.add_argument("--scale", type=int, default=10,
+                            help="Size of the SQLite fixture, 200 items per "
+                                 "unit (default: %(default)s)")
+    run_parser.add_argument("--seed", type=int, default=0,
+                            help="Seed of the SQLite fixture (default: %(default)s)")
+    run_parser.add_argument("--settings-db", action="store_true",
+                            help="Use the database of the settings instead "
+                                 "of a SQLite fixture")
+    run_parser.add_argument("-s", "--scenario", action="append",
+                            help="Only run this scenario, can be repeated")
+    run_parser.set_defaults(function=run)
+
+    compare_parser = commands.add_parser("compare", help="Compare two runs")
+    compare_parser.add_argument("base", help="Results of the reference run")
+    compare_parser.add_argument("new", help="Results of the run to check")
+    compare_parser.add_argument("-t", "--threshold", type=float, default=10,
+                                help="Percentage of change considered a "
+                                     "regression (default: %(default)s)")
+    compare_parser.set_defaults(function=compare)
+
+    args = parser.parse_args()
+    args.function(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,19 +3,62 @@
 This module organizes the connections to teh database accrding to the settings
 file and values provided. It also creates a base model from where the rest of
 models have to inherit from so they connect to the same database.
+
+The connection pool is configured with the POOL_* options of the DATABASE
+settings. Connections are never shared between processes: a connection opened
+before the application server forks its workers is discarded by the worker and
+a new one is opened lazily the first time the worker needs it.
 """
+import os
 import sys
+import time
+import random
 import logging
+import threading
 
 import sqlalchemy
+from sqlalchemy import event, exc
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool, QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 
 from sikr import settings
+from sikr.utils import metrics
 
 logger = logging.getLogger(__name__)
 
 
+class MeasuredQueuePool(QueuePool):
+
+    """Queue pool that records the checkouts and how long they wait.
+
+    The wait includes opening a new connection when the pool has room for
+    it. Checkouts that time out are counted apart.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._measuring = threading.local()
+
+    def _do_get(self):
+        # QueuePool retries by calling itself, only the first call is measured
+        if getattr(self._measuring, 'active', False):
+            return super()._do_get()
+        self._measuring.active = True
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            metrics.inc('sikr_db_pool_timeouts_total')
+            raise
+        finally:
+            self._measuring.active = False
+        metrics.inc('sikr_db_pool_checkouts_total')
+        metrics.observe('sikr_db_pool_wait_seconds', time.perf_counter() - start,
+                        buckets=metrics.POOL_BUCKETS)
+        return connection
+
+
 def get_dict_values(dict, key, default_value=''):
     """Get dictionary values accounting for empty values when key exists."""
     # Returns False if key doesnt exist, False if value is empty
@@ -25,30 +68,105 @@ def get_dict_values(dict, key, default_value=''):
         return default_value
 
 
-db_conf = settings.DATABASE
-db_user = get_dict_values(db_conf, 'USER', 'root')
-db_host = get_dict_values(db_conf, 'HOST', 'localhost')
-db_name = get_dict_values(db_conf, 'NAME', 'mydatabase')
-db_engine = get_dict_values(db_conf, 'ENGINE')
-db_password = get_dict_values(db_conf, 'PASSWORD')
-db_postgres_port = get_dict_values(db_conf, 'PORT', '5432')
-db_mysql_port = get_dict_values(db_conf, 'PORT', '3306')
-
-if db_engine == 'postgresql':
-    engine = sqlalchemy.create_engine("{}://{}:{}@{}:{}/{}".format(
-        db_engine, db_user, db_password, db_host, db_postgres_port, db_name
-    ))
-elif db_engine == 'mysql':
-    engine = sqlalchemy.create_engine("{}://{}:{}@{}:{}/{}".format(
-        db_engine, db_user, db_password, db_host, db_mysql_port, db_name
-    ))
-elif db_engine == 'sqlite':
-    engine = sqlalchemy.create_engine("{}:///{}".format(db_engine, db_name))
-else:
-    error_msg = "Database engine not supported. Valid options are: " \
-                "postgresql, mysql, sqlite"
-    logger.error(error_msg)
-    sys.exit(error_msg)
+def get_engine_url(db_conf):
+    """Build the database URL from a DATABASE-like settings dictionary."""
+    db_user = get_dict_values(db_conf, 'USER', 'root')
+    db_host = get_dict_values(db_conf, 'HOST', 'localhost')
+    db_name = get_dict_values(db_conf, 'NAME', 'mydatabase')
+    db_engine = get_dict_values(db_conf, 'ENGINE')
+    db_password = get_dict_values(db_conf, 'PASSWORD')
+    db_postgres_port = get_dict_values(db_conf, 'PORT', '5432')
+    db_mysql_port = get_dict_values(db_conf, 'PORT', '3306')
+
+    if db_engine == 'postgresql':
+        return "{}://{}:{}@{}:{}/{}".format(
+            db_engine, db_user, db_password, db_host, db_postgres_port, db_name
+        )
+    elif db_engine == 'mysql':
+        return "{}://{}:{}@{}:{}/{}".format(
+            db_engine, db_user, db_password, db_host, db_mysql_port, db_name
+        )
+    elif db_engine == 'sqlite':
+        return "{}:///{}".format(db_engine, db_name)
+    else:
+        error_msg = "Database engine not supported. Valid options are: " \
+                    "postgresql, mysql, sqlite"
+        logger.error(error_msg)
+        sys.exit(error_msg)
+
+
+def get_engine_options(db_conf):
+    """Build the engine and pool options from a DATABASE-like dictionary."""
+    db_engine = get_dict_values(db_conf, 'ENGINE')
+    options = {}
+    if db_engine == 'sqlite':
+        # SQLite connections are files, SQLAlchemy picks the right pool
+        return options
+
+    if db_conf.get('PGBOUNCER', False):
+        options['poolclass'] = NullPool
+    else:
+        options['poolclass'] = MeasuredQueuePool
+        options['pool_size'] = db_conf.get('POOL_SIZE', 5)
+        options['max_overflow'] = db_conf.get('MAX_OVERFLOW', 10)
+        options['pool_timeout'] = db_conf.get('POOL_TIMEOUT', 30)
+        options['pool_recycle'] = db_conf.get('POOL_RECYCLE', 1800)
+        options['pool_pre_ping'] = db_conf.get('POOL_PRE_PING', True)
+
+    statement_timeout = db_conf.get('STATEMENT_TIMEOUT', 0)
+    if statement_timeout and db_engine == 'postgresql':
+        if db_conf.get('PGBOUNCER', False):
+            logger.warning("STATEMENT_TIMEOUT is ignored behind PgBouncer")
+        else:
+            options['connect_args'] = {
+                'options': '-c statement_timeout={}'.format(int(statement_timeout))
+            }
+    return options
+
+
+def create_engine(db_conf):
+    """Create the engine of a DATABASE-like settings dictionary.
+
+    The engine doesn't connect until it's used. The connections remember the
+    process that opened them and they're discarded, without closing them, if
+    they are checked out from a different process after a fork.
+    """
+    engine = sqlalchemy.create_engine(get_engine_url(db_conf),
+                                      **get_engine_options(db_conf))
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        pid = os.getpid()
+        if connection_record.info['pid'] != pid:
+            # Closing it would close the socket of the parent process too
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                "Connection record belongs to pid {}, attempting to check "
+                "out in pid {}".format(connection_record.info['pid'], pid))
+
+    return engine
+
+
+engine = create_engine(settings.DATABASE)
+
+# Read replicas, each one with the DATABASE settings it overrides
+replica_engines = [create_engine(dict(settings.DATABASE, **replica))
+                   for replica in settings.DATABASE.get('REPLICAS', [])]
+
+
+def get_read_engine():
+    """Get the engine to send a read only request to.
+
+    Requests are spread randomly between the replicas, if there's no replica
+    the primary database engine is used.
+    """
+    if not replica_engines:
+        return engine
+    return random.choice(replica_engines)
 
 # Establish declarative mapping for models
 Base = declarative_base()
@@ -0,0 +1,225 @@
+"""Random data to fill the database for load tests.
+
+Creates users, user groups, categories (groups) and items (entries) with the
+permissions that link them, written with bulk inserts, or COPY on
+PostgreSQL, in batches of one transaction each. The same seed generates the
+same data on an empty database.
+
+The permissions are skewed like in a real installation: a few users own most
+of the items and belong to most of the user groups, and most items are only
+shared with their owner while a few are shared with many users.
+"""
+
+import csv
+import io
+import itertools
+import logging
+import random
+import sys
+import time
+
+from sqlalchemy import func, select, text
+
+from sikr.db.connector import engine
+from sikr.models.users import User, UserGroup, user_group_table
+from sikr.models.entries import Group, Entry, group_user_table, entry_user_table
+from sikr.models.permissions import DIRECT, permission_table
+
+logger = logging.getLogger(__name__)
+
+# Exponent of the Zipf distribution of the objects between users, the bigger
+# the more skewed
+USER_SKEW = 1.1
+# Shape of the Pareto distribution of the number of users of each object and
+# of the members of each user group
+SHARE_SHAPE = 2.0
+MEMBER_SHAPE = 1.2
+# Most users an object is shared with
+MAX_SHARES = 50
+
+
+class UserPicker(object):
+
+    """Choose users following a Zipf distribution.
+
+    The users are shuffled first, so the most active ones are not always the
+    first ids.
+    """
+
+    def __init__(self, rng, user_ids):
+        self.rng = rng
+        self.user_ids = list(user_ids)
+        rng.shuffle(self.user_ids)
+        self.cum_weights = list(itertools.accumulate(
+            1 / (rank ** USER_SKEW) for rank in range(1, len(self.user_ids) + 1)))
+
+    def pick(self, count=1):
+        """Choose ``count`` different users."""
+        count = min(count, len(self.user_ids))
+        users = set()
+        while len(users) < count:
+            users.update(self.rng.choices(self.user_ids,
+                                          cum_weights=self.cum_weights,
+                                          k=count - len(users)))
+        return users
+
+    def pick_shared(self):
+        """Choose the users of an object, usually only one."""
+        shares = min(int(self.rng.paretovariate(SHARE_SHAPE)), MAX_SHARES)
+        return self.pick(shares)
+
+
+def _next_id(connection, table):
+    """First id free for the generated rows of a table."""
+    return (connection.execute(select([func.max(table.c.id)])).scalar() or 0) + 1
+
+
+def _copy(connection, table, columns, rows):
+    """Write rows with COPY, PostgreSQL only."""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert("COPY {0} ({1}) FROM STDIN WITH (FORMAT csv)".format(
+            table.name, ", ".join(columns)), buffer)
+    finally:
+        cursor.close()
+
+
+def _write(connection, table, columns, rows, use_copy):
+    """Write a batch of rows, given as tuples of ``columns``."""
+    if not rows:
+        return
+    if use_copy:
+        _copy(connection, table, columns, rows)
+    else:
+        connection.execute(table.insert(),
+                           [dict(zip(columns, row)) for row in rows])
+
+
+def _fill(name, batches, use_copy):
+    """Write the batches of a generator, one transaction each.
+
+    Args:
+        batches (iterable): Lists of ``(table, columns, rows)`` to write in
+            the same transaction.
+    """
+    start = time.time()
+    count = 0
+    for batch in batches:
+        with engine.begin() as connection:
+            for table, columns, rows in batch:
+                _write(connection, table, columns, rows, use_copy)
+        count += len(batch[0][2])
+        logger.debug("Generated %s %s", count, name)
+    msg = "{0} {1} generated in {2:.1f}s".format(count, name, time.time() - start)
+    print(f"[ OK  ] {msg}")
+    logger.info(msg)
+
+
+def _chunks(ids, size):
+    """Split a range of ids in ranges of ``size``."""
+    for start in range(ids.start, ids.stop, size):
+        yield range(start, min(start + size, ids.stop))
+
+
+def _permissions(object_type, shares):
+    """Rows of the permissions table for the shares of some objects."""
+    return (permission_table, ('user_id', 'object_type', 'object_id', 'usergroup_id'),
+            [(user, object_type, id, DIRECT) for id, user in shares])
+
+
+def _reset_sequences(connection, tables):
+    """Move the id sequences after the generated ids, PostgreSQL only."""
+    for table in tables:
+        connection.execute(text(
+            "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+            "(SELECT max(id) FROM {0}))".format(table.name)))
+
+
+def generate_data(users=1000, usergroups=100, groups=2000, entries=20000,
+                  seed=0, batch_size=10000, use_copy=None):
+    """Fill the database with random data.
+
+    Args:
+        users, usergroups, groups, entries (int): Number of rows to create of
+            each model.
+        seed (int): Seed of the random generator.
+        batch_size (int): Rows written per transaction.
+        use_copy (bool): Write with COPY instead of INSERT. Defaults to True
+            on PostgreSQL, it's not available in the other databases.
+    """
+    postgresql = engine.dialect.name == 'postgresql'
+    if use_copy is None:
+        use_copy = postgresql
+    if use_copy and not postgresql:
+        print("[ERROR] COPY is only available in PostgreSQL")
+        sys.exit(1)
+    rng = random.Random(seed)
+    tables = (User.__table__, UserGroup.__table__, Group.__table__,
+              Entry.__table__)
+
+    with engine.connect() as connection:
+        user_ids, usergroup_ids, group_ids, entry_ids = [
+            range(first, first + count) for first, count in
+            zip([_next_id(connection, table) for table in tables],
+                (users, usergroups, groups, entries))]
+
+    start_msg = "Generating data with seed {0}...".format(seed)
+    print(f"[ --  ] {start_msg}")
+    logger.info(start_msg)
+
+    def user_batches():
+        for ids in _chunks(user_ids, batch_size):
+            yield [(User.__table__,
+                    ('id', 'active', 'username', 'name', 'email', 'master_password'),
+                    [(id, True, f"user{id}", f"User {id}", f"user{id}@example.com", '')
+                     for id in ids])]
+
+    _fill("users", user_batches(), use_copy)
+    picker = UserPicker(rng, user_ids)
+
+    def usergroup_batches():
+        for ids in _chunks(usergroup_ids, batch_size):
+            members = []
+            for id in ids:
+                size = min(int(rng.paretovariate(MEMBER_SHAPE)), len(user_ids))
+                members.extend((user, id) for user in sorted(picker.pick(size)))
+            yield [(UserGroup.__table__, ('id', 'active', 'name'),
+                    [(id, True, f"User group {id}") for id in ids]),
+                   (user_group_table, ('sikr_user', 'sikr_usergroup'), members)]
+
+    _fill("user groups", usergroup_batches(), use_copy)
+
+    def group_batches():
+        for ids in _chunks(group_ids, batch_size):
+            shares = [(id, user) for id in ids
+                      for user in sorted(picker.pick_shared())]
+            yield [(Group.__table__, ('id', 'active', 'name'),
+                    [(id, True, f"Category {id}") for id in ids]),
+                   (group_user_table, ('sikr_group', 'sikr_user'), shares),
+                   _permissions('group', shares)]
+
+    _fill("categories", group_batches(), use_copy)
+
+    def entry_batches():
+        for ids in _chunks(entry_ids, batch_size):
+            rows = []
+            shares = []
+            for id in ids:
+                group = rng.choice(group_ids) if group_ids else None
+                rows.append((id, True, f"Item {id}", f"Description of item {id}",
+                             "generated", group))
+                shares.extend((id, user) for user in sorted(picker.pick_shared()))
+            yield [(Entry.__table__,
+                    ('id', 'active', 'name', 'description', 'tags', 'group_id'),
+                    rows),
+                   (entry_user_table, ('sikr_entry', 'sikr_user'), shares),
+                   _permissions('entry', shares)]
+
+    _fill("items", entry_batches(), use_copy)
+
+    if postgresql:
+        with engine.begin() as connection:
+            _reset_sequences(connection, tables)
@@ -0,0 +1,231 @@
+"""Rotation of the encryption keys.
+
+Encrypts again, with the current key, every stored value and every uploaded
+file that was encrypted with another one. The rows are rotated in small
+transactions, in order of id, and the files one at a time, in order of
+service id. The last id of each table, and of the files, is saved in a
+checkpoint file after every transaction or file, so the job can be stopped
+and started again at any moment. The API keeps working meanwhile, the
+keyring reads the values and the files under both keys.
+"""
+
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy import String, bindparam, select, type_coerce
+
+from sikr import settings
+from sikr.db.connector import Base, engine
+from sikr.db.types import EncryptedString, keyring
+from sikr.models import entries  # noqa: registers the encrypted tables
+from sikr.utils.cryptofunctions import StreamCipher
+
+logger = logging.getLogger(__name__)
+
+
+def get_encrypted_tables():
+    """Get the tables with encrypted columns, with those columns."""
+    tables = []
+    for table in Base.metadata.sorted_tables:
+        columns = [column for column in table.columns
+                   if isinstance(column.type, EncryptedString)]
+        if columns:
+            tables.append((table, columns))
+    return tables
+
+
+def load_checkpoint(path):
+    """Get the progress of the rotation.
+
+    The progress of a rotation to another key is discarded, the rows and
+    files it rotated must be rotated again.
+
+    Returns:
+        dict: The last rotated id of each table, in ``tables``, and the id of
+            the service of the last rotated file, in ``files``.
+    """
+    checkpoint = {'tables': {}, 'files': 0}
+    try:
+        with open(path) as checkpoint_file:
+            saved = json.load(checkpoint_file)
+    except FileNotFoundError:
+        return checkpoint
+    if saved.get('key') == keyring.current:
+        checkpoint['tables'] = saved.get('tables', {})
+        checkpoint['files'] = saved.get('files', 0)
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    """Save the progress, replacing the file so it's never left half written."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as tmp:
+        json.dump({'key': keyring.current, 'tables': checkpoint['tables'],
+                   'files': checkpoint['files']}, tmp)
+    os.replace(tmp_path, path)
+
+
+def rotate_batch(connection, table, columns, after, batch_size, workers=None):
+    """Rotate the values of a batch of rows.
+
+    The rows are locked until the transaction ends, so a concurrent update
+    can't be overwritten with the old value. The values of the whole batch
+    are rotated at once, split between ``workers`` threads.
+
+    Returns:
+        tuple: Last id read (None if there were no rows) and number of rows
+            rotated.
+    """
+    raw_columns = [type_coerce(column, String).label(column.name)
+                   for column in columns]
+    query = (select([table.c.id] + raw_columns)
+             .where(table.c.id > after)
+             .order_by(table.c.id)
+             .limit(batch_size)
+             .with_for_update())
+    rows = connection.execute(query).fetchall()
+    if not rows:
+        return None, 0
+
+    params = []
+    pending = []
+    for row in rows:
+        values = {'b_id': row['id']}
+        changed = False
+        for column in columns:
+            value = row[column.name]
+            if value is not None and keyring.needs_rotation(value):
+                pending.append((values, 'b_' + column.name, value))
+                changed = True
+            values['b_' + column.name] = value
+        if changed:
+            params.append(values)
+
+    rotated = keyring.rotate_many((value for _, _, value in pending), workers)
+    for (values, name, _), value in zip(pending, rotated):
+        values[name] = value.decode('ascii')
+
+    if params:
+        update = (table.update()
+                  .where(table.c.id == bindparam('b_id'))
+                  .values({column.name: type_coerce(bindparam('b_' + column.name), String)
+                           for column in columns}))
+        connection.execute(update, params)
+    return rows[-1]['id'], len(params)
+
+
+def get_file_ids(upload_dir):
+    """Get the ids of the services with a file, in order."""
+    if not os.path.isdir(upload_dir):
+        return []
+    return sorted(int(name) for name in os.listdir(upload_dir)
+                  if name.isdigit())
+
+
+def rotate_file(path):
+    """Encrypt a file again with the current key, if it isn't already.
+
+    The file is encrypted into a temporary file that replaces it, so it's
+    never left half written. If the file is uploaded again meanwhile the new
+    one, that already uses the current key, is kept.
+
+    Returns:
+        bool: Whether the file was rotated.
+    """
+    cipher = StreamCipher(keyring)
+    tmp_path = None
+    try:
+        with open(path, 'rb') as src:
+            stat = os.fstat(src.fileno())
+            if not cipher.needs_rotation(src):
+                return False
+            src.seek(0)
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path),
+                                             suffix='.tmp', delete=False) as dst:
+                tmp_path = dst.name
+                cipher.rotate_stream(src, dst)
+        current = os.stat(path)
+        if (current.st_ino, current.st_mtime_ns) != (stat.st_ino, stat.st_mtime_ns):
+            return False
+        os.replace(tmp_path, path)
+        tmp_path = None
+        return True
+    except FileNotFoundError:
+        # The file was deleted meanwhile
+        return False
+    finally:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def rotate_keys(batch_size=None, pause=None, checkpoint_path=None,
+                workers=None):
+    """Encrypt all the stored values and files with the current key.
+
+    Args:
+        batch_size (int): Rows per transaction.
+        pause (float): Seconds to wait between transactions and files.
+        checkpoint_path (str): File where the progress is saved. It's
+            removed once all the tables and files are rotated.
+        workers (int): Threads that encrypt the values of every batch.
+    """
+    batch_size = batch_size or settings.ROTATION_BATCH_SIZE
+    pause = settings.ROTATION_PAUSE if pause is None else pause
+    workers = workers or settings.ROTATION_WORKERS
+    checkpoint_path = checkpoint_path or settings.ROTATION_CHECKPOINT
+    checkpoint = load_checkpoint(checkpoint_path)
+
+    start_msg = "Rotating encryption keys to key {0}...".format(keyring.current)
+    print(f"[ --  ] {start_msg}")
+    logger.info(start_msg)
+    try:
+        for table, columns in get_encrypted_tables():
+            after = checkpoint['tables'].get(table.name, 0)
+            rotated = 0
+            while True:
+                with engine.begin() as connection:
+                    last_id, count = rotate_batch(connection, table, columns,
+                                                  after, batch_size, workers)
+                if last_id is None:
+                    break
+                after = last_id
+                rotated += count
+                checkpoint['tables'][table.name] = after
+                save_checkpoint(checkpoint_path, checkpoint)
+                logger.debug("Rotated %s rows of %s up to id %s",
+                             rotated, table.name, after)
+                if pause:
+                    time.sleep(pause)
+            table_msg = "{0}: {1} rows rotated".format(table.name, rotated)
+            print(f"[ OK  ] {table_msg}")
+            logger.info(table_msg)
+
+        rotated = 0
+        for service_id in get_file_ids(settings.UPLOAD_DIR):
+            if service_id <= checkpoint['files']:
+                continue
+            if rotate_file(os.path.join(settings.UPLOAD_DIR, str(service_id))):
+                rotated += 1
+            checkpoint['files'] = service_id
+            save_checkpoint(checkpoint_path, checkpoint)
+            logger.debug("Rotated %s files up to service %s", rotated, service_id)
+            if pause:
+                time.sleep(pause)
+        files_msg = "Files: {0} rotated".format(rotated)
+        print(f"[ OK  ] {files_msg}")
+        logger.info(files_msg)
+    except Exception as e:
+        error_msg = f"Error rotating keys, run it again to continue: {e}"
+        print(f"[ERROR] {error_msg}")
+        logger.error(error_msg)
+        sys.exit(1)
+
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    end_msg = "Encryption keys rotated"
+    print(f"[ OK  ] {end_msg}")
+    logger.info(end_msg)
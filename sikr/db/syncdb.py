@@ -1,7 +1,14 @@
+import logging
+import sys
+
 from sikr.db.connector import Base, engine
 from sikr.models.users import UserGroup, User
-from sikr.models.entries import Group, Entry
-from sikr.utils.logs import logger
+from sikr.models.entries import Group, Entry, Service
+from sikr.models.permissions import rebuild_permissions
+from sikr.models.emails import OutboxEmail
+from sikr.models.shares import ShareToken
+
+logger = logging.getLogger(__name__)
 
 
 def generate_schema():
@@ -19,3 +26,21 @@ def generate_schema():
         print(f"[ERROR] {error_msg}")
         logger.error(error_msg)
         sys.exit(1)
+
+
+def rebuild_permission_table():
+    """Build the table of effective permissions again from the shares."""
+    start_msg = "Rebuilding the permissions table..."
+    end_msg = "Permissions table rebuilt"
+    print(f"[ --  ] {start_msg}")
+    logger.info(start_msg)
+    try:
+        with engine.begin() as connection:
+            rebuild_permissions(connection)
+        print(f"[ OK  ] {end_msg}")
+        logger.info(end_msg)
+    except Exception as e:
+        error_msg = f"Error rebuilding the permissions: {e}"
+        print(f"[ERROR] {error_msg}")
+        logger.error(error_msg)
+        sys.exit(1)
@@ -0,0 +1,31 @@
+"""Custom column types."""
+
+from sqlalchemy.types import TypeDecorator, String
+
+from sikr import settings
+from sikr.utils.cryptofunctions import KeyRing
+
+keyring = KeyRing(settings.ENCRYPTION_KEYS, settings.ENCRYPTION_KEY_ID,
+                  legacy=settings.SECRET)
+
+
+class EncryptedString(TypeDecorator):
+
+    """String that is stored encrypted with the keyring.
+
+    The values are encrypted when they are written and decrypted when they
+    are loaded, so the models only see the plain text. To read the stored
+    ciphertext, for example to rotate it, coerce the column to ``String``.
+    """
+
+    impl = String
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return keyring.encrypt(value).decode('ascii')
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return keyring.decrypt(value)
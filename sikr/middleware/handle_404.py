@@ -1,8 +1,7 @@
-import json
-
 import falcon
 
 from sikr import settings
+from sikr.utils import codec
 
 
 class WrongURL(object):
@@ -21,5 +20,5 @@ class WrongURL(object):
             JSON: A customized JSON response
         """
         if resp.status == falcon.HTTP_404:
-            resp.body = json.dumps({"message": "Resource not found",
-                                    "documentation": settings.__docs__})
+            resp.body = codec.dumps({"message": "Resource not found",
+                                     "documentation": settings.__docs__})
@@ -1,63 +1,87 @@
-import re
-
 import falcon
 
 from sikr import settings
-from sikr.utils.logs import logger
+
+ALLOW_HEADERS = ('Origin, X-Requested-With, Content-Type, Accept, x-auth-user, '
+                 'x-auth-password, Authorization')
+ALLOW_METHODS = 'GET, PUT, POST, OPTIONS, DELETE'
 
 
 class BaseHeaders(object):
-    # Unused regular expression to check that origin is always a website.
-    # expression = re.compile("^(https?:\/\/)?([\da-z\.-]+)\.([a-z\.]{2,6})([\/\w \.-]*)*\/?$")
 
-    def process_request(self, req, res):
+    """Set the common headers of every response and answer CORS preflights.
+
+    The headers that never change are built once, when the middleware is
+    created, and the origin is checked against a precomputed allow-list.
+    This middleware must go before the rest of the application middleware,
+    so a preflight OPTIONS request is answered before the database session,
+    the JSON checks or any resource run. The only middleware allowed ahead
+    of it is the observability one (``RequestMetrics`` and
+    ``RequestTiming``), that has to wrap the whole request, preflights
+    included, and never touches the request or the response body.
+    """
+
+    def __init__(self):
+        self.cors_active = settings.CORS_ACTIVE
+        self.allowed_origins = frozenset(settings.CORS_ALLOWED_ORIGINS)
+        self.response_headers = [
+            ('Cache-Control', 'no-store, must-revalidate, no-cache, max-age=0'),
+            ('Server', settings.SERVER_NAME),
+            ('Access-Control-Allow-Credentials', 'true'),
+            ('Access-Control-Allow-Headers', ALLOW_HEADERS),
+            ('Access-Control-Allow-Methods', ALLOW_METHODS),
+            ('Access-Control-Expose-Headers', 'X-Next-Cursor'),
+        ]
+        self.preflight_headers = self.response_headers + [
+            ('Content-Type', 'application/json; charset=utf-8'),
+            ('Access-Control-Max-Age', str(settings.CORS_MAX_AGE)),
+        ]
 
-        """Process the request before entering in the API
+    def get_origin(self, req):
+        """Get the value of the Access-Control-Allow-Origin header.
 
-        Before we process anything in the API, we reset the Origin header to
-        match the address from the request.
+        If CORS is active the origin of the request is allowed back, as long
+        as it's in CORS_ALLOWED_ORIGINS (or the list is empty). Disallowed
+        origins get the SITE_DOMAIN.
+        """
+        origin = req.get_header('Origin')
+        if not self.cors_active or not origin:
+            return '*'
+        if self.allowed_origins and origin not in self.allowed_origins:
+            return settings.SITE_DOMAIN
+        return origin
 
-        Args:
-            Access-Control-Allow-Origin: Change the origin to the URL that made
-                the request.
+    def process_request(self, req, res):
 
-        Raises:
-            HTTP Error: An HTTP error in case the Origin header doesn't match
-                        the predefined regular expression.
+        """Process the request before entering in the API
 
-        Return:
-            HTTP headers: A modified set of headers.
+        Preflight OPTIONS requests are answered right here, the rest of the
+        middleware and the resources never see them. Other requests get the
+        default Content-Type, that the resource can still change.
 
+        Raises:
+            HTTP Status: A 200 response to the preflight request.
         """
+        if req.method == 'OPTIONS':
+            res.set_headers(self.preflight_headers)
+            res.set_header('Access-Control-Allow-Origin', self.get_origin(req))
+            res.set_header('Vary', 'Origin')
+            raise falcon.HTTPStatus(falcon.HTTP_200, body='')
 
-        origin_domain = req.get_header('Origin')
-        logger.debug("Origin domain is: {}, type: {}".format(origin_domain, type(origin_domain)))
-        origin_header = origin_domain if settings.CORS_ACTIVE and origin_domain else "*"
-        logger.debug("Origin header is: {}, type: {}".format(origin_header, type(origin_header)))
-
-        res.set_headers([
-            ('Cache-Control', 'no-store, must-revalidate, no-cache, max-age=0'),
-            ('Content-Type', 'application/json; charset=utf-8'),
-            ('Access-Control-Allow-Credentials', 'true'),
-            ('Access-Control-Allow-Origin', origin_header),
-            ('Access-Control-Allow-Headers', 'Origin, X-Requested-With, Content-Type, Accept, x-auth-user, x-auth-password, Authorization'),
-            ('Access-Control-Allow-Methods', 'GET, PUT, POST, OPTIONS, DELETE')
-        ])
+        res.set_header('Content-Type', 'application/json; charset=utf-8')
 
     def process_response(self, req, res, resource):
 
         """Process the response before returning it to the client.
 
         In the reutrning reponse we change some values to be able to overcome
-        the CORS protection and mask the origin server. The CORS interaction
-        is protected by a check agains a regular expression to make sure the
-        origin is a website-like URL.
+        the CORS protection and mask the origin server.
 
         Warning:
             If you are really concerned about security, you can deactivate
-            the CORS allowance by turning CORS_ACTIVE to `False` in your settings
-            file. That will force the application to answer to the SITE_DOMAIN
-            domain.
+            the CORS allowance by turning CORS_ACTIVE to `False` in your
+            settings file, or restrict it to the frontends listed in
+            CORS_ALLOWED_ORIGINS.
 
         Args:
             Server (string): Changes the server name sent to the browser in the
@@ -66,25 +90,9 @@ class BaseHeaders(object):
                 match the one that made the request. That way we can allow CORS
                 anywhere.
 
-        Raises:
-            HTTP Error: An HTTP error in case the Origin header doesn't match
-            the predefined regular expression.
-
         Returns:
             HTTP headers: A modified set of headers
         """
-
-        origin_domain = req.get_header('Origin')
-        logger.debug("Origin domain is: {}, type: {}".format(origin_domain, type(origin_domain)))
-        origin_header = origin_domain if settings.CORS_ACTIVE and origin_domain else "*"
-        logger.debug("Origin header is: {}, type: {}".format(origin_header, type(origin_header)))
-
-        res.set_headers([
-            ('Cache-Control', 'no-store, must-revalidate, no-cache, max-age=0'),
-            ('Content-Type', 'application/json; charset=utf-8'),
-            ('Server', settings.SERVER_NAME),
-            ('Access-Control-Allow-Credentials', 'true'),
-            ('Access-Control-Allow-Origin', origin_header),
-            ('Access-Control-Allow-Headers', 'Origin, X-Requested-With, Content-Type, Accept, x-auth-user, x-auth-password, Authorization'),
-            ('Access-Control-Allow-Methods', 'GET, PUT, POST, OPTIONS, DELETE')
-        ])
+        res.set_headers(self.response_headers)
+        res.set_header('Access-Control-Allow-Origin', self.get_origin(req))
+        res.set_header('Vary', 'Origin')
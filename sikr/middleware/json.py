@@ -1,20 +1,28 @@
-import json
-
 import falcon
 
 from sikr import settings
+from sikr.utils import codec
 
 
 class RequireJSON(object):
 
-    def process_request(self, req, resp):
+    """Only accept JSON requests and clients that accept JSON responses.
+
+    The checks are done once the resource is known, resources that read or
+    send their own body (like file uploads) set ``raw_content = True`` and are
+    left alone.
+    """
+    def process_resource(self, req, resp, resource, params):
+        if getattr(resource, 'raw_content', False):
+            return
+
         if not req.client_accepts_json:
             raise falcon.HTTPNotAcceptable(
                 'This API only supports responses encoded as JSON.',
                 href=settings.__docs__)
 
         if req.method in ('POST', 'PUT'):
-            if 'application/json' not in req.content_type:
+            if 'application/json' not in (req.content_type or ''):
                 raise falcon.HTTPUnsupportedMediaType(
                     'This API only supports requests encoded as JSON.',
                     href=settings.__docs__)
@@ -22,7 +30,7 @@ class RequireJSON(object):
 
 class JSONTranslator(object):
 
-    def process_request(self, req, resp):
+    def process_resource(self, req, resp, resource, params):
         # req.stream corresponds to the WSGI wsgi.input environ variable,
         # and allows you to read bytes from the request body.
         #
@@ -31,13 +39,17 @@ class JSONTranslator(object):
             # Nothing to do
             return
 
+        if getattr(resource, 'raw_content', False):
+            # The resource reads the body itself
+            return
+
         body = req.stream.read()
         if not body:
             raise falcon.HTTPBadRequest('Empty request body',
                                         'A valid JSON document is required.')
 
         try:
-            req.context['doc'] = json.loads(body.decode('utf-8'))
+            req.context['doc'] = codec.loads(body)
 
         except (ValueError, UnicodeDecodeError):
             raise falcon.HTTPError(falcon.HTTP_753,
@@ -47,7 +59,13 @@ class JSONTranslator(object):
                                    'UTF-8.')
 
     def process_response(self, req, resp, resource):
+        # Streamed results are encoded while the server sends them, see
+        # sikr.utils.streaming.JSONStream
+        if 'stream' in req.context:
+            resp.stream = req.context['stream']
+            return
+
         if 'result' not in req.context:
             return
 
-        resp.body = json.dumps(req.context['result'])
+        resp.body = codec.dumps(req.context['result'])
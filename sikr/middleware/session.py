@@ -0,0 +1,58 @@
+import falcon
+
+from sikr.db.connector import Session, engine, get_read_engine
+
+# Methods that never write, they can be served by a read replica
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Answers sent without a body, their stream is dropped by Falcon unread
+BODILESS_STATUS = (falcon.HTTP_100, falcon.HTTP_101, falcon.HTTP_204,
+                   falcon.HTTP_304)
+
+
+class DBSession(object):
+
+    """Open a database session for the lifetime of every request.
+
+    The session is stored in ``req.context['session']`` for the resources to
+    use it. Read only requests are bound to one of the read replicas and the
+    rest to the primary database. When the request finishes the session is
+    committed, or rolled back if the request failed, and closed.
+
+    Warning:
+        Replicas can lag behind the primary, a GET sent right after a write
+        may not see it yet.
+
+    If the resource streams its result the session stays open until the
+    WSGI server closes the stream, so this middleware must run before the
+    JSON middleware in the middleware list. HEAD requests and answers without
+    a body never send the stream, the session is closed right away.
+    """
+    def process_request(self, req, resp):
+        bind = get_read_engine() if req.method in READ_METHODS else engine
+        req.context['session'] = Session(bind=bind)
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        session = req.context.get('session')
+        if session is None:
+            return
+
+        stream = req.context.get('stream')
+        if stream is not None:
+            if (req_succeeded and req.method != 'HEAD' and
+                    resp.status not in BODILESS_STATUS):
+                # The rows are read while the response is sent
+                stream.on_close = session.close
+                return
+            stream.close()
+
+        try:
+            if req_succeeded:
+                session.commit()
+            else:
+                session.rollback()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
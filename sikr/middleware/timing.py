@@ -0,0 +1,132 @@
+import logging
+import threading
+import time
+
+from sikr import settings
+from sikr.db import connector
+from sikr.models.users import identity_cache, user_cache
+from sikr.resources.auth.utils import token_cache
+from sikr.utils import metrics, timing
+
+logger = logging.getLogger(__name__)
+
+
+class RequestTiming(object):
+
+    """Measure where the time of every request goes.
+
+    The request is split in the middleware chain, the resource (with its
+    hooks, like the authentication) and the JSON encoding and parsing, and
+    the SQL statements are counted and timed. The result is sent in the
+    ``Server-Timing`` header and logged, and a warning is logged if a
+    request executes more than TIMING_QUERY_THRESHOLD statements, as it's
+    probably running a query per row (N+1).
+
+    This middleware must be the first of the list and ``ResourceTiming`` the
+    last one. Only enable them with TIMING_ACTIVE, they add some overhead.
+    """
+
+    def __init__(self):
+        self.query_threshold = settings.TIMING_QUERY_THRESHOLD
+        timing.instrument_codec()
+        for engine in [connector.engine] + connector.replica_engines:
+            timing.instrument_engine(engine)
+
+    def process_request(self, req, resp):
+        timing.start_request()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        stats = timing.end_request()
+        if stats is None:
+            return
+
+        total = time.perf_counter() - stats.start
+        resource_time = 0.0
+        if 'resource_end' in stats.marks:
+            resource_time = stats.marks['resource_end'] - stats.marks['resource_start']
+        phases = [
+            ('middleware', total - resource_time),
+            ('resource', resource_time),
+            ('auth', stats.phases['auth']),
+            ('serialize', stats.phases['serialize']),
+            ('parse', stats.phases['parse']),
+            ('db', stats.db_time),
+            ('total', total),
+        ]
+        server_timing = ['{0};dur={1:.2f}'.format(name, seconds * 1000)
+                         for name, seconds in phases]
+        server_timing.append('queries;desc="{0}"'.format(stats.queries))
+        resp.set_header('Server-Timing', ', '.join(server_timing))
+
+        logger.info("Request timing method=%s path=%s status=%s queries=%s %s",
+                    req.method, req.path, resp.status.split()[0], stats.queries,
+                    " ".join("{0}_ms={1:.2f}".format(name, seconds * 1000)
+                             for name, seconds in phases))
+
+        if stats.queries > self.query_threshold:
+            statement, count = stats.statements.most_common(1)[0]
+            logger.warning("Possible N+1 queries in %s %s: %s statements, "
+                           "%s times: %s", req.method, req.path, stats.queries,
+                           count, " ".join(statement.split()))
+
+
+class ResourceTiming(object):
+
+    """Mark where the resource starts and ends for ``RequestTiming``.
+
+    This middleware must be the last of the list, so its hooks run right
+    before and right after the resource.
+    """
+
+    def process_resource(self, req, resp, resource, params):
+        stats = timing.current()
+        if stats is not None:
+            stats.marks['resource_start'] = time.perf_counter()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        stats = timing.current()
+        if stats is not None and 'resource_start' in stats.marks:
+            stats.marks['resource_end'] = time.perf_counter()
+
+
+class RequestMetrics(object):
+
+    """Record the metrics of every request, see ``sikr.utils.metrics``.
+
+    The requests are counted and timed by method and resource, the ones
+    answered with an error status are counted apart, and the hits and misses
+    of the caches of the process are added since the last request. This
+    middleware must be the first of the list, so it measures the rest.
+    """
+
+    def __init__(self):
+        # Caches of the process and the counts already recorded
+        self.caches = (('jwt', token_cache), ('user', user_cache),
+                       ('identity', identity_cache))
+        self.recorded = {}
+        self._lock = threading.Lock()
+
+    def process_request(self, req, resp):
+        req.context['metrics_start'] = time.perf_counter()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        start = req.context.get('metrics_start')
+        if start is None:
+            return
+        route = resource.__class__.__name__ if resource is not None else 'none'
+        status = resp.status.split()[0]
+        labels = (('method', req.method), ('route', route))
+        metrics.inc('sikr_requests_total', labels + (('status', status),))
+        metrics.observe('sikr_request_duration_seconds',
+                        time.perf_counter() - start, labels)
+        if int(status) >= 400:
+            metrics.inc('sikr_errors_total', labels + (('status', status),))
+
+        with self._lock:
+            for name, cache in self.caches:
+                for kind, count in (('hits', cache.hits), ('misses', cache.misses)):
+                    new = count - self.recorded.get((name, kind), 0)
+                    if new:
+                        self.recorded[(name, kind)] = count
+                        metrics.inc('sikr_cache_{0}_total'.format(kind),
+                                    (('cache', name),), new)
@@ -0,0 +1,36 @@
+import datetime
+
+from sqlalchemy import Column, Integer, String, Text, DateTime
+
+from sikr.db.connector import Base
+from sikr.db.mixins import SikrModelMixin
+
+
+class OutboxEmail(Base, SikrModelMixin):
+
+    """Email waiting to be sent, see ``sikr.utils.email``.
+
+    The emails are deleted once they are sent. The ones that failed
+    EMAIL_MAX_ATTEMPTS times are kept with their last error.
+    """
+    from_address = Column(String, nullable=False)
+    # Comma separated recipients
+    to_address = Column(Text, nullable=False)
+    # The whole MIME message, ready to be sent
+    message = Column(Text, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    # UTC time of the next attempt to send it. While a dispatcher sends it,
+    # the end of its claim.
+    next_attempt = Column(DateTime, nullable=False, index=True,
+                          default=datetime.datetime.utcnow)
+    # Claim of the dispatcher that is sending it
+    claimed_by = Column(String(32), index=True)
+    last_error = Column(String)
+
+    @property
+    def recipients(self):
+        return [address.strip() for address in self.to_address.split(',')]
+
+    def __repr__(self):
+        """String representation of the object."""
+        return f"<OutboxEmail: {self.to_address}>"
@@ -1,28 +1,109 @@
 import datetime
 
-from sqlalchemy import Column, Integer, String, ForeignKey, Table, DateTime
+from sqlalchemy import (Column, Integer, String, ForeignKey, Table, DateTime,
+                        Index)
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 
 from sikr.db.connector import Base
+from sikr.db.types import EncryptedString
 from sikr.db.mixins import SikrModelMixin
-from sikr.models.users import User
+from sikr.models.users import User, UserGroup
+
+
+# Shares of the objects with users and user groups (below). granted_by is the
+# id of the user that shared the object, with the bulk sharing or an
+# invitation, empty for the rest.
+group_user_table = Table('sikr_group_user_m2m', Base.metadata,
+    Column('sikr_group', Integer, ForeignKey('sikr_group.id')),
+    Column('sikr_user', Integer, ForeignKey('sikr_user.id')),
+    Column('granted_by', Integer),
+    # Listings walk the permissions of a user ordered by object id
+    Index('ix_sikr_group_user_m2m_user', 'sikr_user', 'sikr_group')
+)
+
+entry_user_table = Table('sikr_entry_user_m2m', Base.metadata,
+    Column('sikr_entry', Integer, ForeignKey('sikr_entry.id')),
+    Column('sikr_user', Integer, ForeignKey('sikr_user.id')),
+    Column('granted_by', Integer),
+    Index('ix_sikr_entry_user_m2m_user', 'sikr_user', 'sikr_entry')
+)
+
+service_user_table = Table('sikr_service_user_m2m', Base.metadata,
+    Column('sikr_service', Integer, ForeignKey('sikr_service.id')),
+    Column('sikr_user', Integer, ForeignKey('sikr_user.id')),
+    Column('granted_by', Integer),
+    Index('ix_sikr_service_user_m2m_user', 'sikr_user', 'sikr_service')
+)
+
+# Objects shared with user groups, every member of the group has access
+group_usergroup_table = Table('sikr_group_usergroup_m2m', Base.metadata,
+    Column('sikr_group', Integer, ForeignKey('sikr_group.id')),
+    Column('sikr_usergroup', Integer, ForeignKey('sikr_usergroup.id')),
+    Column('granted_by', Integer),
+    Index('ix_sikr_group_usergroup_m2m_usergroup', 'sikr_usergroup', 'sikr_group')
+)
+
+entry_usergroup_table = Table('sikr_entry_usergroup_m2m', Base.metadata,
+    Column('sikr_entry', Integer, ForeignKey('sikr_entry.id')),
+    Column('sikr_usergroup', Integer, ForeignKey('sikr_usergroup.id')),
+    Column('granted_by', Integer),
+    Index('ix_sikr_entry_usergroup_m2m_usergroup', 'sikr_usergroup', 'sikr_entry')
+)
+
+service_usergroup_table = Table('sikr_service_usergroup_m2m', Base.metadata,
+    Column('sikr_service', Integer, ForeignKey('sikr_service.id')),
+    Column('sikr_usergroup', Integer, ForeignKey('sikr_usergroup.id')),
+    Column('granted_by', Integer),
+    Index('ix_sikr_service_usergroup_m2m_usergroup', 'sikr_usergroup', 'sikr_service')
+)
 
 
 class Group(Base, SikrModelMixin):
     name = Column(String)
-    #allowed_users = ManyToManyField(User, related_name='allowed_categories')
-
-#UserCategory = Category.allowed_users.get_through_model()
+    allowed_users = relationship("User",
+                                 secondary=group_user_table,
+                                 backref="allowed_groups")
+    allowed_usergroups = relationship("UserGroup",
+                                      secondary=group_usergroup_table,
+                                      backref="allowed_groups")
 
 
 class Entry(Base, SikrModelMixin):
     name = Column(String)
     description = Column(String)
-    #allowed_users = ManyToManyField(User, related_name='allowed_items')
+    allowed_users = relationship("User",
+                                 secondary=entry_user_table,
+                                 backref="allowed_entries")
+    allowed_usergroups = relationship("UserGroup",
+                                      secondary=entry_usergroup_table,
+                                      backref="allowed_entries")
     pub_date = Column(DateTime(timezone=True), server_default=func.now())
     mod_date = Column(DateTime(timezone=True), onupdate=func.now())
-    #tags = pw.CharField(null=True)
-    #category = pw.ForeignKeyField(Category)
+    tags = Column(String)
+    group_id = Column(Integer, ForeignKey('sikr_group.id'), index=True)
+    group = relationship("Group", backref="entries")
 
-#UserItem = Item.allowed_users.get_through_model()
+
+class Service(Base, SikrModelMixin):
+    """Credentials and files attached to an entry."""
+    name = Column(String)
+    username = Column(String)
+    password = Column(EncryptedString)
+    url = Column(String)
+    port = Column(Integer)
+    extra = Column(String)
+    ssh_title = Column(String)
+    ssh_public = Column(String)
+    ssh_private = Column(EncryptedString)
+    ssl_title = Column(String)
+    ssl_filename = Column(String)
+    other = Column(String)
+    allowed_users = relationship("User",
+                                 secondary=service_user_table,
+                                 backref="allowed_services")
+    allowed_usergroups = relationship("UserGroup",
+                                      secondary=service_usergroup_table,
+                                      backref="allowed_services")
+    entry_id = Column(Integer, ForeignKey('sikr_entry.id'), index=True)
+    entry = relationship("Entry", backref="services")
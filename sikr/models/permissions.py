@@ -0,0 +1,314 @@
+"""Effective permissions of the users.
+
+A user can access a category, item or service that is shared with them or
+with one of their user groups. ``permission_table`` keeps a row for every
+user, object and source of the access (DIRECT for the objects shared with
+the user, or the id of the user group), so checking the access to an object
+or listing the objects of a user is a single indexed query, whatever the
+number of groups and shares.
+
+The table is refreshed after every flush from the shares and memberships
+changed through the ORM. ``grant_access`` and ``revoke_access`` change the
+shares of many objects in bulk and refresh it too. Any other code that
+writes the share or membership tables with plain SQL statements must call
+``add_direct_permissions`` or ``rebuild_permissions``.
+"""
+
+import itertools
+
+from sqlalchemy import (Column, Index, Integer, PrimaryKeyConstraint, String,
+                        Table, and_, distinct, event, exists, func, literal,
+                        or_, select)
+from sqlalchemy.orm import attributes
+
+from sikr.db.connector import Base, Session
+from sikr.models.users import User, UserGroup, user_group_table
+from sikr.models.entries import (Group, Entry, Service, group_user_table,
+                                 entry_user_table, service_user_table,
+                                 group_usergroup_table, entry_usergroup_table,
+                                 service_usergroup_table)
+
+# Source of the permissions given by sharing the object with the user
+DIRECT = 0
+
+permission_table = Table('sikr_permission', Base.metadata,
+    Column('user_id', Integer, nullable=False),
+    Column('object_type', String(16), nullable=False),
+    Column('object_id', Integer, nullable=False),
+    Column('usergroup_id', Integer, nullable=False),
+    PrimaryKeyConstraint('user_id', 'object_type', 'object_id', 'usergroup_id'),
+    Index('ix_sikr_permission_object', 'object_type', 'object_id'),
+    Index('ix_sikr_permission_usergroup', 'usergroup_id', 'user_id')
+)
+
+# Type of every shared model, its tables of shares with users and with user
+# groups, the column of the object in those tables and the name of the
+# collection of these objects in User and UserGroup
+SHARED = {
+    Group: ('group', group_user_table, group_usergroup_table, 'sikr_group',
+            'allowed_groups'),
+    Entry: ('entry', entry_user_table, entry_usergroup_table, 'sikr_entry',
+            'allowed_entries'),
+    Service: ('service', service_user_table, service_usergroup_table,
+              'sikr_service', 'allowed_services'),
+}
+OBJECT_TYPES = {model: shared[0] for model, shared in SHARED.items()}
+
+
+def has_permission(session, user_id, model, object_id):
+    """Check if a user can access an object.
+
+    Args:
+        model: Class of the object, Group, Entry or Service.
+    """
+    return session.query(exists().where(and_(
+        permission_table.c.user_id == user_id,
+        permission_table.c.object_type == OBJECT_TYPES[model],
+        permission_table.c.object_id == object_id))).scalar()
+
+
+def visible_ids(user_id, model):
+    """Select the ids of the objects of a model that a user can access.
+
+    Meant to filter a query, ``query.filter(Entry.id.in_(visible_ids(...)))``.
+    """
+    return (select([permission_table.c.object_id])
+            .where(permission_table.c.user_id == user_id)
+            .where(permission_table.c.object_type == OBJECT_TYPES[model]))
+
+
+def _direct_rows(model, user_id=None, object_id=None):
+    """Select the permissions given by the shares with users."""
+    object_type, table, _, column, _ = SHARED[model]
+    query = select([table.c.sikr_user, literal(object_type), table.c[column],
+                    literal(DIRECT)]).distinct()
+    if user_id is not None:
+        query = query.where(table.c.sikr_user == user_id)
+    if object_id is not None:
+        query = query.where(table.c[column] == object_id)
+    return query
+
+
+def _usergroup_rows(model, user_id=None, usergroup_id=None, object_id=None):
+    """Select the permissions given by the shares with user groups."""
+    object_type, _, table, column, _ = SHARED[model]
+    query = (select([user_group_table.c.sikr_user, literal(object_type),
+                     table.c[column], table.c.sikr_usergroup])
+             .select_from(table.join(user_group_table,
+                                     user_group_table.c.sikr_usergroup ==
+                                     table.c.sikr_usergroup))
+             .distinct())
+    if user_id is not None:
+        query = query.where(user_group_table.c.sikr_user == user_id)
+    if usergroup_id is not None:
+        query = query.where(table.c.sikr_usergroup == usergroup_id)
+    if object_id is not None:
+        query = query.where(table.c[column] == object_id)
+    return query
+
+
+def _refresh(connection, scope, queries):
+    """Replace the permissions that match ``scope`` with the selected ones."""
+    columns = permission_table.c
+    connection.execute(permission_table.delete().where(
+        and_(*[columns[name] == value for name, value in scope.items()])))
+    for query in queries:
+        connection.execute(permission_table.insert().from_select(
+            ['user_id', 'object_type', 'object_id', 'usergroup_id'], query))
+
+
+def add_direct_permissions(connection, model, user_id, object_ids):
+    """Add the permissions of objects just shared with a user in bulk.
+
+    For the bulk writes that insert in the share tables without the ORM.
+    """
+    if object_ids:
+        connection.execute(permission_table.insert(), [
+            {'user_id': user_id, 'object_type': OBJECT_TYPES[model],
+             'object_id': object_id, 'usergroup_id': DIRECT}
+            for object_id in object_ids])
+
+
+def _refresh_shares(connection, model, object_ids, user_ids=(),
+                    usergroup_ids=()):
+    """Refresh the permissions of some objects given to users and groups."""
+    object_type, user_table, usergroup_table, column, _ = SHARED[model]
+    columns = permission_table.c
+    scope = and_(columns.object_type == object_type,
+                 columns.object_id.in_(object_ids))
+    if user_ids:
+        _refresh_where(connection,
+                       and_(scope, columns.usergroup_id == DIRECT,
+                            columns.user_id.in_(user_ids)),
+                       _direct_rows(model)
+                       .where(user_table.c[column].in_(object_ids))
+                       .where(user_table.c.sikr_user.in_(user_ids)))
+    if usergroup_ids:
+        _refresh_where(connection,
+                       and_(scope, columns.usergroup_id.in_(usergroup_ids)),
+                       _usergroup_rows(model)
+                       .where(usergroup_table.c[column].in_(object_ids))
+                       .where(usergroup_table.c.sikr_usergroup.in_(usergroup_ids)))
+
+
+def _refresh_where(connection, condition, query):
+    connection.execute(permission_table.delete().where(condition))
+    connection.execute(permission_table.insert().from_select(
+        ['user_id', 'object_type', 'object_id', 'usergroup_id'], query))
+
+
+def _targets(model, user_ids, usergroup_ids):
+    """Kind, share table, target table and column, and ids to share with."""
+    _, user_table, usergroup_table, _, _ = SHARED[model]
+    targets = (('users', user_table, User.__table__, 'sikr_user', user_ids),
+               ('usergroups', usergroup_table, UserGroup.__table__,
+                'sikr_usergroup', usergroup_ids))
+    return [target for target in targets if target[-1]]
+
+
+def grant_access(connection, model, object_ids, user_ids=(), usergroup_ids=(),
+                 granted_by=None):
+    """Share many objects with many users and user groups.
+
+    Every share table gets a single INSERT ... SELECT of the missing pairs of
+    object and user (or group), the ids that don't exist are skipped.
+
+    Args:
+        granted_by (int): Id of the user that shares the objects, the only
+            one that can revoke the new shares apart from their users.
+
+    Returns:
+        dict: Shares added with 'users' and with 'usergroups'.
+    """
+    _, _, _, column, _ = SHARED[model]
+    objects = model.__table__
+    added = {'users': 0, 'usergroups': 0}
+    for kind, table, target, target_column, ids in _targets(model, user_ids,
+                                                            usergroup_ids):
+        query = (select([objects.c.id, target.c.id,
+                         literal(granted_by, Integer)])
+                 .where(objects.c.id.in_(object_ids))
+                 .where(target.c.id.in_(ids))
+                 .where(~exists().where(and_(table.c[column] == objects.c.id,
+                                             table.c[target_column] == target.c.id))))
+        result = connection.execute(table.insert().from_select(
+            [column, target_column, 'granted_by'], query))
+        added[kind] = result.rowcount
+    _refresh_shares(connection, model, object_ids, user_ids, usergroup_ids)
+    return added
+
+
+def revoke_access(connection, model, object_ids, user_ids=(), usergroup_ids=(),
+                  revoked_by=None):
+    """Stop sharing many objects with many users and user groups.
+
+    Args:
+        revoked_by (int): Id of the user that stops sharing the objects. Only
+            the shares granted by this user and their own are removed, the
+            rest are skipped. All of them without it.
+
+    Returns:
+        dict: Shares removed with 'users' and with 'usergroups'.
+    """
+    _, _, _, column, _ = SHARED[model]
+    removed = {'users': 0, 'usergroups': 0}
+    for kind, table, _, target_column, ids in _targets(model, user_ids,
+                                                       usergroup_ids):
+        condition = and_(table.c[column].in_(object_ids),
+                         table.c[target_column].in_(ids))
+        if revoked_by is not None:
+            allowed = table.c.granted_by == revoked_by
+            if kind == 'users':
+                allowed = or_(allowed, table.c[target_column] == revoked_by)
+            condition = and_(condition, allowed)
+        result = connection.execute(table.delete().where(condition))
+        removed[kind] = result.rowcount
+    _refresh_shares(connection, model, object_ids, user_ids, usergroup_ids)
+    return removed
+
+
+def count_permitted(session, user_id, model, object_ids):
+    """Count how many of some objects a user can access."""
+    columns = permission_table.c
+    return session.query(func.count(distinct(columns.object_id))).filter(
+        columns.user_id == user_id,
+        columns.object_type == OBJECT_TYPES[model],
+        columns.object_id.in_(object_ids)).scalar()
+
+
+def rebuild_permissions(connection):
+    """Build the whole permissions table again from the shares."""
+    _refresh(connection, {}, itertools.chain(
+        (_direct_rows(model) for model in SHARED),
+        (_usergroup_rows(model) for model in SHARED)))
+
+
+def _changed(obj, key):
+    """Objects added to or removed from a collection since the last flush."""
+    history = attributes.get_history(obj, key,
+                                     passive=attributes.PASSIVE_NO_INITIALIZE)
+    return itertools.chain(history.added or (), history.deleted or ())
+
+
+@event.listens_for(Session, 'after_flush')
+def _update_permissions(session, flush_context):
+    """Refresh the permissions affected by the changes of a flush.
+
+    A change can be seen from both sides of a relationship, so the affected
+    shares and memberships are collected in sets first.
+    """
+    direct = set()       # (model, user id, object id)
+    shared = set()       # (model, user group id, object id)
+    memberships = set()  # (user id, user group id)
+    for obj in itertools.chain(session.new, session.dirty):
+        model = type(obj)
+        if model in SHARED:
+            for user in _changed(obj, 'allowed_users'):
+                direct.add((model, user.id, obj.id))
+            for usergroup in _changed(obj, 'allowed_usergroups'):
+                shared.add((model, usergroup.id, obj.id))
+        elif model is User:
+            for shared_model, (_, _, _, _, key) in SHARED.items():
+                for target in _changed(obj, key):
+                    direct.add((shared_model, obj.id, target.id))
+            for usergroup in _changed(obj, 'groups'):
+                memberships.add((obj.id, usergroup.id))
+        elif model is UserGroup:
+            for shared_model, (_, _, _, _, key) in SHARED.items():
+                for target in _changed(obj, key):
+                    shared.add((shared_model, obj.id, target.id))
+            for user in _changed(obj, 'users'):
+                memberships.add((user.id, obj.id))
+
+    deleted = []
+    for obj in session.deleted:
+        model = type(obj)
+        if model in SHARED:
+            deleted.append({'object_type': OBJECT_TYPES[model], 'object_id': obj.id})
+        elif model is User:
+            deleted.append({'user_id': obj.id})
+        elif model is UserGroup:
+            deleted.append({'usergroup_id': obj.id})
+
+    if not (direct or shared or memberships or deleted):
+        return
+
+    connection = session.connection()
+    for model, user_id, object_id in direct:
+        _refresh(connection,
+                 {'user_id': user_id, 'object_type': OBJECT_TYPES[model],
+                  'object_id': object_id, 'usergroup_id': DIRECT},
+                 [_direct_rows(model, user_id=user_id, object_id=object_id)])
+    for model, usergroup_id, object_id in shared:
+        _refresh(connection,
+                 {'usergroup_id': usergroup_id,
+                  'object_type': OBJECT_TYPES[model], 'object_id': object_id},
+                 [_usergroup_rows(model, usergroup_id=usergroup_id,
+                                  object_id=object_id)])
+    for user_id, usergroup_id in memberships:
+        _refresh(connection, {'user_id': user_id, 'usergroup_id': usergroup_id},
+                 [_usergroup_rows(model, user_id=user_id,
+                                  usergroup_id=usergroup_id)
+                  for model in SHARED])
+    for scope in deleted:
+        _refresh(connection, scope, [])
@@ -0,0 +1,120 @@
+import datetime
+
+from sqlalchemy import (Column, Integer, String, ForeignKey, DateTime,
+                        LargeBinary)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import relationship
+
+from sikr import settings
+from sikr.db.connector import Base
+from sikr.db.mixins import SikrModelMixin
+from sikr.models.permissions import OBJECT_TYPES, grant_access
+from sikr.utils.tokens import generate_token, hash_token
+
+# Shared model of every object type
+OBJECT_MODELS = {object_type: model for model, object_type in OBJECT_TYPES.items()}
+
+
+class ShareToken(Base, SikrModelMixin):
+
+    """Invitation to access a category, item or service.
+
+    The token is sent to the recipient and only its hash is stored, so the
+    tokens can't be used by someone that reads the database. A token can be
+    used once, before it expires.
+    """
+    token_hash = Column(LargeBinary(32), nullable=False, unique=True, index=True)
+    user_id = Column(Integer, ForeignKey('sikr_user.id'), nullable=False)
+    object_type = Column(String(16), nullable=False)
+    object_id = Column(Integer, nullable=False)
+    email = Column(String)
+    expires = Column(DateTime, nullable=False)
+    user = relationship("User")
+
+    def is_valid(self):
+        return bool(self.active) and self.expires > datetime.datetime.utcnow()
+
+    def __repr__(self):
+        """String representation of the object."""
+        return f"<ShareToken: {self.object_type} {self.object_id}>"
+
+
+def issue_share_tokens(session, user_id, model, object_id, emails):
+    """Create the tokens to share an object with many recipients.
+
+    All the tokens are inserted in a single statement. The tokens are random
+    enough to never repeat, but PostgreSQL skips the repeated ones anyway and
+    they are issued again.
+
+    Args:
+        user_id (int): Id of the user that shares the object.
+        model: Class of the object, Group, Entry or Service.
+        emails (list): Addresses of the recipients.
+
+    Returns:
+        dict: The token of every email.
+    """
+    table = ShareToken.__table__
+    expires = (datetime.datetime.utcnow() +
+               datetime.timedelta(hours=settings.SHARE_TOKEN_EXPIRES))
+    issued = {}
+    pending = list(dict.fromkeys(emails))
+    while pending:
+        tokens = {hash_token(token): (email, token) for email, token in
+                  ((email, generate_token()) for email in pending)}
+        rows = [{'active': True, 'token_hash': token_hash, 'user_id': user_id,
+                 'object_type': OBJECT_TYPES[model], 'object_id': object_id,
+                 'email': email, 'expires': expires}
+                for token_hash, (email, _) in tokens.items()]
+        if session.bind.dialect.name == 'postgresql':
+            result = session.execute(
+                postgresql.insert(table).values(rows)
+                          .on_conflict_do_nothing(index_elements=['token_hash'])
+                          .returning(table.c.token_hash))
+            inserted = [bytes(token_hash) for token_hash, in result]
+        else:
+            session.execute(table.insert(), rows)
+            inserted = list(tokens)
+        for token_hash in inserted:
+            email, token = tokens.pop(token_hash)
+            issued[email] = token
+        pending = [email for email, _ in tokens.values()]
+    return issued
+
+
+def get_share_token(session, token, lock=False):
+    """Get a valid share token.
+
+    Args:
+        lock (bool): Lock the row of the token until the end of the
+            transaction, to use it.
+
+    Returns:
+        ShareToken: The token, or None if it doesn't exist, it was already used
+        or it expired.
+    """
+    query = session.query(ShareToken).filter(ShareToken.token_hash == hash_token(token))
+    if lock:
+        query = query.with_for_update()
+    share = query.first()
+    if share is None or not share.is_valid():
+        return None
+    return share
+
+
+def redeem_share_token(session, token, user):
+    """Give a user access to the object of a share token, and spend the token.
+
+    The access is granted by the user that issued the token, who can revoke
+    it later.
+
+    Returns:
+        bool: If the token was valid.
+    """
+    share = get_share_token(session, token, lock=True)
+    if share is None:
+        return False
+    grant_access(session.connection(), OBJECT_MODELS[share.object_type],
+                 [share.object_id], [user.id], granted_by=share.user_id)
+    share.active = False
+    return True
@@ -1,8 +1,11 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Table
-from sqlalchemy.orm import relationship
+from sqlalchemy import (Column, Index, Integer, String, ForeignKey, Table,
+                        event)
+from sqlalchemy.orm import backref, relationship, make_transient_to_detached
 
+from sikr import settings
 from sikr.db.connector import Base
 from sikr.db.mixins import SikrModelMixin
+from sikr.utils.cache import LRUCache
 
 
 user_group_table = Table('sikr_user_group_m2m', Base.metadata,
@@ -41,3 +44,106 @@ class User(Base, SikrModelMixin):
     def __repr__(self):
         """String representation of the object."""
         return f"<User: {self.username}>"
+
+
+class UserIdentity(Base, SikrModelMixin):
+
+    """Account of a user in an OAuth provider.
+
+    A user can log in with an account of every provider, and every account
+    belongs to a single user.
+    """
+    __table_args__ = (
+        Index('ix_sikr_useridentity_account', 'provider', 'external_id',
+              unique=True),
+    )
+
+    provider = Column(String(16), nullable=False)
+    external_id = Column(String, nullable=False)
+    user_id = Column(Integer, ForeignKey('sikr_user.id'), nullable=False,
+                     index=True)
+    user = relationship("User",
+                        backref=backref("identities",
+                                        cascade="all, delete-orphan"))
+
+    def __repr__(self):
+        """String representation of the object."""
+        return f"<UserIdentity: {self.provider} {self.external_id}>"
+
+
+# Users loaded by this process, keyed by user id. Changes made by other
+# processes are seen once the key expires.
+user_cache = LRUCache(settings.USER_CACHE_SIZE, ttl=settings.USER_CACHE_TTL)
+
+# Columns kept in the cache, the rest are loaded when they are accessed
+USER_CACHED_FIELDS = ('id', 'active', 'username', 'name', 'email')
+
+
+def _get_cached_user(session, user_id):
+    """Get the cache entry of a user, loading it on a miss."""
+    cached = user_cache.get(user_id)
+    if cached is None:
+        user = session.query(User).get(user_id)
+        if user is None:
+            return None
+        cached = {field: getattr(user, field) for field in USER_CACHED_FIELDS}
+        user_cache.set(user_id, cached)
+    return cached
+
+
+def get_user(session, user_id):
+    """Get a user attached to ``session``, without a query when it's cached.
+
+    Returns:
+        User: The user, or None if it doesn't exist.
+    """
+    cached = _get_cached_user(session, user_id)
+    if cached is None:
+        return None
+    user = User(**cached)
+    make_transient_to_detached(user)
+    return session.merge(user, load=False)
+
+
+def invalidate_user(user_id):
+    """Remove a user from the cache.
+
+    The cache follows the changes made through the ORM, call this after
+    changing a user with plain SQL statements.
+    """
+    user_cache.delete(user_id)
+
+
+# Ids of the users of the OAuth accounts, keyed by provider and account id
+identity_cache = LRUCache(settings.IDENTITY_CACHE_SIZE,
+                          ttl=settings.IDENTITY_CACHE_TTL)
+
+
+def get_identity_user_id(session, provider, external_id):
+    """Get the id of the user of an OAuth account, cached.
+
+    Returns:
+        int: The id of the user, or None if the account isn't linked to one.
+    """
+    key = (provider, str(external_id))
+    user_id = identity_cache.get(key)
+    if user_id is None:
+        user_id = (session.query(UserIdentity.user_id)
+                          .filter(UserIdentity.provider == provider,
+                                  UserIdentity.external_id == str(external_id))
+                          .scalar())
+        if user_id is not None:
+            identity_cache.set(key, user_id)
+    return user_id
+
+
+@event.listens_for(UserIdentity, 'after_update')
+@event.listens_for(UserIdentity, 'after_delete')
+def _identity_changed(mapper, connection, target):
+    identity_cache.delete((target.provider, target.external_id))
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _user_changed(mapper, connection, target):
+    invalidate_user(target.id)
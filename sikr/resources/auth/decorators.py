@@ -1,10 +1,12 @@
-import datetime
+import logging
 
 import falcon
+import jwt
 
-from sikre import settings
-from sikre.resources.auth import utils
-from sikre.utils.logs import logger
+from sikr.resources.auth import utils
+from sikr.utils.timing import phase
+
+logger = logging.getLogger(__name__)
 
 
 def login_required(req, res, resource, params):
@@ -15,23 +17,20 @@ def login_required(req, res, resource, params):
         - Issuer host doesn't match the one specified in the settings file
         - Expiry timestamp is lower than the current timestamp
         - Issued timestamp is lower than the current timestamp minus SESSION_EXPIRES
+    The checks are made by utils.validate_token, the verified claims are left
+    in req.context['claims'] for the resource.
     :returns: Redirect to the LOGIN_URL or HTTP 200
     """
     if req.auth:
         logger.debug("The user has a token in the header")
-        payload = utils.parse_token(req)
-        current_time = datetime.datetime.now()
-        issue_time = current_time - datetime.timedelta(hours=settings.SESSION_EXPIRES)
-        if payload['iss'] != settings.SITE_DOMAIN or \
-           payload['exp'] <= int(current_time.timestamp()) or \
-           payload['iat'] <= int(issue_time.timestamp()):
-
+        try:
+            with phase('auth'):
+                utils.validate_token(req)
+        except jwt.InvalidTokenError:
             logger.debug("JWT token expired or malformed")
             raise falcon.HTTPError(falcon.HTTP_401, title="Credentials expired",
                                    description="Your crendentials have expired. Please login again.")
-
-        else:
-            res.status = falcon.HTTP_200
+        res.status = falcon.HTTP_200
     else:
         logger.debug("No JWT token found")
         raise falcon.HTTPError(falcon.HTTP_401, title="Credentials not found",
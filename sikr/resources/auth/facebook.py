@@ -1,13 +1,14 @@
-import json
 from urllib.parse import parse_qsl
+import logging
 
 import falcon
-import requests
 
-from sikre import settings
-from sikre.models.users import User
-from sikre.resources.auth import utils
-from sikre.utils.logs import logger
+from sikr import settings
+from sikr.resources.auth import utils
+from sikr.resources.auth.providers import get_client
+from sikr.utils import codec
+
+logger = logging.getLogger(__name__)
 
 
 class FacebookAuth(object):
@@ -16,12 +17,10 @@ class FacebookAuth(object):
 
         """Create the JWT token for the user
         """
-        access_token_url = 'https://graph.facebook.com/oauth/access_token'
-        graph_api_url = 'https://graph.facebook.com/me'
+        client = get_client('facebook')
 
-        # Read the incoming data
-        stream = req.stream.read()
-        data = json.loads(stream.decode('utf-8'))
+        # The incoming data is parsed by the JSON middleware
+        data = req.context['doc']
         logger.debug("Facebook OAuth: Incoming data read successfully")
 
         params = {
@@ -33,49 +32,23 @@ class FacebookAuth(object):
         logger.debug("Facebook OAuth: Built the code response correctly")
 
         # Step 1. Exchange authorization code for access token.
-        r = requests.get(access_token_url, params=params)
+        r = client.get('access_token', params=params)
         access_token = dict(parse_qsl(r.text))
         logger.debug("Facebook OAuth: Auth code exchange for token success")
 
         # Step 2. Retrieve information about the current user.
-        r = requests.get(graph_api_url, params=access_token)
-        profile = json.loads(r.text)
+        r = client.get('user', params=access_token)
+        profile = codec.loads(r.content)
         logger.debug("Facebook OAuth: Retrieve user information success")
 
-        # Step 3. (optional) Link accounts.
-        if req.auth:
-            payload = utils.parse_token(req)
-            try:
-                user = User.select().where(
-                    (User.facebook == profile['id']) |
-                    (User.id == payload['sub']) |
-                    (User.email == profile['email'])
-                ).get()
-                # Set the facebook code again. This is a failsafe.
-                user.facebook = profile['id']
-                user.save()
-                logger.debug("Facebook OAuth: Account {0} already exists".format(profile["id"]))
-            except User.DoesNotExist:
-                logger.debug("Facebook OAuth: User does not exist")
-                user = User.create(facebook=profile['id'], username=profile['name'], email=profile["email"])
-                user.save()
-                logger.debug("Facebook OAuth: Created user {0}".format(profile["name"]))
-        else:
-            try:
-                user = User.select().where(
-                    (User.facebook == profile['id']) |
-                    (User.email == profile['email'])
-                ).get()
-                # Set the github code again. This is a failsafe.
-                user.facebook = profile['id']
-                user.save()
-            except User.DoesNotExist:
-                logger.debug("Facebook OAuth: User does not exist")
-                user = User.create(facebook=profile['id'], username=profile['name'], email=profile["email"])
-                user.save()
-                logger.debug("Facebook OAuth: Created user {0}".format(profile["name"]))
+        # Step 3. Get the user of the account, linking it on the first login
+        def get_profile():
+            # Facebook has no handles, the user gets one made of the id
+            return {'name': profile['name'], 'email': profile.get('email'),
+                    'email_verified': False}
+        user = utils.login_user(req, 'facebook', profile['id'], get_profile)
         token = utils.create_jwt_token(user)
-        res.body = json.dumps({"token": token})
+        res.body = codec.dumps({"token": token})
         res.status = falcon.HTTP_200
 
     def on_options(self, req, res):
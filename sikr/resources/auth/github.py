@@ -1,13 +1,14 @@
-import json
 from urllib.parse import parse_qsl
+import logging
 
 import falcon
-import requests
 
-from sikre import settings
-from sikre.models.users import User
-from sikre.resources.auth import utils
-from sikre.utils.logs import logger
+from sikr import settings
+from sikr.resources.auth import utils
+from sikr.resources.auth.providers import get_client
+from sikr.utils import codec
+
+logger = logging.getLogger(__name__)
 
 
 class GithubAuth(object):
@@ -16,12 +17,10 @@ class GithubAuth(object):
 
         """Create the JWT token for the user
         """
-        access_token_url = 'https://github.com/login/oauth/access_token'
-        users_api_url = 'https://api.github.com/user'
+        client = get_client('github')
 
-        # Read the incoming data
-        stream = req.stream.read()
-        data = json.loads(stream.decode('utf-8'))
+        # The incoming data is parsed by the JSON middleware
+        data = req.context['doc']
         logger.debug("GitHub OAuth: Incoming data read successfully")
 
         params = {
@@ -33,51 +32,25 @@ class GithubAuth(object):
         logger.debug("GitHub OAuth: Built the code response correctly")
 
         # Step 1. Exchange authorization code for access token.
-        r = requests.get(access_token_url, params=params)
+        r = client.get('access_token', params=params)
         access_token = dict(parse_qsl(r.text))
         headers = {'User-Agent': 'Satellizer'}
         logger.debug("GitHub OAuth: Auth code exchange for token success")
 
         # Step 2. Retrieve information about the current user.
-        r = requests.get(users_api_url, params=access_token, headers=headers)
-        profile = json.loads(r.text)
+        r = client.get('user', params=access_token, headers=headers)
+        profile = codec.loads(r.content)
         logger.debug("GitHub OAuth: Retrieve user information success")
-        logger.debug("GitHub OAuth: Profile: {}".format(profile))
-
-        # Step 3. (optional) Link accounts.
-        if req.auth:
-            payload = utils.parse_token(req)
-            try:
-                user = User.select().where(
-                    (User.github == profile['id']) |
-                    (User.id == payload['sub']) |
-                    (User.email == profile['email'])
-                ).get()
-                # Set the github code again. This is a failsafe.
-                user.github = profile['id']
-                user.save()
-                logger.debug("GitHub OAuth: Account {0} already exists".format(profile["id"]))
-            except User.DoesNotExist:
-                logger.debug("GitHub OAuth: User does not exist")
-                user = User.create(github=profile['id'], username=profile['name'], email=profile["email"])
-                user.save()
-                logger.debug("GitHub OAuth: Created user {0}".format(profile["name"]))
-        else:
-            try:
-                user = User.select().where(
-                    (User.github == profile['id']) |
-                    (User.email == profile['email'])
-                ).get()
-                # Set the github code again. This is a failsafe.
-                user.github = profile['id']
-                user.save()
-            except User.DoesNotExist:
-                logger.debug("GitHub OAuth: User does not exist")
-                user = User.create(github=profile['id'], username=profile['name'], email=profile["email"])
-                user.save()
-                logger.debug("GitHub OAuth: Created user {0}".format(profile["name"]))
+        logger.debug("GitHub OAuth: Profile: %s", profile)
+
+        # Step 3. Get the user of the account, linking it on the first login
+        def get_profile():
+            # The public email of the profile may not be verified
+            return {'username': profile['login'], 'name': profile.get('name'),
+                    'email': profile.get('email'), 'email_verified': False}
+        user = utils.login_user(req, 'github', profile['id'], get_profile)
         token = utils.create_jwt_token(user)
-        res.body = json.dumps({"token": token})
+        res.body = codec.dumps({"token": token})
         res.status = falcon.HTTP_200
 
     def on_options(self, req, res):
@@ -1,31 +1,26 @@
-import json
 # from urllib.parse import parse_qsl
+import logging
 
 import falcon
-import requests
+import jwt
 
-from sikre import settings
-from sikre.models.users import User
-from sikre.models.shares import ShareToken
-from sikre.resources.auth import utils
-from sikre.utils.logs import logger
+from sikr import settings
+from sikr.resources.auth import utils
+from sikr.resources.auth.providers import get_client
+from sikr.utils import codec
+
+logger = logging.getLogger(__name__)
 
 
 class GoogleAuth(object):
 
     def on_post(self, req, res):
-        access_token_url = 'https://accounts.google.com/o/oauth2/token'
-        people_api_url = 'https://www.googleapis.com/plus/v1/people/me/openIdConnect'
+        client = get_client('google')
 
-        # Read the incoming data
-        stream = req.stream.read()
-        data = json.loads(stream.decode('utf-8'))
+        # The incoming data is parsed by the JSON middleware
+        data = req.context['doc']
         logger.debug("Google OAuth: Incoming data read successfully")
 
-        # See if the user has a share token
-        share_token = req.get_param("share_token", required=False)
-        logger.debug("Google OAuth: User carries a share token")
-
         payload = {
             'client_id': data['clientId'],
             'redirect_uri': data['redirectUri'],
@@ -36,39 +31,41 @@ class GoogleAuth(object):
         logger.debug("Google OAuth: Built the code response correctly")
 
         # Step 1. Exchange authorization code for access token.
-        r = requests.post(access_token_url, data=payload)
-        token = json.loads(r.text)
-        headers = {'Authorization': 'Bearer {0}'.format(token['access_token'])}
+        endpoints = client.discover()
+        r = client.post('access_token', url=endpoints['token_endpoint'],
+                        data=payload)
+        token = codec.loads(r.content)
         logger.debug("Google OAuth: Auth code exchange for token success")
 
-        # Step 2. Retrieve information about the current user.
-        r = requests.get(people_api_url, headers=headers)
-        profile = json.loads(r.text)
-        logger.debug("Google OAuth: Retrieve user information success")
-
+        # Step 2. Read the account from the ID token. It comes straight from
+        # Google, so its signature doesn't need to be checked, but it can be
+        # expired or issued to another client.
         try:
-            user = User.select().where(User.google == profile['sub']).get()
-            if user:
-                logger.debug("Google OAuth: Account {0} already exists".format(profile["sub"]))
-        except User.DoesNotExist:
-            logger.debug("Google OAuth: User does not exist")
-            user = User.create(google=profile['sub'], username=profile['name'], email=profile['email'])
-            user.save()
-            logger.debug("Google OAuth: Created user {0}".format(profile["name"]))
+            claims = jwt.decode(token['id_token'],
+                                options={'verify_signature': False},
+                                audience=data['clientId'])
+        except jwt.InvalidTokenError as e:
+            logger.debug("Google OAuth: ID token not valid: %s", e)
+            raise falcon.HTTPBadRequest(title="Bad request",
+                                        description="Google rejected the login",
+                                        href=settings.__docs__)
+
+        # Step 3. Get the user of the account, accepting the invitation of the
+        # share token if there's one. Only the first login needs the profile
+        # of the user.
+        def get_profile():
+            headers = {'Authorization': 'Bearer {0}'.format(token['access_token'])}
+            r = client.get('user', url=endpoints['userinfo_endpoint'],
+                           headers=headers)
+            profile = codec.loads(r.content)
+            logger.debug("Google OAuth: Retrieve user information success")
+            verified = profile.get('email_verified') in (True, 'true')
+            return {'username': profile['email'], 'name': profile.get('name'),
+                    'email': profile['email'], 'email_verified': verified}
+        user = utils.login_user(req, 'google', claims['sub'], get_profile)
 
         token = utils.create_jwt_token(user)
-
-        # if share_token:
-        #     try:
-        #         token = ShareToken.get(token=share_token)
-        #         if token.is_valid():
-        #             if token.resource == 0:
-
-        #     except:
-        #         logger.error("Token does not exist")
-
-
-        res.body = json.dumps({"token": token})
+        res.body = codec.dumps({"token": token})
         res.status = falcon.HTTP_200
         return
 
@@ -113,12 +110,12 @@ class GoogleAuth(object):
 
 #     # Step 1. Exchange authorization code for access token.
 #     r = requests.post(access_token_url, data=payload)
-#     token = json.loads(r.text)
+#     token = codec.loads(r.content)
 #     headers = {'Authorization': 'Bearer {0}'.format(token['access_token'])}
 
 #     # Step 2. Retrieve information about the current user.
 #     r = requests.get(people_api_url, headers=headers)
-#     profile = json.loads(r.text)
+#     profile = codec.loads(r.content)
 
 #     user = User.query.filter_by(google=profile['sub']).first()
 #     if user:
@@ -1,51 +1,61 @@
-import json
-from urllib.parse import parse_qsl, urlencode
+import logging
 
 import falcon
-import requests
-from requests_oauthlib import OAuth1Session
 
-from sikre import settings
-from sikre.models.users import User
-from sikre.resources.auth import utils
-from sikre.utils.logs import logger
+from sikr import settings
+from sikr.resources.auth import utils
+from sikr.resources.auth.providers import get_client
+from sikr.utils import codec
+
+logger = logging.getLogger(__name__)
 
 
 class LinkedinAuth(object):
 
     def on_post(self, req, res):
 
-        @app.route('/auth/linkedin', methods=['POST'])
-        def linkedin():
-            access_token_url = 'https://www.linkedin.com/uas/oauth2/accessToken'
-            people_api_url = 'https://api.linkedin.com/v1/people/~:(id,first-name,last-name,email-address)'
-
-            payload = dict(client_id=request.json['clientId'],
-                           redirect_uri=request.json['redirectUri'],
-                           client_secret=app.config['LINKEDIN_SECRET'],
-                           code=request.json['code'],
-                           grant_type='authorization_code')
-
-            # Step 1. Exchange authorization code for access token.
-            r = requests.post(access_token_url, data=payload)
-            access_token = json.loads(r.text)
-            params = dict(oauth2_access_token=access_token['access_token'],
-                          format='json')
-
-            # Step 2. Retrieve information about the current user.
-            r = requests.get(people_api_url, params=params)
-            profile = json.loads(r.text)
-
-            user = User.query.filter_by(linkedin=profile['id']).first()
-            if user:
-                token = create_token(user)
-                return jsonify(token=token)
-            u = User(linkedin=profile['id'],
-                     display_name=profile['firstName'] + ' ' + profile['lastName'])
-            db.session.add(u)
-            db.session.commit()
-            token = create_token(u)
-            return jsonify(token=token)
+        """Create the JWT token for the user
+        """
+        client = get_client('linkedin')
+
+        # The incoming data is parsed by the JSON middleware
+        data = req.context['doc']
+        logger.debug("LinkedIn OAuth: Incoming data read successfully")
+
+        payload = {
+            'client_id': data['clientId'],
+            'redirect_uri': data['redirectUri'],
+            'client_secret': settings.LINKEDIN_SECRET,
+            'code': data['code'],
+            'grant_type': 'authorization_code'
+        }
+        logger.debug("LinkedIn OAuth: Built the code response correctly")
+
+        # Step 1. Exchange authorization code for access token.
+        r = client.post('access_token', data=payload)
+        access_token = codec.loads(r.content)
+        params = {
+            'oauth2_access_token': access_token['access_token'],
+            'format': 'json'
+        }
+        logger.debug("LinkedIn OAuth: Auth code exchange for token success")
+
+        # Step 2. Retrieve information about the current user.
+        r = client.get('user', params=params)
+        profile = codec.loads(r.content)
+        logger.debug("LinkedIn OAuth: Retrieve user information success")
+
+        # Step 3. Get the user of the account, linking it on the first login
+        def get_profile():
+            # LinkedIn has no handles, the user gets one made of the id
+            name = profile['firstName'] + ' ' + profile['lastName']
+            return {'name': name, 'email': profile.get('emailAddress'),
+                    'email_verified': False}
+        user = utils.login_user(req, 'linkedin', profile['id'], get_profile)
+
+        token = utils.create_jwt_token(user)
+        res.body = codec.dumps({"token": token})
+        res.status = falcon.HTTP_200
 
     def on_options(self, req, res):
 
@@ -0,0 +1,217 @@
+"""HTTP client for the OAuth providers.
+
+Every provider gets a ``requests`` session per process, so the logins reuse
+the connections (and the TLS sessions) instead of opening new ones, with
+timeouts, retries and a circuit breaker. The URLs of the providers are taken
+from OAUTH_PROVIDERS.
+
+A provider that fails or that is down makes the login fail with a 503, and a
+request rejected by the provider (like an expired code) with a 400.
+"""
+
+import logging
+import os
+import threading
+import time
+
+import falcon
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from sikr import settings
+from sikr.utils import codec
+from sikr.utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Answers of the providers that are retried
+RETRY_STATUS = (500, 502, 503, 504)
+
+# OpenID Connect discovery documents, keyed by their URL
+discovery_cache = LRUCache(32, ttl=settings.OAUTH_DISCOVERY_TTL)
+
+
+class CircuitBreaker(object):
+
+    """Stop calling a provider that keeps failing.
+
+    After ``failures`` failures in a row the circuit opens and the calls are
+    refused. After ``reset_timeout`` seconds a single call is let through to
+    test the provider, the circuit closes if it succeeds and opens again if
+    it fails.
+
+    Args:
+        failures (int): Failures in a row that open the circuit.
+        reset_timeout (float): Seconds to wait before testing the provider.
+    """
+
+    def __init__(self, failures, reset_timeout):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self._count = 0
+        self._opened = None
+        self._testing = False
+        self._lock = threading.Lock()
+
+    def retry_after(self):
+        """Seconds until the provider is tested again, 0 if it's closed."""
+        with self._lock:
+            if self._opened is None:
+                return 0
+            return max(0, self._opened + self.reset_timeout - time.monotonic())
+
+    def allow(self):
+        """Check if a call can be made, and take the test call if it's due."""
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._testing or time.monotonic() - self._opened < self.reset_timeout:
+                return False
+            self._testing = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self._count = 0
+            self._opened = None
+            self._testing = False
+
+    def failure(self):
+        with self._lock:
+            self._count += 1
+            self._testing = False
+            if self._opened is not None or self._count >= self.failures:
+                self._opened = time.monotonic()
+
+
+def _new_session():
+    """Create a session with a pool of connections and retries."""
+    retry = Retry(total=settings.OAUTH_RETRIES,
+                  backoff_factor=settings.OAUTH_BACKOFF,
+                  status_forcelist=RETRY_STATUS,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_maxsize=settings.OAUTH_POOL_SIZE,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class ProviderClient(object):
+
+    """Client of an OAuth provider.
+
+    Args:
+        name (str): Name of the provider, for the logs and the errors.
+        urls (dict): URL of every endpoint of the provider, by name.
+        session (requests.Session): Session for the requests, by default a
+            new one with the pool and retries of the settings.
+    """
+
+    def __init__(self, name, urls, session=None):
+        self.name = name
+        self.urls = urls
+        self.session = session or _new_session()
+        self.timeout = (settings.OAUTH_CONNECT_TIMEOUT, settings.OAUTH_READ_TIMEOUT)
+        self.breaker = CircuitBreaker(settings.OAUTH_BREAKER_FAILURES,
+                                      settings.OAUTH_BREAKER_RESET)
+
+    def url(self, endpoint):
+        return self.urls[endpoint]
+
+    def _unavailable(self, error_msg):
+        logger.error("%s OAuth: %s", self.name, error_msg)
+        raise falcon.HTTPServiceUnavailable(
+            title="Service unavailable",
+            description="Can't log in with {0} right now".format(
+                self.name.capitalize()),
+            retry_after=int(self.breaker.retry_after()) or 30,
+            href=settings.__docs__)
+
+    def request(self, method, endpoint, url=None, **kwargs):
+        """Make a request to an endpoint of the provider.
+
+        Takes the same arguments as ``requests.request``.
+
+        Args:
+            endpoint (str): Name of the endpoint.
+            url (str): URL of the endpoint when it isn't in the settings, like
+                the ones of the discovery document.
+
+        Raises:
+            falcon.HTTPServiceUnavailable: If the provider is down or failed.
+            falcon.HTTPBadRequest: If the provider rejected the request.
+
+        Returns:
+            requests.Response: The answer of the provider.
+        """
+        if not self.breaker.allow():
+            self._unavailable("Circuit open, request not sent")
+
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            response = self.session.request(method, url or self.url(endpoint),
+                                            **kwargs)
+        except requests.RequestException as e:
+            self.breaker.failure()
+            self._unavailable("Request to {0} failed: {1}".format(endpoint, e))
+
+        if response.status_code >= 500:
+            self.breaker.failure()
+            self._unavailable("Request to {0} failed with status {1}".format(
+                endpoint, response.status_code))
+        self.breaker.success()
+
+        if response.status_code >= 400:
+            logger.debug("%s OAuth: Request to %s rejected with status %s",
+                         self.name, endpoint, response.status_code)
+            raise falcon.HTTPBadRequest(
+                title="Bad request",
+                description="{0} rejected the login".format(self.name.capitalize()),
+                href=settings.__docs__)
+        return response
+
+    def get(self, endpoint, **kwargs):
+        return self.request('GET', endpoint, **kwargs)
+
+    def post(self, endpoint, **kwargs):
+        return self.request('POST', endpoint, **kwargs)
+
+    def discover(self):
+        """Get the OpenID Connect discovery document of the provider.
+
+        The document lists the endpoints of the provider and rarely changes,
+        it's fetched once every OAUTH_DISCOVERY_TTL seconds.
+        """
+        url = self.url('discovery')
+        document = discovery_cache.get(url)
+        if document is None:
+            document = codec.loads(self.get('discovery').content)
+            discovery_cache.set(url, document)
+        return document
+
+
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+
+def get_client(name):
+    """Get the client of a provider for this process.
+
+    The clients are created again after a fork, the pooled connections
+    can't be shared between processes.
+    """
+    global _clients_pid
+    pid = os.getpid()
+    with _clients_lock:
+        if _clients_pid != pid:
+            _clients.clear()
+            _clients_pid = pid
+        client = _clients.get(name)
+        if client is None:
+            client = ProviderClient(name, settings.OAUTH_PROVIDERS[name])
+            _clients[name] = client
+        return client
@@ -1,14 +1,15 @@
-import json
 from urllib.parse import parse_qsl, urlencode
+import logging
 
 import falcon
-import requests
 from requests_oauthlib import OAuth1
 
-from sikre import settings
-from sikre.models.users import User
-from sikre.resources.auth import utils
-from sikre.utils.logs import logger
+from sikr import settings
+from sikr.resources.auth import utils
+from sikr.resources.auth.providers import get_client
+from sikr.utils import codec
+
+logger = logging.getLogger(__name__)
 
 
 class TwitterAuth(object):
@@ -17,9 +18,7 @@ class TwitterAuth(object):
 
         """Create Twitter JWT token
         """
-        request_token_url = 'https://api.twitter.com/oauth/request_token'
-        access_token_url = 'https://api.twitter.com/oauth/access_token'
-        authenticate_url = 'https://api.twitter.com/oauth/authenticate'
+        client = get_client('twitter')
 
         if req.get_param('oauth_token') and req.get_param('oauth_verifier'):
             auth = OAuth1(settings.TWITTER_KEY,
@@ -27,34 +26,32 @@ class TwitterAuth(object):
                           resource_owner_key=req.get_param('oauth_token'),
                           verifier=req.get_param('oauth_verifier'))
             logger.debug("Twitter OAuth: Got auth session.")
-            r = requests.post(access_token_url, auth=auth)
+            r = client.post('access_token', auth=auth)
             profile = dict(parse_qsl(r.text))
             logger.debug("Twitter OAuth: User profile retrieved")
 
-            try:
-                user = User.select().where(User.twitter == profile['user_id'] |
-                                           User.username == profile['screen_name']).get()
-            except:
-                user = User.create(twitter=profile['user_id'],
-                                   username=profile['screen_name'])
-                user.save()
+            # The answer carries the account, there's no profile to fetch
+            def get_profile():
+                return {'username': profile['screen_name'],
+                        'name': profile['screen_name'], 'email_verified': False}
+            user = utils.login_user(req, 'twitter', profile['user_id'], get_profile)
 
             token = utils.create_jwt_token(user)
-            res.body = json.dumps({"token": token})
+            res.body = codec.dumps({"token": token})
             res.status = falcon.HTTP_200
         else:
             oauth = OAuth1(settings.TWITTER_KEY,
                            client_secret=settings.TWITTER_SECRET,
                            callback_uri=settings.TWITTER_CALLBACK_URI)
             logger.debug("Twitter OAuth: Got auth session.")
-            r = requests.post(request_token_url, auth=oauth)
+            r = client.post('request_token', auth=oauth)
             oauth_token = dict(parse_qsl(r.text))
             logger.debug("Twitter OAuth: User profile retrieved")
             qs = urlencode(dict(oauth_token=oauth_token['oauth_token']))
 
             # Falcon doesn't support redirects, so we have to fake it
             # this implementation has been taken from werkzeug
-            final_url = authenticate_url + '?' + qs
+            final_url = client.url('authenticate') + '?' + qs
             res.body = (
                 '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">\n'
                 '<title>Redirecting...</title>\n'
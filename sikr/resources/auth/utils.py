@@ -1,8 +1,24 @@
 from datetime import datetime, timedelta
+import hashlib
+import logging
+import time
 
+import falcon
 import jwt
+from sqlalchemy.exc import IntegrityError
 
-from sikre import settings
+from sikr import settings
+from sikr.db.connector import Session, engine
+from sikr.models.shares import redeem_share_token
+from sikr.models.users import (User, UserIdentity, get_identity_user_id,
+                               get_user)
+from sikr.utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Claims of the tokens already verified, keyed by the token digest. Every
+# token is evicted when it expires.
+token_cache = LRUCache(settings.JWT_CACHE_SIZE)
 
 
 def create_jwt_token(user):
@@ -17,5 +33,192 @@ def create_jwt_token(user):
 
 
 def parse_token(req):
+    """Get the verified claims of the request token.
+
+    The token is decoded once per request and the claims are kept in
+    ``req.context['claims']``. The tokens seen by this process are only
+    verified the first time, until they expire.
+
+    Raises:
+        jwt.InvalidTokenError: If the token is malformed, expired or its
+            signature is not valid.
+    """
+    claims = req.context.get('claims')
+    if claims is not None:
+        return claims
+
     token = req.auth.split()[1]
-    return jwt.decode(token, settings.SECRET)
+    digest = hashlib.sha256(token.encode('utf-8')).digest()
+    claims = token_cache.get(digest)
+    if claims is None:
+        claims = jwt.decode(token, settings.SECRET)
+        token_cache.set(digest, claims, expires=claims['exp'])
+    req.context['claims'] = claims
+    return claims
+
+
+def validate_token(req):
+    """Get the claims of the request token, checking that it's still valid.
+
+    Besides the checks of ``parse_token``, the token must have been issued
+    by SITE_DOMAIN in the last SESSION_EXPIRES hours.
+
+    Raises:
+        jwt.InvalidTokenError: If the token is malformed, expired, its
+            signature is not valid or it was issued by another site.
+    """
+    try:
+        claims = parse_token(req)
+    except IndexError:
+        raise jwt.InvalidTokenError("The Authorization header has no token")
+    current_time = int(time.time())
+    issue_time = current_time - settings.SESSION_EXPIRES * 3600
+    if (claims.get('iss') != settings.SITE_DOMAIN or
+            claims.get('exp', 0) <= current_time or
+            claims.get('iat', 0) <= issue_time):
+        raise jwt.InvalidTokenError("The token is expired or not issued here")
+    return claims
+
+
+def _username(session, provider, external_id, profile, unique=False):
+    """Username of a new user.
+
+    The username of the account if it's free, else one made of the provider
+    and the account id, which no other user can take.
+
+    Args:
+        unique (bool): Skip the username of the account, it was taken by a
+            concurrent login.
+    """
+    username = profile.get('username')
+    if username and ':' not in username and not unique:
+        taken = session.query(User.id).filter(User.username == username).first()
+        if taken is None:
+            return username
+    return '{0}:{1}'.format(provider, external_id)
+
+
+def _link_identity(session, req, provider, external_id, profile, unique=False):
+    """Link an OAuth account to a user, creating the user if needed.
+
+    The account goes to the logged in user if the request has a token, else
+    to the user with the same email if the provider verified it, else to a
+    new user. Unverified emails are never stored, anyone can claim them.
+
+    Raises:
+        falcon.HTTPError: A 401 if the request has a token that is not
+            valid, the account isn't linked to anyone else instead.
+    """
+    user = None
+    if req.auth:
+        try:
+            claims = validate_token(req)
+        except jwt.InvalidTokenError:
+            logger.debug("%s OAuth: JWT token expired or malformed", provider)
+            raise falcon.HTTPError(falcon.HTTP_401, title="Credentials expired",
+                                   description="Your crendentials have expired. Please login again.")
+        user = session.query(User).get(claims['sub'])
+    email = profile.get('email') if profile.get('email_verified') else None
+    if user is None and email:
+        user = session.query(User).filter(User.email == email).first()
+    if user is None:
+        username = _username(session, provider, external_id, profile, unique)
+        user = User(active=True, username=username, name=profile.get('name'),
+                    email=email)
+        session.add(user)
+        logger.debug("%s OAuth: Created user %s", provider, username)
+    session.add(UserIdentity(active=True, provider=provider,
+                             external_id=str(external_id), user=user))
+    return user
+
+
+def accept_invitation(req, user):
+    """Accept the invitation of the ``share_token`` parameter, if any.
+
+    The token is redeemed in the primary database, even if the request is a
+    GET.
+
+    Returns:
+        bool: If the request had a valid token.
+    """
+    share_token = req.get_param('share_token')
+    if not share_token:
+        return False
+    write_session = Session(bind=engine)
+    try:
+        accepted = redeem_share_token(write_session, share_token,
+                                      write_session.query(User).get(user.id))
+        write_session.commit()
+    except Exception:
+        write_session.rollback()
+        raise
+    finally:
+        write_session.close()
+    logger.debug("Share token of user %s %s", user.id,
+                 "accepted" if accepted else "not valid")
+    return accepted
+
+
+def login_user(req, provider, external_id, get_profile):
+    """Get the user of an OAuth account.
+
+    A returning user is found by the provider and account id alone, with a
+    single indexed query, or none if it's cached. The first login links the
+    account to a user (see ``_link_identity``) in the primary database, even
+    if the request is a GET. If the login comes from an invitation, the
+    ``share_token`` parameter, it's accepted (see ``accept_invitation``).
+
+    Args:
+        provider (str): Name of the provider.
+        external_id: Id of the account in the provider.
+        get_profile (callable): Gets the profile of the account, as a dict with
+            the 'username' (a handle, if the provider has them), 'name',
+            'email' and 'email_verified' of the user. Only called on the
+            first login.
+
+    Raises:
+        falcon.HTTPConflict: If the account can't be linked.
+
+    Returns:
+        User: The user.
+    """
+    user = _get_or_link_user(req, provider, external_id, get_profile)
+    accept_invitation(req, user)
+    return user
+
+
+def _get_or_link_user(req, provider, external_id, get_profile):
+    """Get the user of an OAuth account, linking it on the first login."""
+    session = req.context['session']
+    user_id = get_identity_user_id(session, provider, external_id)
+    if user_id is not None:
+        user = get_user(session, user_id)
+        if user is not None:
+            return user
+
+    profile = get_profile()
+    write_session = Session(bind=engine)
+    try:
+        for unique in (False, True):
+            try:
+                user = _link_identity(write_session, req, provider,
+                                      external_id, profile, unique)
+                write_session.commit()
+                # Load the user before the session is closed
+                write_session.refresh(user)
+                return user
+            except IntegrityError:
+                write_session.rollback()
+            # The account may have been linked by a concurrent login, else
+            # its username was taken meanwhile
+            user_id = get_identity_user_id(write_session, provider, external_id)
+            user = write_session.query(User).get(user_id) if user_id else None
+            if user is not None:
+                return user
+        raise falcon.HTTPConflict(
+            title="Conflict",
+            description="The {0} account can't be linked".format(
+                provider.capitalize()),
+            href=settings.__docs__)
+    finally:
+        write_session.close()
@@ -10,16 +10,23 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import json
+import logging
 
 import falcon
 
 from sikr import settings
-from sikr.utils.logs import logger
-from sikr.models.users import User
-from sikr.models.items import Category
+from sikr.utils import codec
+from sikr.models.users import get_user
+from sikr.models.entries import Group
+from sikr.models.permissions import has_permission, visible_ids
 from sikr.resources.auth.decorators import login_required
 from sikr.resources.auth.utils import parse_token
+from sikr.utils.pagination import (NEXT_CURSOR_HEADER, get_page, get_fields,
+                                   paginate, split_page)
+
+logger = logging.getLogger(__name__)
+
+CATEGORY_FIELDS = ('id', 'name')
 
 
 class Categories(object):
@@ -32,19 +39,29 @@ class Categories(object):
     @falcon.before(login_required)
     def on_get(self, req, res):
         # Parse token and get user id
-        user_id = parse_token(req)['sub']
+        user_id = int(parse_token(req)['sub'])
+        limit, after = get_page(req)
+        fields = get_fields(req, CATEGORY_FIELDS)
+        session = req.context['session']
 
         try:
-            # Get the user
-            user = User.get(User.id == int(user_id))
-
-            groups = list(user.allowed_categories
-                              .select(Category.id, Category.name)
-                              .dicts())
+            columns = [getattr(Group, field) for field in fields
+                       if field != 'id']
+            groups_query = (session.query(Group.id, *columns)
+                                   .filter(Group.id.in_(visible_ids(user_id, Group))))
+            groups = [group._asdict() for group in
+                      paginate(groups_query, Group.id, limit, after)]
+            groups, next_cursor = split_page(groups, limit)
+            if "id" not in fields:
+                for group in groups:
+                    del group["id"]
+
+            if next_cursor is not None:
+                res.set_header(NEXT_CURSOR_HEADER, str(next_cursor))
             res.status = falcon.HTTP_200
-            res.body = json.dumps(groups)
+            res.body = codec.dumps(groups)
         except Exception as e:
-            print(e)
+            logger.error(e)
             error_msg = ("Unable to get the groups. Please try again later")
             raise falcon.HTTPServiceUnavailable(title="{0} failed".format(
                                                 req.method),
@@ -54,39 +71,29 @@ class Categories(object):
 
     @falcon.before(login_required)
     def on_post(self, req, res):
+        session = req.context['session']
         try:
             # Parse token and get user id
             user_id = parse_token(req)['sub']
             # Get the user
-            user = User.get(User.id == int(user_id))
+            user = get_user(session, int(user_id))
         except Exception as e:
             logger.error("Can't verify user")
             raise falcon.HTTPBadRequest(title="Bad request",
                                         description=e,
                                         href=settings.__docs__)
 
-        try:
-            raw_json = req.stream.read()
-            logger.debug("Got incoming JSON data")
-        except Exception as e:
-            logger.error("Can't read incoming data stream")
+        if 'doc' not in req.context:
             raise falcon.HTTPBadRequest(title="Bad request",
-                                        description=e,
+                                        description="A valid JSON document is required.",
                                         href=settings.__docs__)
+        result_json = req.context['doc']
 
         try:
-            result_json = json.loads(raw_json.decode("utf-8"),
-                                     encoding='utf-8')
-        except ValueError:
-            raise falcon.HTTPError(falcon.HTTP_400,
-                                   'Malformed JSON',
-                                   'Could not decode the request body. The '
-                                   'JSON was incorrect.')
-
-        try:
-            new_category = Category.create(name=result_json['name'] or '')
-            new_category.save()
-            new_category.allowed_users.add(user)
+            new_category = Group(name=result_json['name'] or '')
+            new_category.allowed_users.append(user)
+            session.add(new_category)
+            session.commit()
         except Exception as e:
             raise falcon.HTTPInternalServerError(title="Error while saving the group",
                                                  description=e,
@@ -120,19 +127,21 @@ class DetailCategory(object):
 
     @falcon.before(login_required)
     def on_get(self, req, res, id):
-        user_id = parse_token(req)['sub']
+        user_id = int(parse_token(req)['sub'])
+        session = req.context['session']
         try:
-            user = User.get(User.id == int(user_id))
-            group = Category.get(Category.id == int(id))
-            if user not in group.allowed_users:
+            group = session.query(Group).get(int(id))
+            if not has_permission(session, user_id, Group, int(id)):
                 raise falcon.HTTPForbidden(title="Permission denied",
                                            description="You don't have access to this resource",
                                            href=settings.__docs__)
             res.status = falcon.HTTP_200
-            res.body = json.dumps(group)
+            res.body = codec.dumps({"id": group.id, "name": group.name})
             logger.debug("Items request succesful")
+        except falcon.HTTPForbidden:
+            raise
         except Exception as e:
-            print(e)
+            logger.error(e)
             error_msg = ("Unable to get the group. Please try again later.")
             raise falcon.HTTPServiceUnavailable(req.method + " failed",
                                                 description=error_msg,
@@ -141,43 +150,34 @@ class DetailCategory(object):
 
     @falcon.before(login_required)
     def on_put(self, req, res, id):
+        session = req.context['session']
         try:
             # Parse token and get user id
-            user_id = parse_token(req)['sub']
-            # Get the user
-            user = User.get(User.id == int(user_id))
+            user_id = int(parse_token(req)['sub'])
         except Exception as e:
             logger.error("Can't verify user")
             raise falcon.HTTPBadRequest(title="Bad request",
                                         description=e,
                                         href=settings.__docs__)
-        try:
-            raw_json = req.stream.read()
-            logger.debug("Got incoming JSON data")
-        except Exception as e:
-            logger.error("Can't read incoming data stream")
+        if 'doc' not in req.context:
             raise falcon.HTTPBadRequest(title="Bad request",
-                                        description=e,
+                                        description="A valid JSON document is required.",
                                         href=settings.__docs__)
+        result_json = req.context['doc']
         try:
-            result_json = json.loads(raw_json.decode("utf-8"), encoding='utf-8')
-        except ValueError:
-            raise falcon.HTTPError(falcon.HTTP_400,
-                                   'Malformed JSON',
-                                   'Could not decode the request body. The '
-                                   'JSON was incorrect.')
-        try:
-            category = Category.get(Category.id == int(id))
-            if user not in category.allowed_users:
+            category = session.query(Group).get(int(id))
+            if not has_permission(session, user_id, Group, int(id)):
                 raise falcon.HTTPForbidden(title="Permission denied",
                                            description="You don't have access to this resource",
                                            href=settings.__docs__)
             category.name = result_json["name"]
-            category.save()
+            session.commit()
             res.status = falcon.HTTP_200
-            res.body = json.dumps({"message": "Category updated"})
+            res.body = codec.dumps({"message": "Category updated"})
+        except falcon.HTTPForbidden:
+            raise
         except Exception as e:
-            print(e)
+            logger.error(e)
             error_msg = ("Unable to get the category. Please try again later.")
             raise falcon.HTTPServiceUnavailable(req.method + " failed",
                                                 description=error_msg,
@@ -186,25 +186,30 @@ class DetailCategory(object):
 
     @falcon.before(login_required)
     def on_delete(self, req, res, id):
+        session = req.context['session']
         try:
             # Parse token and get user id
-            user_id = parse_token(req)['sub']
-            # Get the user
-            user = User.get(User.id == int(user_id))
+            user_id = int(parse_token(req)['sub'])
         except Exception as e:
             logger.error("Can't verify user")
             raise falcon.HTTPBadRequest(title="Bad request",
                                         description=e,
                                         href=settings.__docs__)
         try:
-            category = Category.get(Category.id == int(id))
-            category.delete_instance(recursive=True)
+            category = session.query(Group).get(int(id))
+            if not has_permission(session, user_id, Group, int(id)):
+                raise falcon.HTTPForbidden(title="Permission denied",
+                                           description="You don't have access to this resource",
+                                           href=settings.__docs__)
+            session.delete(category)
+            session.commit()
 
             res.status = falcon.HTTP_200
-            res.body = json.dumps({"status": "Deletion successful"})
-
+            res.body = codec.dumps({"status": "Deletion successful"})
+        except falcon.HTTPForbidden:
+            raise
         except Exception as e:
-            print(e)
+            logger.error(e)
             error_msg = ("Unable to delete category. Please try again later.")
             raise falcon.HTTPServiceUnavailable(title="{0} failed".format(req.method),
                                                 description=error_msg,
@@ -0,0 +1,102 @@
+import logging
+
+import falcon
+
+from sikr import settings
+from sikr.models.entries import Group, Entry, Service
+from sikr.models.permissions import visible_ids
+from sikr.resources.auth.decorators import login_required
+from sikr.resources.auth.utils import parse_token
+from sikr.utils.streaming import NDJSONStream
+
+logger = logging.getLogger(__name__)
+
+# Exported objects: type of the line, model and exported columns by name
+EXPORTED = (
+    ("category", Group,
+     (('id', Group.id), ('name', Group.name))),
+    ("item", Entry,
+     (('id', Entry.id), ('name', Entry.name), ('description', Entry.description),
+      ('tags', Entry.tags), ('category', Entry.group_id))),
+    ("service", Service,
+     (('id', Service.id), ('name', Service.name),
+      ('username', Service.username), ('password', Service.password),
+      ('url', Service.url), ('port', Service.port), ('extra', Service.extra),
+      ('ssh_title', Service.ssh_title), ('ssh_public', Service.ssh_public),
+      ('ssh_private', Service.ssh_private), ('ssl_title', Service.ssl_title),
+      ('ssl_filename', Service.ssl_filename), ('other', Service.other),
+      ('item', Service.entry_id))),
+)
+
+
+def _export_rows(session, user_id):
+    """Yield every object the user has access to, one type after the other.
+
+    Each type is read from a server side cursor, STREAM_CHUNK_SIZE rows at a
+    time, so the memory used doesn't depend on the size of the vault.
+    """
+    for object_type, model, columns in EXPORTED:
+        names = [name for name, _ in columns]
+        rows = (session.query(*[field for _, field in columns])
+                       .filter(model.id.in_(visible_ids(user_id, model)))
+                       .order_by(model.id)
+                       .yield_per(settings.STREAM_CHUNK_SIZE))
+        for row in rows:
+            line = dict(zip(names, row))
+            line["type"] = object_type
+            yield line
+
+
+class Export(object):
+
+    """Export everything the user has access to as newline delimited JSON.
+
+    Every line is a category, item or service, with a ``type`` attribute to
+    tell them apart. The categories come first, then the items and then the
+    services. With ``gzip=true`` the export is compressed while it's sent.
+    """
+    # The body is NDJSON, not JSON
+    raw_content = True
+
+    @falcon.before(login_required)
+    def on_get(self, req, res):
+        user_id = int(parse_token(req)['sub'])
+        compress = req.get_param_as_bool("gzip")
+        filename = "sikr-export.ndjson"
+
+        res.status = falcon.HTTP_200
+        if compress:
+            res.content_type = 'application/gzip'
+            filename += ".gz"
+        else:
+            res.content_type = 'application/x-ndjson'
+        res.set_header('Content-Disposition',
+                       'attachment; filename="{0}"'.format(filename))
+        # The session middleware releases the session with the stream
+        req.context['stream'] = NDJSONStream(
+            _export_rows(req.context['session'], user_id), compress=compress)
+        logger.debug("Exporting the vault of user %s", user_id)
+
+    def on_options(self, req, res):
+
+        """Acknowledge the OPTIONS method.
+        """
+        res.status = falcon.HTTP_200
+
+    def on_post(self, req, res):
+        raise falcon.HTTPError(falcon.HTTP_405,
+                               title="Client error",
+                               description="{0} method not allowed.".format(req.method),
+                               href=settings.__docs__)
+
+    def on_put(self, req, res):
+        raise falcon.HTTPError(falcon.HTTP_405,
+                               title="Client error",
+                               description="{0} method not allowed.".format(req.method),
+                               href=settings.__docs__)
+
+    def on_delete(self, req, res):
+        raise falcon.HTTPError(falcon.HTTP_405,
+                               title="Client error",
+                               description="{0} method not allowed.".format(req.method),
+                               href=settings.__docs__)
@@ -0,0 +1,156 @@
+import logging
+import os
+import tempfile
+import unicodedata
+from urllib.parse import quote
+
+import falcon
+
+from sikr import settings
+from sikr.db.types import keyring
+from sikr.utils import codec
+from sikr.utils.cryptofunctions import StreamCipher
+from sikr.models.entries import Service
+from sikr.models.permissions import has_permission
+from sikr.resources.auth.decorators import login_required
+from sikr.resources.auth.utils import parse_token
+
+logger = logging.getLogger(__name__)
+
+# Unicode categories removed from the file names: control, format, private
+# use and unassigned characters, and line and paragraph separators
+UNSAFE_CATEGORIES = ('Cc', 'Cf', 'Cs', 'Co', 'Cn', 'Zl', 'Zp')
+
+
+def _file_path(service_id):
+    """Path where the encrypted file of a service is stored."""
+    return os.path.join(settings.UPLOAD_DIR, str(service_id))
+
+
+def _clean_filename(filename):
+    """Name of an uploaded file without its path, quotes or control characters."""
+    filename = filename.replace('\\', '/').rsplit('/', 1)[-1]
+    return ''.join(char for char in filename if char != '"' and
+                   unicodedata.category(char) not in UNSAFE_CATEGORIES)
+
+
+def _content_disposition(filename):
+    """Content-Disposition of a download, with the name encoded (RFC 5987).
+
+    Old clients only read ``filename``, an ASCII version of the name.
+    """
+    filename = _clean_filename(filename)
+    fallback = filename.encode('ascii', 'replace').decode('ascii')
+    return "attachment; filename=\"{0}\"; filename*=UTF-8''{1}".format(
+        fallback, quote(filename, safe=''))
+
+
+def _decrypted(path):
+    """Yield the decrypted content of a stored file."""
+    with open(path, 'rb') as src:
+        yield from StreamCipher(keyring).decrypt_stream(src)
+
+
+class ServiceFile(object):
+
+    """Upload and download the file (certificate, key...) of a service.
+
+    The file is encrypted while it's read from the request and decrypted
+    while it's sent back, a chunk at a time, so the memory used doesn't
+    depend on the size of the file.
+    """
+    # The body is the file itself, not JSON
+    raw_content = True
+
+    def _get_service(self, req, id):
+        """Get the service, checking that the user has access to it."""
+        session = req.context['session']
+        user_id = int(parse_token(req)['sub'])
+        if not has_permission(session, user_id, Service, int(id)):
+            raise falcon.HTTPForbidden(title="Permission denied",
+                                       description="You don't have access to this resource",
+                                       href=settings.__docs__)
+        service = session.query(Service).get(int(id))
+        if service is None:
+            raise falcon.HTTPNotFound(title="Not found",
+                                      description="The service doesn't exist",
+                                      href=settings.__docs__)
+        return service
+
+    @falcon.before(login_required)
+    def on_get(self, req, res, id):
+        service = self._get_service(req, id)
+        path = _file_path(service.id)
+        if not os.path.exists(path):
+            raise falcon.HTTPNotFound(title="Not found",
+                                      description="This service has no file",
+                                      href=settings.__docs__)
+        res.status = falcon.HTTP_200
+        res.content_type = 'application/octet-stream'
+        filename = service.ssl_filename or str(service.id)
+        res.set_header('Content-Disposition', _content_disposition(filename))
+        res.stream = _decrypted(path)
+
+    @falcon.before(login_required)
+    def on_put(self, req, res, id):
+        filename = _clean_filename(req.get_param('filename', required=True))
+        extension = os.path.splitext(filename)[1][1:].lower()
+        if extension not in settings.ALLOWED_EXTENSIONS:
+            raise falcon.HTTPBadRequest(title="Bad request",
+                                        description="File type not allowed",
+                                        href=settings.__docs__)
+        if req.content_length is None:
+            raise falcon.HTTPLengthRequired(title="Length required",
+                                            description="The file size is required")
+        if req.content_length > settings.MAX_UPLOAD_SIZE:
+            raise falcon.HTTPRequestEntityTooLarge(title="File too large",
+                                                   description="The file is too large")
+
+        service = self._get_service(req, id)
+        path = _file_path(service.id)
+        tmp_path = None
+        try:
+            os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=settings.UPLOAD_DIR, suffix='.tmp',
+                                             delete=False) as dst:
+                tmp_path = dst.name
+                StreamCipher(keyring).encrypt_stream(req.bounded_stream, dst)
+            # The file only replaces the old one once its name is saved
+            service.ssl_filename = filename
+            req.context['session'].commit()
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(e)
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            error_msg = ("Unable to save the file. Please try again later.")
+            raise falcon.HTTPServiceUnavailable(title="{0} failed".format(req.method),
+                                                description=error_msg,
+                                                retry_after=30,
+                                                href=settings.__docs__)
+        res.status = falcon.HTTP_200
+        res.body = codec.dumps({"message": "File uploaded"})
+
+    @falcon.before(login_required)
+    def on_delete(self, req, res, id):
+        service = self._get_service(req, id)
+        path = _file_path(service.id)
+        # The file is only removed once the service no longer refers to it
+        service.ssl_filename = ''
+        req.context['session'].commit()
+        if os.path.exists(path):
+            os.remove(path)
+        res.status = falcon.HTTP_200
+        res.body = codec.dumps({"message": "Deletion successful"})
+
+    def on_options(self, req, res, id):
+
+        """Acknowledge the OPTIONS method.
+        """
+        res.status = falcon.HTTP_200
+
+    def on_post(self, req, res, id):
+        raise falcon.HTTPError(falcon.HTTP_405,
+                               title="Client error",
+                               description="{0} method not allowed.".format(req.method),
+                               href=settings.__docs__)
@@ -0,0 +1,298 @@
+import csv
+import logging
+import time
+
+import falcon
+from sqlalchemy import select
+
+from sikr import settings
+from sikr.utils import codec
+from sikr.utils.readers import (LimitedStream, StreamTooLarge, read_csv,
+                                read_ndjson, read_json_array)
+from sikr.models.entries import (Group, Entry, Service, group_user_table,
+                                 entry_user_table, service_user_table)
+from sikr.models.permissions import add_direct_permissions, visible_ids
+from sikr.resources.auth.decorators import login_required
+from sikr.resources.auth.utils import parse_token
+
+logger = logging.getLogger(__name__)
+
+READERS = {
+    'csv': read_csv,
+    'ndjson': read_ndjson,
+    'json': read_json_array,
+}
+CONTENT_TYPES = {
+    'text/csv': 'csv',
+    'application/x-ndjson': 'ndjson',
+    'application/json': 'json',
+}
+# Fields of every imported record. Each record is a service, created in the
+# item (entry) and category (group) it names.
+IMPORT_FIELDS = ('category', 'item', 'description', 'tags', 'service',
+                 'username', 'password', 'url', 'port', 'extra', 'ssh_title',
+                 'ssh_public', 'ssh_private', 'ssl_title', 'other')
+SERVICE_FIELDS = ('username', 'password', 'url', 'extra', 'ssh_title',
+                  'ssh_public', 'ssh_private', 'ssl_title', 'other')
+# Invalid records listed in the response, the rest are only counted
+MAX_REPORTED_ERRORS = 100
+# Most parameters of a multi-row INSERT, the limit of the older SQLite versions
+MAX_INSERT_PARAMS = 999
+
+
+def _validate(record):
+    """Check an imported record and return it with all the fields set.
+
+    Raises:
+        ValueError: If the record is not valid.
+    """
+    if not isinstance(record, dict):
+        raise ValueError("The record must be an object")
+    unknown = [str(field) for field in record if field not in IMPORT_FIELDS]
+    if unknown:
+        raise ValueError("Unknown fields: {0}".format(", ".join(unknown)))
+    if not record.get('item') or not isinstance(record['item'], str):
+        raise ValueError("The 'item' field is required")
+
+    clean = {}
+    for field in IMPORT_FIELDS:
+        value = record.get(field)
+        if field == 'port':
+            try:
+                clean[field] = int(value or 0)
+            except (TypeError, ValueError):
+                raise ValueError("The 'port' field must be a number")
+        elif value is None:
+            clean[field] = ''
+        elif not isinstance(value, str):
+            raise ValueError("The '{0}' field must be a string".format(field))
+        else:
+            clean[field] = value
+    return clean
+
+
+def _insert(session, table, rows):
+    """Insert a batch of rows and return their ids, in the same order.
+
+    PostgreSQL inserts the whole batch in one statement and returns the ids
+    with it. The other databases insert it with multi-row INSERTs of up to
+    MAX_INSERT_PARAMS parameters, see ``_insert_many``.
+    """
+    if not rows:
+        return []
+    if session.bind.dialect.name == 'postgresql':
+        result = session.execute(table.insert().values(rows).returning(table.c.id))
+        return [row[0] for row in result]
+    size = max(1, MAX_INSERT_PARAMS // len(rows[0]))
+    ids = []
+    for start in range(0, len(rows), size):
+        ids.extend(_insert_many(session, table, rows[start:start + size]))
+    return ids
+
+
+def _insert_many(session, table, rows):
+    """Insert rows with a multi-row INSERT and get their ids.
+
+    The rows of one statement get consecutive ids, in SQLite and in MySQL
+    (they are "simple inserts" for InnoDB). The cursor only has one of them,
+    the last one in SQLite and the first one in MySQL, the rest are read back
+    with a single query on the range.
+
+    Raises:
+        RuntimeError: If the ids of the rows are not consecutive.
+    """
+    result = session.execute(table.insert().values(rows))
+    first = result.lastrowid
+    if session.bind.dialect.name != 'mysql':
+        first -= len(rows) - 1
+    last = first + len(rows) - 1
+    ids = [row[0] for row in session.execute(
+        select([table.c.id]).where(table.c.id.between(first, last))
+                            .order_by(table.c.id))]
+    if len(ids) != len(rows):
+        raise RuntimeError("The ids of the imported rows are not consecutive")
+    return ids
+
+
+def _import_chunk(session, user_id, records, groups, entries):
+    """Write a chunk of records with bulk inserts.
+
+    Args:
+        groups (dict): Ids of the categories by name, updated with the new
+            ones.
+        entries (dict): Ids of the items by category id and name, updated
+            with the new ones.
+
+    Returns:
+        dict: Number of categories, items and services created.
+    """
+    new_groups = [name for name in dict.fromkeys(record['category'] for record in records)
+                  if name and name not in groups]
+    group_ids = _insert(session, Group.__table__,
+                        [{'name': name} for name in new_groups])
+    groups.update(zip(new_groups, group_ids))
+
+    new_entries = {}
+    for record in records:
+        key = (groups.get(record['category']), record['item'])
+        if key not in entries and key not in new_entries:
+            new_entries[key] = {'name': record['item'],
+                                'description': record['description'],
+                                'tags': record['tags'],
+                                'group_id': key[0]}
+    entry_ids = _insert(session, Entry.__table__, list(new_entries.values()))
+    entries.update(zip(new_entries, entry_ids))
+
+    services = [dict({field: record[field] for field in SERVICE_FIELDS},
+                     name=record['service'] or record['item'],
+                     port=record['port'],
+                     entry_id=entries[(groups.get(record['category']), record['item'])])
+                for record in records]
+    service_ids = _insert(session, Service.__table__, services)
+
+    for model, table, column, ids in (
+            (Group, group_user_table, 'sikr_group', group_ids),
+            (Entry, entry_user_table, 'sikr_entry', entry_ids),
+            (Service, service_user_table, 'sikr_service', service_ids)):
+        if ids:
+            session.execute(table.insert(),
+                            [{column: id, 'sikr_user': user_id} for id in ids])
+            add_direct_permissions(session.connection(), model, user_id, ids)
+
+    return {"categories": len(group_ids), "items": len(entry_ids),
+            "services": len(service_ids)}
+
+
+class Import(object):
+
+    """Import categories, items and services from a file.
+
+    The file is read while it's uploaded, as a JSON array, newline delimited
+    JSON or CSV with a header row, and every record creates a service in the
+    item and category it names. Categories are matched by name, and items by
+    category and name, with the ones the user can access, the rest are
+    created.
+
+    The records are written in chunks of IMPORT_CHUNK_SIZE, each one with a
+    handful of bulk inserts and committed on its own, and the response lists
+    the progress of every chunk. Invalid records are skipped and reported.
+    """
+    # The body is the file itself, not JSON
+    raw_content = True
+
+    def _get_format(self, req):
+        """Get the format of the file, from the parameters or Content-Type."""
+        file_format = req.get_param('format')
+        if file_format is None:
+            content_type = (req.content_type or '').split(';')[0].strip()
+            file_format = CONTENT_TYPES.get(content_type)
+        if file_format not in READERS:
+            raise falcon.HTTPUnsupportedMediaType(
+                "Send the file as JSON, NDJSON or CSV",
+                href=settings.__docs__)
+        return file_format
+
+    @falcon.before(login_required)
+    def on_post(self, req, res):
+        user_id = int(parse_token(req)['sub'])
+        file_format = self._get_format(req)
+        if req.content_length and req.content_length > settings.MAX_IMPORT_SIZE:
+            raise falcon.HTTPRequestEntityTooLarge(title="File too large",
+                                                   description="The file is too large")
+        session = req.context['session']
+
+        groups = dict(session.query(Group.name, Group.id)
+                             .filter(Group.id.in_(visible_ids(user_id, Group)))
+                             .order_by(Group.id))
+        entries = {(group_id, name): id for group_id, name, id in
+                   session.query(Entry.group_id, Entry.name, Entry.id)
+                          .filter(Entry.id.in_(visible_ids(user_id, Entry)))
+                          .order_by(Entry.id)}
+        chunks = []
+        errors = []
+        invalid = 0
+        chunk = []
+        number = 0
+
+        def write(chunk):
+            start = time.time()
+            created = _import_chunk(session, user_id, chunk, groups, entries)
+            session.commit()
+            created.update(chunk=len(chunks) + 1, records=len(chunk),
+                           last_record=number,
+                           seconds=round(time.time() - start, 3))
+            chunks.append(created)
+            logger.info("Import of user %s: chunk %s, %s records written",
+                        user_id, created["chunk"], created["records"])
+
+        # The size is also checked while reading, the client may not send it
+        stream = LimitedStream(req.bounded_stream, settings.MAX_IMPORT_SIZE)
+        try:
+            for number, record in enumerate(READERS[file_format](stream), 1):
+                try:
+                    chunk.append(_validate(record))
+                except ValueError as e:
+                    invalid += 1
+                    if len(errors) < MAX_REPORTED_ERRORS:
+                        errors.append({"record": number, "error": str(e)})
+                    continue
+                if len(chunk) == settings.IMPORT_CHUNK_SIZE:
+                    write(chunk)
+                    chunk = []
+            if chunk:
+                write(chunk)
+        except StreamTooLarge:
+            session.rollback()
+            raise falcon.HTTPRequestEntityTooLarge(
+                title="File too large",
+                description="The file is too large. {0} chunks were "
+                            "imported.".format(len(chunks)))
+        except (ValueError, csv.Error) as e:
+            session.rollback()
+            raise falcon.HTTPBadRequest(
+                title="Malformed file",
+                description="Error after record {0}: {1}. {2} chunks were "
+                            "imported.".format(number, e, len(chunks)),
+                href=settings.__docs__)
+        except Exception as e:
+            logger.error(e)
+            session.rollback()
+            error_msg = ("Unable to import the file, {0} chunks were imported. "
+                         "Please try again later.".format(len(chunks)))
+            raise falcon.HTTPServiceUnavailable(title=req.method + " failed",
+                                                description=error_msg,
+                                                retry_after=30,
+                                                href=settings.__docs__)
+
+        res.status = falcon.HTTP_201
+        res.body = codec.dumps({
+            "records": number,
+            "imported": number - invalid,
+            "invalid": invalid,
+            "errors": errors,
+            "chunks": chunks,
+        })
+
+    def on_options(self, req, res):
+
+        """Acknowledge the OPTIONS method.
+        """
+        res.status = falcon.HTTP_200
+
+    def on_get(self, req, res):
+        raise falcon.HTTPError(falcon.HTTP_405,
+                               title="Client error",
+                               description="{0} method not allowed.".format(req.method),
+                               href=settings.__docs__)
+
+    def on_put(self, req, res):
+        raise falcon.HTTPError(falcon.HTTP_405,
+                               title="Client error",
+                               description="{0} method not allowed.".format(req.method),
+                               href=settings.__docs__)
+
+    def on_delete(self, req, res):
+        raise falcon.HTTPError(falcon.HTTP_405,
+                               title="Client error",
+                               description="{0} method not allowed.".format(req.method),
+                               href=settings.__docs__)
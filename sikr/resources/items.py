@@ -1,14 +1,65 @@
-import json
+from collections import defaultdict
+import logging
 
 import falcon
 
 from sikr import settings
-from sikr.utils.logs import logger
-from sikr.models.users import User
-from sikr.models.items import Category, Item
-from sikr.models.services import Service
+from sikr.utils import codec
+from sikr.models.users import get_user
+from sikr.models.entries import Group, Entry, Service
+from sikr.models.permissions import has_permission, visible_ids
 from sikr.resources.auth.decorators import login_required
 from sikr.resources.auth.utils import parse_token
+from sikr.utils.pagination import (NEXT_CURSOR_HEADER, get_page, get_fields,
+                                   paginate, split_page)
+from sikr.utils.streaming import JSONStream
+
+logger = logging.getLogger(__name__)
+
+ITEM_FIELDS = ('id', 'name', 'description', 'services')
+
+
+def _prepare_items(session, user_id, items, fields):
+    """Attach the services to a batch of items and drop unrequested fields.
+
+    The services the user can see for the whole batch are fetched in one
+    ``IN (...)`` query and grouped in memory, so the number of queries
+    doesn't grow with the number of items.
+    """
+    if "services" in fields:
+        services_by_item = defaultdict(list)
+        if items:
+            services = (session.query(Service.id, Service.name,
+                                      Service.entry_id)
+                               .filter(Service.id.in_(visible_ids(user_id, Service)))
+                               .filter(Service.entry_id.in_([item["id"] for item in items]))
+                               .order_by(Service.id))
+            for service in services:
+                services_by_item[service.entry_id].append(
+                    {"id": service.id, "name": service.name})
+        for item in items:
+            item["services"] = services_by_item[item["id"]]
+    if "id" not in fields:
+        for item in items:
+            del item["id"]
+    return items
+
+
+def _stream_items(session, user_id, items_query, fields, after):
+    """Yield every item of the query, reading them in chunks.
+
+    The items are read by keyset chunks instead of a single server side
+    cursor because the services of each chunk have to be queried on the
+    same connection while the items are being read.
+    """
+    chunk_size = settings.STREAM_CHUNK_SIZE
+    while True:
+        items = [item._asdict() for item in
+                 paginate(items_query, Entry.id, chunk_size, after)]
+        items, after = split_page(items, chunk_size)
+        yield from _prepare_items(session, user_id, items, fields)
+        if after is None:
+            return
 
 
 class Items(object):
@@ -17,55 +68,62 @@ class Items(object):
     def on_get(self, req, res):
         """Get the items that belong to that user.
 
-        This method contains two behaviours, one returns
-        Handle the GET request, returning a list of the items that the user
-        has access to.
+        Handle the GET request, returning a page of the items that the user
+        has access to, optionally filtered by category. The page size and
+        position are set with the ``limit`` and ``after`` parameters and the
+        returned fields with ``fields``. With ``stream=true`` all the items
+        after the cursor are sent, encoded as they are read.
 
-        First we create an empty dictionary and query the database to get
-        all the item objects. After that, we iterate over the objects to
-        populate the dictionary. In the end we return a 200 code to the browser
-        and return the results dictionary wrapped in a list like the REsT
-        standard says.
+        The items are fetched in a single query filtered by the user
+        permissions, then the services the user can see for all of those
+        items are fetched in one batched query.
         """
         payload = {}
         # Parse token and get user id
-        user_id = parse_token(req)['sub']
+        user_id = int(parse_token(req)['sub'])
+        stream = req.get_param_as_bool("stream")
+        limit, after = get_page(req)
+        fields = get_fields(req, ITEM_FIELDS)
+        session = req.context['session']
 
         try:
-            # Get the user
-            user = User.get(User.id == int(user_id))
+            columns = [getattr(Entry, field) for field in fields
+                       if field not in ('id', 'services')]
+            items_query = (session.query(Entry.id, *columns)
+                                  .filter(Entry.id.in_(visible_ids(user_id, Entry))))
             # See if we have to filter by category
             filter_category = req.get_param("category", required=False)
             if filter_category:
                 # Get the category
-                category = (Category.select(Category.name, Category.id)
-                                  .where(Category.id == int(filter_category))
-                                  .get())
+                category = (session.query(Group.id, Group.name)
+                                   .filter(Group.id == int(filter_category))
+                                   .one())
                 payload["category_name"] = str(category.name)
                 payload["category_id"] = int(category.id)
-                items = list(user.allowed_items
-                                 .select(Item.name, Item.description, Item.id)
-                                 .where(Item.category == int(filter_category))
-                                 .dicts())
+                items_query = items_query.filter(Entry.group_id == category.id)
                 logger.debug("Got items filtered by category and user")
             else:
                 payload["category_name"] = "All"
-                items = list(user.allowed_items
-                             .select(Item.name, Item.description, Item.id)
-                             .dicts())
                 logger.debug("Got all items")
-            for item in items:
-                services = list(user.allowed_services
-                                    .select(Service.id, Service.name)
-                                    .where(Service.item == item["id"])
-                                    .dicts())
-                item["services"] = services
-            payload["items"] = items
+
             res.status = falcon.HTTP_200
-            res.body = json.dumps(payload)
+            if stream:
+                # The session middleware releases the session with the stream
+                req.context['stream'] = JSONStream(
+                    _stream_items(session, user_id, items_query, fields, after),
+                    envelope=payload, key="items")
+                logger.debug("Streaming items")
+                return
+
+            items = [item._asdict() for item in
+                     paginate(items_query, Entry.id, limit, after)]
+            items, next_cursor = split_page(items, limit)
+            payload["items"] = _prepare_items(session, user_id, items, fields)
+            if next_cursor is not None:
+                res.set_header(NEXT_CURSOR_HEADER, str(next_cursor))
+            res.body = codec.dumps(payload)
             logger.debug("Items request succesful")
         except Exception as e:
-            print(e)
             logger.error(e)
             error_msg = ("Unable to get the items. Please try again later")
             raise falcon.HTTPServiceUnavailable(title=req.method + " failed",
@@ -78,11 +136,12 @@ class Items(object):
 
         """Save a new item
         """
+        session = req.context['session']
         try:
             # Parse token and get user id
             user_id = parse_token(req)['sub']
             # Get the user
-            user = User.get(User.id == int(user_id))
+            user = get_user(session, int(user_id))
             logger.debug("Got user data")
         except Exception as e:
             logger.error("Can't verify user")
@@ -90,31 +149,20 @@ class Items(object):
                                         description=e,
                                         href=settings.__docs__)
 
-        try:
-            raw_json = req.stream.read()
-            logger.debug("Got incoming JSON data")
-        except Exception as e:
-            logger.error("Can't read incoming data stream")
+        if 'doc' not in req.context:
             raise falcon.HTTPBadRequest(title="Bad request",
-                                        description=e,
+                                        description="A valid JSON document is required.",
                                         href=settings.__docs__)
+        result_json = req.context['doc']
 
         try:
-            result_json = json.loads(raw_json.decode("utf-8"), encoding='utf-8')
-            logger.debug("Parsed JSON data")
-        except ValueError:
-            raise falcon.HTTPError(falcon.HTTP_400,
-                                   'Malformed JSON',
-                                   'Could not decode the request body. The '
-                                   'JSON was incorrect.')
-
-        try:
-            new_item = Item.create(name=result_json.get('name'),
-                                   description=result_json.get("description", ''),
-                                   category=result_json.get("category"),
-                                   tags=result_json.get("tags", ''))
-            new_item.save()
-            new_item.allowed_users.add(user)
+            new_item = Entry(name=result_json.get('name'),
+                             description=result_json.get("description", ''),
+                             group_id=result_json.get("category"),
+                             tags=result_json.get("tags", ''))
+            new_item.allowed_users.append(user)
+            session.add(new_item)
+            session.commit()
             logger.debug("Saved new item into the database")
         except Exception as e:
             raise falcon.HTTPInternalServerError(title="Error while saving the item",
@@ -152,19 +200,25 @@ class DetailItem(object):
     """
     @falcon.before(login_required)
     def on_get(self, req, res, id):
-        user_id = parse_token(req)['sub']
+        user_id = int(parse_token(req)['sub'])
+        session = req.context['session']
         try:
-            user = User.get(User.id == int(user_id))
-            item = Item.get(Item.id == int(id))
-            if user not in item.allowed_users:
+            item = session.query(Entry).get(int(id))
+            if not has_permission(session, user_id, Entry, int(id)):
                 raise falcon.HTTPForbidden(title="Permission denied",
                                            description="You don't have access to this resource",
                                            href=settings.__docs__)
             res.status = falcon.HTTP_200
-            res.body = json.dumps(item)
+            res.body = codec.dumps({"id": item.id,
+                                    "name": item.name,
+                                    "description": item.description,
+                                    "category": item.group_id,
+                                    "tags": item.tags})
             logger.debug("Items request succesful")
+        except falcon.HTTPForbidden:
+            raise
         except Exception as e:
-            print(e)
+            logger.error(e)
             error_msg = ("Unable to get the item. Please try again later.")
             raise falcon.HTTPServiceUnavailable(req.method + " failed",
                                                 description=error_msg,
@@ -173,46 +227,37 @@ class DetailItem(object):
 
     @falcon.before(login_required)
     def on_put(self, req, res, id):
+        session = req.context['session']
         try:
             # Parse token and get user id
-            user_id = parse_token(req)['sub']
-            # Get the user
-            user = User.get(User.id == int(user_id))
+            user_id = int(parse_token(req)['sub'])
         except Exception as e:
             logger.error("Can't verify user")
             raise falcon.HTTPBadRequest(title="Bad request",
                                         description=e,
                                         href=settings.__docs__)
-        try:
-            raw_json = req.stream.read()
-            logger.debug("Got incoming JSON data")
-        except Exception as e:
-            logger.error("Can't read incoming data stream")
+        if 'doc' not in req.context:
             raise falcon.HTTPBadRequest(title="Bad request",
-                                        description=e,
+                                        description="A valid JSON document is required.",
                                         href=settings.__docs__)
+        result_json = req.context['doc']
         try:
-            result_json = json.loads(raw_json.decode("utf-8"), encoding='utf-8')
-        except ValueError:
-            raise falcon.HTTPError(falcon.HTTP_400,
-                                   'Malformed JSON',
-                                   'Could not decode the request body. The '
-                                   'JSON was incorrect.')
-        try:
-            item = Item.get(Item.id == int(id))
-            if user not in item.allowed_users:
+            item = session.query(Entry).get(int(id))
+            if not has_permission(session, user_id, Entry, int(id)):
                 raise falcon.HTTPForbidden(title="Permission denied",
                                            description="You don't have access to this resource",
                                            href=settings.__docs__)
             item.name = result_json.get("name", item.name)
             item.description = result_json.get("description", item.description)
-            item.category = result_json.get("category", item.category)
+            item.group_id = result_json.get("category", item.group_id)
             item.tags = result_json.get("tags", item.tags)
-            item.save()
+            session.commit()
             res.status = falcon.HTTP_200
-            res.body = json.dumps({"message": "Item updated"})
+            res.body = codec.dumps({"message": "Item updated"})
+        except falcon.HTTPForbidden:
+            raise
         except Exception as e:
-            print(e)
+            logger.error(e)
             error_msg = ("Unable to get the item. Please try again later.")
             raise falcon.HTTPServiceUnavailable(req.method + " failed",
                                                 description=error_msg,
@@ -221,28 +266,29 @@ class DetailItem(object):
 
     @falcon.before(login_required)
     def on_delete(self, req, res, id):
+        session = req.context['session']
         try:
             # Parse token and get user id
-            user_id = parse_token(req)['sub']
-            # Get the user
-            user = User.get(User.id == int(user_id))
+            user_id = int(parse_token(req)['sub'])
         except Exception as e:
             logger.error("Can't verify user")
             raise falcon.HTTPBadRequest(title="Bad request",
                                         description=e,
                                         href=settings.__docs__)
         try:
-            item = Item.get(Item.id == int(id))
-            if user not in item.allowed_users:
+            item = session.query(Entry).get(int(id))
+            if not has_permission(session, user_id, Entry, int(id)):
                 raise falcon.HTTPForbidden(title="Permission denied",
                                            description="You don't have access to this resource",
                                            href=settings.__docs__)
-            item.delete_instance()
+            session.delete(item)
+            session.commit()
             res.status = falcon.HTTP_200
-            res.body = json.dumps({"message": "Deletion successful"})
-
+            res.body = codec.dumps({"message": "Deletion successful"})
+        except falcon.HTTPForbidden:
+            raise
         except Exception as e:
-            print(e)
+            logger.error(e)
             error_msg = ("Unable to delete category. Please try again later.")
             raise falcon.HTTPServiceUnavailable(title="{0} failed".format(req.method),
                                                 description=error_msg,
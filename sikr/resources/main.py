@@ -1,9 +1,9 @@
 from datetime import datetime, timezone
-import json
 
 import falcon
 
 from sikr import settings
+from sikr.utils import codec
 
 
 class APIInfo(object):
@@ -22,7 +22,7 @@ class APIInfo(object):
             "date": str(datetime.utcnow().replace(tzinfo=timezone.utc)),
         }
         res.status = falcon.HTTP_200
-        res.body = json.dumps(payload)
+        res.body = codec.dumps(payload)
 
     def on_options(self, req, res):
         res.status = falcon.HTTP_200
@@ -0,0 +1,41 @@
+import falcon
+
+from sikr import settings
+from sikr.utils import metrics
+
+
+class Metrics(object):
+
+    """Show the metrics of all the worker processes, for Prometheus.
+
+    The endpoint is only added with METRICS_ACTIVE. It doesn't require a
+    login, so restrict the access to it in the web server.
+    """
+    # The body is in the Prometheus text format, not JSON
+    raw_content = True
+
+    def on_get(self, req, res):
+        res.status = falcon.HTTP_200
+        res.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        res.body = metrics.render(metrics.collect())
+
+    def on_options(self, req, res):
+        res.status = falcon.HTTP_200
+
+    def on_post(self, req, res):
+        raise falcon.HTTPError(falcon.HTTP_405,
+                               title="Client error",
+                               description="{0} method not allowed.".format(req.method),
+                               href=settings.__docs__)
+
+    def on_put(self, req, res):
+        raise falcon.HTTPError(falcon.HTTP_405,
+                               title="Client error",
+                               description="{0} method not allowed.".format(req.method),
+                               href=settings.__docs__)
+
+    def on_delete(self, req, res):
+        raise falcon.HTTPError(falcon.HTTP_405,
+                               title="Client error",
+                               description="{0} method not allowed.".format(req.method),
+                               href=settings.__docs__)
@@ -1,52 +1,89 @@
-import json
+
+import logging
 
 import falcon
 
 from sikr import settings
-from sikr.utils.logs import logger
-from sikr.models.users import User
-from sikr.models.services import Service
+from sikr.utils import codec
+from sikr.models.users import get_user
+from sikr.models.entries import Service
+from sikr.models.permissions import has_permission, visible_ids
 from sikr.resources.auth.decorators import login_required
 from sikr.resources.auth.utils import parse_token
+from sikr.utils.pagination import (NEXT_CURSOR_HEADER, get_page, get_fields,
+                                   paginate, split_page)
+from sikr.utils.streaming import JSONStream
+
+logger = logging.getLogger(__name__)
+
+SERVICE_FIELDS = ('id', 'name', 'username', 'password', 'url', 'port',
+                  'extra', 'ssh_title', 'ssh_public', 'ssh_private',
+                  'ssl_title', 'ssl_filename', 'other')
+
+
+def _service_row(service, fields):
+    """Turn a service row into a dictionary with the requested fields."""
+    row = service._asdict()
+    if "id" not in fields:
+        del row["id"]
+    return row
 
 
 class Services(object):
 
     @falcon.before(login_required)
     def on_get(self, req, res):
-        """
+        """Get a page of the services that the user has access to.
+
+        The services can be filtered by item, the page size and position are
+        set with the ``limit`` and ``after`` parameters and the returned
+        fields with ``fields``. With ``stream=true`` all the services after
+        the cursor are sent, read from a server side cursor and encoded as
+        they arrive.
         """
         # Parse token and get user id
-        user_id = parse_token(req)['sub']
+        user_id = int(parse_token(req)['sub'])
         # See if we have to filter by item
         filter_item = req.get_param("item", required=False)
+        stream = req.get_param_as_bool("stream")
+        limit, after = get_page(req)
+        fields = get_fields(req, SERVICE_FIELDS)
+        session = req.context['session']
 
         try:
-            # Get the user
-            user = User.get(User.id == int(user_id))
+            columns = [getattr(Service, field) for field in fields
+                       if field != 'id']
+            services_query = (session.query(Service.id, *columns)
+                                     .filter(Service.id.in_(visible_ids(user_id, Service))))
             if filter_item:
-                services = list(user.allowed_services
-                                    .select(Service.id, Service.name,
-                                            Service.username, Service.password,
-                                            Service.url, Service.port, Service.extra,
-                                            Service.ssh_title, Service.ssh_public,
-                                            Service.ssh_private, Service.ssl_title,
-                                            Service.ssl_filename, Service.other)
-                                    .where(Service.item == int(filter_item))
-                                    .dicts())
+                services_query = services_query.filter(
+                    Service.entry_id == int(filter_item))
                 logger.debug("Got services filtered by item")
             else:
-                services = list(user.allowed_services
-                                    .select(Service.id, Service.name,
-                                            Service.username, Service.password,
-                                            Service.url, Service.port, Service.extra,
-                                            Service.ssh_title, Service.ssh_public,
-                                            Service.ssh_private, Service.ssl_title,
-                                            Service.ssl_filename, Service.other)
-                                    .dicts())
                 logger.debug("Got all the items")
+
             res.status = falcon.HTTP_200
-            res.body = json.dumps(services)
+            if stream:
+                if after is not None:
+                    services_query = services_query.filter(Service.id > after)
+                services_query = (services_query.order_by(Service.id)
+                                                .yield_per(settings.STREAM_CHUNK_SIZE))
+                # The session middleware releases the session with the stream
+                req.context['stream'] = JSONStream(
+                    (_service_row(service, fields) for service in services_query))
+                logger.debug("Streaming services")
+                return
+
+            services = [service._asdict() for service in
+                        paginate(services_query, Service.id, limit, after)]
+            services, next_cursor = split_page(services, limit)
+            if "id" not in fields:
+                for service in services:
+                    del service["id"]
+
+            if next_cursor is not None:
+                res.set_header(NEXT_CURSOR_HEADER, str(next_cursor))
+            res.body = codec.dumps(services)
         except Exception as e:
             logger.error(e)
             error_msg = ("Unable to get the services. Please try again later")
@@ -57,51 +94,41 @@ class Services(object):
 
     @falcon.before(login_required)
     def on_post(self, req, res):
+        session = req.context['session']
         try:
             # Parse token and get user id
             user_id = parse_token(req)['sub']
             # Get the user
-            user = User.get(User.id == int(user_id))
+            user = get_user(session, int(user_id))
         except Exception as e:
             logger.error("Can't verify user")
             raise falcon.HTTPBadRequest(title="Bad request",
                                         description=e,
                                         href=settings.__docs__)
 
-        try:
-            raw_json = req.stream.read()
-            logger.debug("Got incoming JSON data")
-        except Exception as e:
-            logger.error("Can't read incoming data stream")
+        if 'doc' not in req.context:
             raise falcon.HTTPBadRequest(title="Bad request",
-                                        description=e,
+                                        description="A valid JSON document is required.",
                                         href=settings.__docs__)
+        result_json = req.context['doc']
 
         try:
-            result_json = json.loads(raw_json.decode("utf-8"), encoding='utf-8')
-            logger.debug(result_json)
-        except ValueError:
-            raise falcon.HTTPError(falcon.HTTP_400,
-                                   'Malformed JSON',
-                                   'Could not decode the request body. The '
-                                   'JSON was incorrect.')
-
-        try:
-            new_service = Service.create(name=result_json.get("name"),
-                                         item=result_json.get("item"),
-                                         username=result_json.get("username", ''),
-                                         password=result_json.get("password", ''),
-                                         url=result_json.get("url", ''),
-                                         port=result_json.get("port", 0),
-                                         extra=result_json.get("extra", ''),
-                                         ssh_title=result_json.get("ssh_title", ''),
-                                         ssh_public=result_json.get("ssh_public", ''),
-                                         ssh_private=result_json.get("ssh_private", ''),
-                                         ssl_title=result_json.get("ssl_title", ''),
-                                         ssl_filename=result_json.get("ssh_title", ''),
-                                         other=result_json.get("other", ''))
-            new_service.save()
-            new_service.allowed_users.add(user)
+            new_service = Service(name=result_json.get("name"),
+                                  entry_id=result_json.get("item"),
+                                  username=result_json.get("username", ''),
+                                  password=result_json.get("password", ''),
+                                  url=result_json.get("url", ''),
+                                  port=result_json.get("port", 0),
+                                  extra=result_json.get("extra", ''),
+                                  ssh_title=result_json.get("ssh_title", ''),
+                                  ssh_public=result_json.get("ssh_public", ''),
+                                  ssh_private=result_json.get("ssh_private", ''),
+                                  ssl_title=result_json.get("ssl_title", ''),
+                                  ssl_filename=result_json.get("ssl_filename", ''),
+                                  other=result_json.get("other", ''))
+            new_service.allowed_users.append(user)
+            session.add(new_service)
+            session.commit()
         except Exception as e:
             raise falcon.HTTPInternalServerError(title="Error while saving the item",
                                                  description=e,
@@ -139,35 +166,29 @@ class DetailService(object):
     """
     @falcon.before(login_required)
     def on_get(self, req, res, id):
+        session = req.context['session']
         try:
             # Parse token and get user id
-            user_id = parse_token(req)['sub']
-            # Get the user
-            user = User.get(User.id == int(user_id))
+            user_id = int(parse_token(req)['sub'])
         except Exception as e:
             logger.error("Can't verify user")
             raise falcon.HTTPBadRequest(title="Bad request",
                                         description=e,
                                         href=settings.__docs__)
         try:
-            service_obj = Service.get(Service.id == id)
-            service = list(service_obj.select(Service.id, Service.name,
-                                              Service.username, Service.password,
-                                              Service.url, Service.port, Service.extra,
-                                              Service.ssh_title, Service.ssh_public,
-                                              Service.ssh_private, Service.ssl_title,
-                                              Service.ssl_filename, Service.other)
-                                      .where(Service.id == id)
-                                      .dicts())
-            if user not in service_obj.allowed_users:
+            service = session.query(Service).get(int(id))
+            if not has_permission(session, user_id, Service, int(id)):
                 raise falcon.HTTPForbidden(title="Permission denied",
                                            description="You don't have access to this resource",
                                            href=settings.__docs__)
 
             res.status = falcon.HTTP_200
-            res.body = json.dumps(service)
+            res.body = codec.dumps({field: getattr(service, field)
+                                    for field in SERVICE_FIELDS})
+        except falcon.HTTPForbidden:
+            raise
         except Exception as e:
-            print(e)
+            logger.error(e)
             error_msg = ("Unable to get the items. Please try again later")
             raise falcon.HTTPServiceUnavailable(title="{0} failed".format(req.method),
                                                 description=error_msg,
@@ -183,28 +204,29 @@ class DetailService(object):
 
     @falcon.before(login_required)
     def on_delete(self, req, res, id):
+        session = req.context['session']
         try:
             # Parse token and get user id
-            user_id = parse_token(req)['sub']
-            # Get the user
-            user = User.get(User.id == int(user_id))
+            user_id = int(parse_token(req)['sub'])
         except Exception as e:
             logger.error("Can't verify user")
             raise falcon.HTTPBadRequest(title="Bad request",
                                         description=e,
                                         href=settings.__docs__)
         try:
-            service = Service.get(Service.id == id)
-            if user not in service.allowed_users:
+            service = session.query(Service).get(int(id))
+            if not has_permission(session, user_id, Service, int(id)):
                 raise falcon.HTTPForbidden(title="Permission denied",
                                            description="You don't have access to this resource",
                                            href=settings.__docs__)
-            service.delete_instance()
+            session.delete(service)
+            session.commit()
             res.status = falcon.HTTP_200
-            res.body = json.dumps({"message": "Deletion successful"})
-
+            res.body = codec.dumps({"message": "Deletion successful"})
+        except falcon.HTTPForbidden:
+            raise
         except Exception as e:
-            print(e)
+            logger.error(e)
             error_msg = ("Unable to delete service. Please try again later.")
             raise falcon.HTTPServiceUnavailable(title="{0} failed".format(req.method),
                                                 description=error_msg,
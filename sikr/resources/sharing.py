@@ -1,15 +1,31 @@
-import json
+import logging
 
 import falcon
 
 from sikr import settings
-from sikr.utils.logs import logger
-from sikr.models.users import User
-from sikr.models.services import Service
-from sikr.models.shares import ShareToken
+from sikr.utils import codec
+from sikr.utils.email import send_emails
+from sikr.models.entries import Group, Entry, Service
+from sikr.models.permissions import (count_permitted, grant_access,
+                                     has_permission, revoke_access)
+from sikr.models.shares import issue_share_tokens, redeem_share_token
+from sikr.models.users import get_user
 from sikr.resources.auth.decorators import login_required
 from sikr.resources.auth.utils import parse_token
-from sikr.utils.tokens import generate_token
+
+logger = logging.getLogger(__name__)
+
+# Shared model of every object type of the API
+SHARE_TYPES = {
+    'category': Group,
+    'item': Entry,
+    'service': Service,
+}
+# Changes of access of the bulk sharing
+BULK_ACTIONS = ('grant', 'revoke')
+INVITATION_SUBJECT = "Invitation"
+INVITATION_CONTENT = ("You have been invited to access a {0} in Sikr. Log in "
+                      "at {1}?share_token={2} to accept it.")
 
 
 class Share(object):
@@ -18,40 +34,70 @@ class Share(object):
     """
     @falcon.before(login_required)
     def on_post(self, req, res):
-        try:
-            # Parse token and get user id
-            user_id = parse_token(req)['sub']
-            # Get the user
-            user = User.get(User.id == int(user_id))
-        except Exception as e:
-            logger.error("Can't verify user")
+        """Invite people by email to access a category, item or service.
+
+        The document has the ``type`` of the object (category, item or
+        service), its ``id`` and the ``emails`` of the recipients. Every
+        recipient gets an email with a token to accept the invitation when
+        they log in. The tokens are created and the emails queued in a few
+        statements, whatever the number of recipients.
+        """
+        user_id = int(parse_token(req)['sub'])
+        session = req.context['session']
+
+        if 'doc' not in req.context:
             raise falcon.HTTPBadRequest(title="Bad request",
-                                        description=e,
+                                        description="A valid JSON document is required.",
                                         href=settings.__docs__)
+        result_json = req.context['doc']
 
+        object_type = result_json.get('type')
+        emails = result_json.get('emails')
         try:
-            raw_json = req.stream.read()
-            logger.debug("Got incoming JSON data")
-        except Exception as e:
-            logger.error("Can't read incoming data stream")
+            model = SHARE_TYPES[object_type]
+            object_id = int(result_json.get('id'))
+        except (KeyError, TypeError, ValueError):
+            raise falcon.HTTPBadRequest(title="Bad request",
+                                        description="A valid type and id are required.",
+                                        href=settings.__docs__)
+        if (not isinstance(emails, list) or not emails or
+                not all(isinstance(email, str) and '@' in email for email in emails)):
             raise falcon.HTTPBadRequest(title="Bad request",
-                                        description=e,
+                                        description="A list of emails is required.",
                                         href=settings.__docs__)
+        if len(emails) > settings.MAX_SHARE_RECIPIENTS:
+            raise falcon.HTTPBadRequest(
+                title="Bad request",
+                description="Up to {0} emails are allowed.".format(
+                    settings.MAX_SHARE_RECIPIENTS),
+                href=settings.__docs__)
 
-        try:
-            result_json = json.loads(raw_json.decode("utf-8"), encoding='utf-8')
-            logger.debug(result_json)
-        except ValueError:
-            raise falcon.HTTPError(falcon.HTTP_400,
-                                   'Malformed JSON',
-                                   'Could not decode the request body. The '
-                                   'JSON was incorrect.')
+        if not has_permission(session, user_id, model, object_id):
+            raise falcon.HTTPForbidden(title="Permission denied",
+                                       description="You don't have access to this resource",
+                                       href=settings.__docs__)
 
         try:
-            new_share = ShareToken(user=user, token=generate_token(),
-                                   resource=int(result_json.get()))
-        except:
-            pass
+            tokens = issue_share_tokens(session, user_id, model, object_id,
+                                        emails)
+            send_emails([{'subject': INVITATION_SUBJECT, 'to_address': [email],
+                          'content': INVITATION_CONTENT.format(
+                              object_type, settings.LOGIN_URL, token)}
+                         for email, token in tokens.items()],
+                        session=session)
+            logger.debug("Shared %s %s with %s recipients", object_type,
+                         object_id, len(tokens))
+        except Exception as e:
+            error_msg = ("Unable to share the {0}. Please try again later".format(
+                object_type))
+            logger.error("%s: %s", error_msg, e)
+            raise falcon.HTTPServiceUnavailable(title="{0} failed".format(req.method),
+                                                description=error_msg,
+                                                retry_after=30,
+                                                href=settings.__docs__)
+
+        res.status = falcon.HTTP_201
+        res.body = codec.dumps({"invited": len(tokens)})
 
     def on_options(self, req, res):
 
@@ -82,3 +128,178 @@ class Share(object):
                                title="Client error",
                                description="{0} method not allowed.".format(req.method),
                                href=settings.__docs__)
+
+
+class AcceptShare(object):
+
+    """Accept an invitation with the account the user is logged in with
+    """
+    @falcon.before(login_required)
+    def on_post(self, req, res):
+        """Accept the invitation of a share token.
+
+        The document has the ``token`` of the invitation email. The user
+        gets access to the shared object and the token can't be used again.
+        Invitations can also be accepted when logging in, with the
+        ``share_token`` parameter.
+        """
+        user_id = int(parse_token(req)['sub'])
+        session = req.context['session']
+
+        if 'doc' not in req.context:
+            raise falcon.HTTPBadRequest(title="Bad request",
+                                        description="A valid JSON document is required.",
+                                        href=settings.__docs__)
+        token = req.context['doc'].get('token')
+        if not isinstance(token, str) or not token:
+            raise falcon.HTTPBadRequest(title="Bad request",
+                                        description="A token is required.",
+                                        href=settings.__docs__)
+
+        user = get_user(session, user_id)
+        if user is None or not redeem_share_token(session, token, user):
+            raise falcon.HTTPNotFound(title="Not found",
+                                      description="The invitation doesn't exist, was used or expired",
+                                      href=settings.__docs__)
+        logger.debug("User %s accepted a share token", user_id)
+        res.status = falcon.HTTP_200
+        res.body = codec.dumps({"message": "Invitation accepted"})
+
+    def on_options(self, req, res):
+
+        """Acknowledge the OPTIONS method.
+        """
+        res.status = falcon.HTTP_200
+
+    def on_get(self, req, res):
+        raise falcon.HTTPError(falcon.HTTP_405,
+                               title="Client error",
+                               description="{0} method not allowed.".format(req.method),
+                               href=settings.__docs__)
+
+    def on_put(self, req, res):
+        raise falcon.HTTPError(falcon.HTTP_405,
+                               title="Client error",
+                               description="{0} method not allowed.".format(req.method),
+                               href=settings.__docs__)
+
+    def on_delete(self, req, res):
+        raise falcon.HTTPError(falcon.HTTP_405,
+                               title="Client error",
+                               description="{0} method not allowed.".format(req.method),
+                               href=settings.__docs__)
+
+
+def _get_ids(doc, key):
+    """Read a list of ids from the document, it may be missing."""
+    ids = doc.get(key, [])
+    if (not isinstance(ids, list) or
+            not all(isinstance(id, int) and not isinstance(id, bool) for id in ids)):
+        raise falcon.HTTPBadRequest(title="Bad request",
+                                    description="'{0}' must be a list of ids.".format(key),
+                                    href=settings.__docs__)
+    if len(ids) > settings.MAX_BULK_SHARE:
+        raise falcon.HTTPBadRequest(
+            title="Bad request",
+            description="Up to {0} '{1}' are allowed.".format(
+                settings.MAX_BULK_SHARE, key),
+            href=settings.__docs__)
+    return sorted(set(ids))
+
+
+class BulkShare(object):
+
+    """Grant or revoke the access to many objects for many users at once
+    """
+    @falcon.before(login_required)
+    def on_post(self, req, res):
+        """Grant or revoke the access to objects for users and user groups.
+
+        The document has the ``action`` (grant or revoke), the ``type`` of
+        the objects (category, item or service), their ``ids`` and the
+        ``users`` and ``usergroups`` to give the access to or to take it
+        from, as lists of ids. The user must have access to all the objects.
+        All the changes are made in a single transaction, with one statement
+        per share table. The ids of users and groups that don't exist are
+        skipped.
+
+        A user can only revoke the shares they granted (with this endpoint or
+        an invitation) and their own access, the rest are skipped and left
+        out of the ``changed`` counts.
+        """
+        user_id = int(parse_token(req)['sub'])
+        session = req.context['session']
+
+        if 'doc' not in req.context:
+            raise falcon.HTTPBadRequest(title="Bad request",
+                                        description="A valid JSON document is required.",
+                                        href=settings.__docs__)
+        result_json = req.context['doc']
+
+        action = result_json.get('action')
+        object_type = result_json.get('type')
+        if action not in BULK_ACTIONS or object_type not in SHARE_TYPES:
+            raise falcon.HTTPBadRequest(title="Bad request",
+                                        description="A valid action and type are required.",
+                                        href=settings.__docs__)
+        model = SHARE_TYPES[object_type]
+        object_ids = _get_ids(result_json, 'ids')
+        user_ids = _get_ids(result_json, 'users')
+        usergroup_ids = _get_ids(result_json, 'usergroups')
+        if not object_ids or not (user_ids or usergroup_ids):
+            raise falcon.HTTPBadRequest(title="Bad request",
+                                        description="Some ids and some users or user groups are required.",
+                                        href=settings.__docs__)
+
+        if count_permitted(session, user_id, model, object_ids) != len(object_ids):
+            raise falcon.HTTPForbidden(title="Permission denied",
+                                       description="You don't have access to all the resources",
+                                       href=settings.__docs__)
+
+        try:
+            if action == 'grant':
+                changed = grant_access(session.connection(), model, object_ids,
+                                       user_ids, usergroup_ids,
+                                       granted_by=user_id)
+            else:
+                changed = revoke_access(session.connection(), model, object_ids,
+                                        user_ids, usergroup_ids,
+                                        revoked_by=user_id)
+            logger.debug("Bulk %s of %s %ss to %s users and %s user groups",
+                         action, len(object_ids), object_type, len(user_ids),
+                         len(usergroup_ids))
+        except Exception as e:
+            error_msg = ("Unable to {0} the access. Please try again later".format(
+                action))
+            logger.error("%s: %s", error_msg, e)
+            raise falcon.HTTPServiceUnavailable(title="{0} failed".format(req.method),
+                                                description=error_msg,
+                                                retry_after=30,
+                                                href=settings.__docs__)
+
+        res.status = falcon.HTTP_200
+        res.body = codec.dumps({"action": action, "changed": changed})
+
+    def on_options(self, req, res):
+
+        """Acknowledge the OPTIONS method.
+        """
+        res.status = falcon.HTTP_200
+
+    def on_get(self, req, res):
+        raise falcon.HTTPError(falcon.HTTP_405,
+                               title="Client error",
+                               description="{0} method not allowed.".format(req.method),
+                               href=settings.__docs__)
+
+    def on_put(self, req, res):
+        raise falcon.HTTPError(falcon.HTTP_405,
+                               title="Client error",
+                               description="{0} method not allowed.".format(req.method),
+                               href=settings.__docs__)
+
+    def on_delete(self, req, res):
+        raise falcon.HTTPError(falcon.HTTP_405,
+                               title="Client error",
+                               description="{0} method not allowed.".format(req.method),
+                               href=settings.__docs__)
@@ -13,6 +13,19 @@ DATABASE = {
     'PORT': '',                # Not needed for SQLite. PostgreSQL default: 5432
     'USER': 'postgres',                # Not needed for SQLite. User that has access to the DB
     'PASSWORD': '4J2bPbMT5jLe5Re9',            # Not needed for SQLite. Password for the user
+    # Connection pool, per process. Not used with SQLite.
+    'POOL_SIZE': 5,            # Connections kept open
+    'MAX_OVERFLOW': 10,        # Extra connections allowed under load
+    'POOL_TIMEOUT': 30,        # Seconds to wait for a free connection
+    'POOL_RECYCLE': 1800,      # Seconds before a connection is replaced
+    'POOL_PRE_PING': True,     # Check connections before using them (failovers)
+    'STATEMENT_TIMEOUT': 0,    # PostgreSQL only, in milliseconds. 0 disables it
+    # Set to True when running behind PgBouncer. The pool is disabled and
+    # STATEMENT_TIMEOUT ignored, set it on the database role instead.
+    'PGBOUNCER': False,
+    # Read replicas for GET and OPTIONS requests, every replica only needs the
+    # keys that differ from the primary. Example: [{'HOST': '172.17.0.3'}]
+    'REPLICAS': [],
 }
 
 # Restrict the extensions allowed for the uploaded files, we do other checks
@@ -21,14 +34,38 @@ ALLOWED_EXTENSIONS = [
     'cer', 'crt', 'pfx', 'key', 'pem', 'arm', 'crt', 'pub'
 ]
 
+# Uploaded files are stored encrypted in this folder. Maximum size of a file,
+# in bytes. Default: 10MB
+UPLOAD_DIR = os.path.join(BASE_DIR, 'files')
+MAX_UPLOAD_SIZE = 10485760
+
+# Imports. Records written and committed per chunk and maximum size of an
+# imported file, in bytes. Default: 100MB
+IMPORT_CHUNK_SIZE = 1000
+MAX_IMPORT_SIZE = 104857600
+
 # Select the default version of the API, this will load specific parts of your
 # logic in the app.
 DEFAULT_API = 'v1'
 
+# Default and maximum number of rows returned per page by the listings. The
+# client can move to the next page sending the `after` parameter with the
+# value of the X-Next-Cursor header.
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Listings requested with `stream=true` skip the pagination and send every
+# row, reading and encoding them in chunks of this size.
+STREAM_CHUNK_SIZE = 1000
+
 # Site domain, you usually want this to be your frontend url. This is used for
 # login verification between other things like CORS
 CORS_ACTIVE = True
 SITE_DOMAIN = 'https://sikr.io'
+# Origins allowed to make CORS requests, leave it empty to allow any origin
+CORS_ALLOWED_ORIGINS = []
+# Seconds the browsers can cache a preflight response. Default: 86400 (1 day)
+CORS_MAX_AGE = 86400
 LOGIN_URL = 'http://sikr.io/login.html'
 
 # This rewrites the response "Server" header, so you can hide your server name
@@ -38,6 +75,22 @@ SERVER_NAME = "sikr.io"
 # How long the user session will last (in hours). Default: 168 (7 days)
 SESSION_EXPIRES = 168
 
+# Number of verified session tokens kept in memory by each process, so their
+# signature isn't checked again on every request. 0 disables the cache.
+JWT_CACHE_SIZE = 4096
+
+# Number of users kept in memory by each process and for how long (in
+# seconds). Changes made by other processes may take this long to be seen. A
+# size of 0 disables the cache.
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 60
+
+# Number of OAuth accounts (provider and account id) kept in memory by each
+# process with the id of their user, and for how long (in seconds), so the
+# login of a returning user doesn't query the database.
+IDENTITY_CACHE_SIZE = 10000
+IDENTITY_CACHE_TTL = 300
+
 # Service tokens, this are usually the "client secret" or private API keys
 # that you need to finish the OAuth validation. Remember NOT to commit back
 # this values! They should remain known to you only!
@@ -49,11 +102,79 @@ TWITTER_KEY = ''
 TWITTER_SECRET = ''  # Twitter consumer secret
 TWITTER_CALLBACK_URI = ''
 
+# OAuth providers. The URLs of every provider can be changed, for example to
+# test the login against a local server. Each provider keeps a pool of up to
+# OAUTH_POOL_SIZE connections per process. A request waits OAUTH_CONNECT_TIMEOUT
+# seconds to connect and OAUTH_READ_TIMEOUT seconds for every read, and is
+# retried OAUTH_RETRIES times waiting OAUTH_BACKOFF seconds, doubled every time.
+# POST requests are only retried if the connection failed. After
+# OAUTH_BREAKER_FAILURES failures in a row the provider is taken as down and
+# its logins fail right away for OAUTH_BREAKER_RESET seconds. The endpoints of
+# the OpenID Connect providers are read from their 'discovery' document, kept
+# for OAUTH_DISCOVERY_TTL seconds.
+OAUTH_PROVIDERS = {
+    'github': {
+        'access_token': 'https://github.com/login/oauth/access_token',
+        'user': 'https://api.github.com/user',
+    },
+    'google': {
+        'discovery': 'https://accounts.google.com/.well-known/openid-configuration',
+    },
+    'facebook': {
+        'access_token': 'https://graph.facebook.com/oauth/access_token',
+        'user': 'https://graph.facebook.com/me',
+    },
+    'twitter': {
+        'request_token': 'https://api.twitter.com/oauth/request_token',
+        'access_token': 'https://api.twitter.com/oauth/access_token',
+        'authenticate': 'https://api.twitter.com/oauth/authenticate',
+    },
+    'linkedin': {
+        'access_token': 'https://www.linkedin.com/uas/oauth2/accessToken',
+        'user': 'https://api.linkedin.com/v1/people/~:(id,first-name,last-name,email-address)',
+    },
+}
+OAUTH_POOL_SIZE = 10
+OAUTH_CONNECT_TIMEOUT = 3.05
+OAUTH_READ_TIMEOUT = 10
+OAUTH_RETRIES = 2
+OAUTH_BACKOFF = 0.2
+OAUTH_BREAKER_FAILURES = 5
+OAUTH_BREAKER_RESET = 30
+OAUTH_DISCOVERY_TTL = 86400
+
+# Sharing by email. Hours until an invitation expires, and recipients allowed
+# in a single invitation. MAX_BULK_SHARE limits the objects, users and user
+# groups of a bulk grant or revoke.
+SHARE_TOKEN_EXPIRES = 72
+MAX_SHARE_RECIPIENTS = 1000
+MAX_BULK_SHARE = 1000
+
 # Main server token Make it unique and keep it away from strangers! This token
 # is used in authentication and part of the storage encryption. This token
 # is an example. **You MUST replace it!**
 SECRET = '-&3whmt0f&h#zvyc@yk4bs3g6biu9l&a%0l=5u*q2+rz(sypdk'
 
+# Keys that encrypt the stored secrets, by id. New values are encrypted with
+# ENCRYPTION_KEY_ID, the other keys are only used to read the values that
+# haven't been rotated yet. Values stored before the key ids existed are read
+# with SECRET. To rotate: add a new key, make it the current one, run
+# `python app.py --rotate-keys` and remove the old key once it finishes. The
+# uploaded files record the id of their key too, and are rotated by the job.
+ENCRYPTION_KEYS = {
+    '1': SECRET,
+}
+ENCRYPTION_KEY_ID = '1'
+
+# Key rotation job. Rows re-encrypted per transaction, threads that encrypt
+# the values of each transaction, seconds to wait between transactions (and
+# files) to leave room to the API, and file where the progress is saved so an
+# interrupted job continues where it stopped.
+ROTATION_BATCH_SIZE = 500
+ROTATION_WORKERS = 4
+ROTATION_PAUSE = 0.1
+ROTATION_CHECKPOINT = os.path.join(BASE_DIR, 'rotation.json')
+
 # Email SMTP settings.
 DEFAULT_EMAIL_FROM = 'noreply@sikr.io'
 SMTP_SERVER = ''
@@ -62,9 +183,49 @@ SMTP_USER = ''
 SMTP_PASSWORD = ''
 SMTP_TLS = True
 
+# Email outbox. The emails are stored in the database and sent from background
+# threads, EMAIL_CONNECTIONS threads with a connection to the SMTP server each,
+# in batches of EMAIL_BATCH_SIZE. A connection is closed after EMAIL_SMTP_IDLE
+# seconds without sending. An email that fails is retried after
+# EMAIL_RETRY_BACKOFF seconds, doubled every time, up to EMAIL_MAX_ATTEMPTS
+# attempts. The outbox is checked every EMAIL_POLL_INTERVAL seconds, or right
+# away when this process queues an email. A dispatcher claims the emails of a
+# batch for EMAIL_CLAIM_TIMEOUT seconds, if it dies they are sent by another
+# one after that time. With EMAIL_DISPATCHER_ACTIVE every worker process sends
+# emails, else run `python app.py --send-emails`.
+EMAIL_DISPATCHER_ACTIVE = False
+EMAIL_CONNECTIONS = 1
+EMAIL_BATCH_SIZE = 50
+EMAIL_SMTP_TIMEOUT = 30
+EMAIL_SMTP_IDLE = 60
+EMAIL_RETRY_BACKOFF = 30
+EMAIL_MAX_ATTEMPTS = 8
+EMAIL_POLL_INTERVAL = 30
+EMAIL_CLAIM_TIMEOUT = 600
+
+# Request timing. With TIMING_ACTIVE every response gets a Server-Timing header
+# with the time spent in the middleware, the resource, the JSON encoding and
+# the database, and the same is logged. Requests with more SQL statements than
+# TIMING_QUERY_THRESHOLD are logged as possible N+1 queries.
+TIMING_ACTIVE = False
+TIMING_QUERY_THRESHOLD = 20
+
+# Metrics. With METRICS_ACTIVE the requests, the database pool and the caches
+# are measured and exposed in /v1/metrics in the Prometheus text format. Every
+# worker process writes its values to its own file in METRICS_DIR and the
+# endpoint adds them up. Empty the folder when the application is restarted.
+# METRICS_BUCKETS are the bounds, in seconds, of the request time histograms.
+METRICS_ACTIVE = False
+METRICS_DIR = os.path.join(BASE_DIR, 'metrics')
+METRICS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
 # Logging settings. This is a standard python logging configuration. The levels
 # are supposed to change depending on the settings file, to avoid clogging the
-# logs with useless information.
+# logs with useless information. The level of a single module can be changed
+# adding its logger, for example 'sikr.db.connector'.
+# With LOG_ASYNC the log file is written from a background thread, so the
+# requests never wait for the disk.
+LOG_ASYNC = True
 LOGFILE = 'sikr.log'
 LOG_CONFIG = {
     "version": 1,
@@ -0,0 +1,76 @@
+"""In-process caches.
+
+Size bounded LRU cache with per key expiration, shared by the threads of a
+worker process. Each process keeps its own copy, so it's only meant to store
+values that are cheap to rebuild or that are invalidated explicitly.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache(object):
+
+    """Least recently used cache with optional expiration.
+
+    Args:
+        maxsize (int): Maximum number of keys, the least recently used key is
+            evicted when it's exceeded. A size of 0 disables the cache.
+        ttl (int): Default seconds for a key to expire, None to keep keys
+            until they are evicted.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Get the value of a key, or ``default`` if it's missing or expired."""
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= time.time():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, expires=None):
+        """Store a value.
+
+        Args:
+            expires (float): Timestamp when the key expires. Defaults to now
+                plus the cache ``ttl``.
+        """
+        if not self.maxsize:
+            return
+        if expires is None and self.ttl is not None:
+            expires = time.time() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """Remove a key from the cache, if it's there."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove all the keys."""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
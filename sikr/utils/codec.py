@@ -0,0 +1,48 @@
+"""JSON codec of the platform.
+
+All the JSON parsing and encoding of the platform goes through this module,
+which picks the fastest library available when the platform starts: orjson,
+ujson or the standard library json module, in that order.
+
+``loads`` accepts both str and bytes. ``dumps`` returns a str and ``dumpb``
+returns UTF-8 encoded bytes, ready to be sent in a response.
+"""
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+import json
+
+
+if orjson is not None:
+    BACKEND = 'orjson'
+    loads = orjson.loads
+    dumpb = orjson.dumps
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+
+elif ujson is not None:
+    BACKEND = 'ujson'
+    loads = ujson.loads
+    dumps = ujson.dumps
+
+    def dumpb(obj):
+        return ujson.dumps(obj).encode('utf-8')
+
+else:
+    BACKEND = 'json'
+    loads = json.loads
+
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+    def dumpb(obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
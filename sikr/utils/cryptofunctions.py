@@ -5,9 +5,41 @@ backend side of the platform.
 """
 
 import base64
+import functools
 import hashlib
-from Crypto import Random
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
 from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF
+from Crypto.Random import get_random_bytes
+
+# Streamed encryption format. A header, packed as STREAM_HEADER, the length of
+# the id of the key of the stream, packed as KEY_ID_HEADER, and the id, and
+# then frames. Every frame is the
+# length of a chunk of content, packed as FRAME_HEADER with FINAL_FRAME set on
+# the last one, the encrypted chunk and its GCM tag. Streams of version 1 have
+# no key id, they are read with the legacy key of the ring.
+STREAM_MAGIC = b'SKRS'
+STREAM_VERSION = 2
+STREAM_VERSIONS = (1, 2)
+# Magic, version, chunk size, key salt, nonce prefix
+STREAM_HEADER = struct.Struct('>4sBI16s8s')
+KEY_ID_HEADER = struct.Struct('>B')
+FRAME_HEADER = struct.Struct('>I')
+FINAL_FRAME = 0x80000000
+TAG_SIZE = 16
+
+# Values encrypted by a KeyRing start with the id of their key and this
+# separator, that can't be part of the base64 content.
+KEY_ID_SEPARATOR = b'$'
+
+
+@functools.lru_cache(maxsize=16)
+def derive_key(key):
+    """Get the AES key for a secret, the digest is only computed once."""
+    return hashlib.sha256(key.encode()).digest()
 
 
 class AESCipher(object):
@@ -15,27 +47,380 @@ class AESCipher(object):
     def __init__(self, key):
         """Declare main variables like byte size (BS) and key."""
         self.bs = 32
-        self.key = hashlib.sha256(key.encode()).digest()
+        self.key = derive_key(key)
 
     def encrypt(self, raw):
-        """Encrypt content using AES."""
-        raw = self._pad(raw)
-        iv = Random.new().read(AES.block_size)
+        """Encrypt content using AES.
+
+        Args:
+            raw (str, bytes or memoryview): Content to encrypt, str is
+                encoded as UTF-8.
+        """
+        if isinstance(raw, str):
+            raw = raw.encode('utf-8')
+        raw = memoryview(raw)
+        iv = get_random_bytes(AES.block_size)
         cipher = AES.new(self.key, AES.MODE_CBC, iv)
-        return base64.b64encode(iv + cipher.encrypt(raw))
+        # Only the last incomplete block is copied to be padded
+        full = len(raw) - len(raw) % self.bs
+        parts = [iv]
+        if full:
+            parts.append(cipher.encrypt(raw[:full]))
+        parts.append(cipher.encrypt(self._pad(raw[full:])))
+        return base64.b64encode(b''.join(parts))
 
     def decrypt(self, enc):
         """Decrypt content."""
-        enc = base64.b64decode(enc)
-        iv = enc[:AES.block_size]
-        cipher = AES.new(self.key, AES.MODE_CBC, iv)
-        return self._unpad(cipher.decrypt(enc[AES.block_size:])).decode('utf-8')
+        return self.decrypt_bytes(enc).decode('utf-8')
+
+    def decrypt_bytes(self, enc):
+        """Decrypt content without decoding it."""
+        enc = memoryview(base64.b64decode(enc))
+        cipher = AES.new(self.key, AES.MODE_CBC, bytes(enc[:AES.block_size]))
+        return self._unpad(cipher.decrypt(enc[AES.block_size:]))
+
+    def encrypt_many(self, values, workers=None):
+        """Encrypt a batch of values.
+
+        Args:
+            values (iterable): Contents to encrypt, as in ``encrypt``.
+            workers (int): Split the batch between this many threads.
+                PyCryptodome releases the GIL while it encrypts, so big
+                batches use all the cores.
+
+        Returns:
+            list: The encrypted values, in the same order.
+        """
+        return self._map(self.encrypt, values, workers)
+
+    def decrypt_many(self, values, workers=None):
+        """Decrypt a batch of values, see ``encrypt_many``."""
+        return self._map(self.decrypt, values, workers)
+
+    @staticmethod
+    def _map(function, values, workers):
+        """Apply a function to every value, in chunks split between threads."""
+        values = list(values)
+        if not workers or workers < 2 or len(values) < workers:
+            return [function(value) for value in values]
+
+        size = -(-len(values) // workers)
+        chunks = [values[i:i + size] for i in range(0, len(values), size)]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(lambda chunk: [function(value) for value in chunk],
+                               chunks)
+            return [value for chunk in results for value in chunk]
 
     def _pad(self, s):
         """Pad the text if it doesn't match the byte size."""
-        return s + (self.bs - len(s) % self.bs) * chr(self.bs - len(s) % self.bs)
+        padding = self.bs - len(s) % self.bs
+        return bytes(s) + bytes((padding,)) * padding
 
     @staticmethod
     def _unpad(s):
         """Unpad the content for decryption."""
-        return s[:-ord(s[len(s) - 1:])]
+        return s[:-s[-1]]
+
+
+class KeyRing(object):
+
+    """Encrypt with the current key and decrypt with any key of the ring.
+
+    The ciphertext is prefixed with the id of the key that encrypted it
+    (``<id>$<base64>``), so the current key can be changed at any time and
+    the values encrypted with the previous ones can still be read until
+    they are rotated. Values without id were encrypted before the key ids
+    existed, and are read with the ``legacy`` key.
+
+    Args:
+        keys (dict): Secrets by key id.
+        current (str): Id of the key used to encrypt new values.
+        legacy (str): Secret of the values that have no key id.
+
+    Raises:
+        ValueError: If the current key is not in the ring or an id is not
+            alphanumeric.
+    """
+
+    def __init__(self, keys, current, legacy=None):
+        for key_id in keys:
+            if not str(key_id).isalnum():
+                raise ValueError("Invalid key id: {0}".format(key_id))
+        if current not in keys:
+            raise ValueError("Unknown current key: {0}".format(current))
+        self.current = current
+        self.ciphers = {str(key_id).encode('ascii'): AESCipher(key)
+                        for key_id, key in keys.items()}
+        self.legacy = AESCipher(legacy) if legacy else None
+        self._prefix = str(current).encode('ascii') + KEY_ID_SEPARATOR
+
+    @staticmethod
+    def _split(enc):
+        """Split a value in key id (None without it) and content."""
+        if isinstance(enc, str):
+            enc = enc.encode('ascii')
+        key_id, separator, content = enc.partition(KEY_ID_SEPARATOR)
+        if not separator:
+            return None, enc
+        return key_id, content
+
+    def key_id(self, enc):
+        """Get the id of the key that encrypted a value, None if it has none."""
+        key_id = self._split(enc)[0]
+        return key_id.decode('ascii') if key_id is not None else None
+
+    def needs_rotation(self, enc):
+        """Check if a value is not encrypted with the current key."""
+        return self._split(enc)[0] != self._prefix[:-1]
+
+    def encrypt(self, raw):
+        """Encrypt content with the current key, see ``AESCipher.encrypt``."""
+        return self._prefix + self.ciphers[self._prefix[:-1]].encrypt(raw)
+
+    def decrypt(self, enc):
+        """Decrypt content with the key it was encrypted with."""
+        return self.decrypt_bytes(enc).decode('utf-8')
+
+    def decrypt_bytes(self, enc):
+        """Decrypt content without decoding it.
+
+        Raises:
+            KeyError: If the key of the value is not in the ring.
+        """
+        key_id, content = self._split(enc)
+        return self.get_cipher(key_id).decrypt_bytes(content)
+
+    def get_cipher(self, key_id):
+        """Get the cipher of a key id (bytes), None for the legacy key.
+
+        Raises:
+            KeyError: If the key is not in the ring.
+        """
+        if key_id is None:
+            if self.legacy is None:
+                raise KeyError("No legacy key to decrypt the value")
+            return self.legacy
+        return self.ciphers[key_id]
+
+    def rotate(self, enc):
+        """Encrypt a value again with the current key."""
+        return self.encrypt(self.decrypt_bytes(enc))
+
+    def rotate_many(self, values, workers=None):
+        """Encrypt a batch of values again with the current key.
+
+        The values are grouped by the key that encrypted them, and every
+        group is decrypted, and then the whole batch encrypted, with
+        ``AESCipher.decrypt_many`` and ``encrypt_many``.
+
+        Args:
+            values (iterable): Encrypted values, str or bytes.
+            workers (int): Threads that share the work, see
+                ``AESCipher.encrypt_many``.
+
+        Returns:
+            list: The values encrypted with the current key, in the same
+                order.
+        """
+        groups = {}
+        for index, value in enumerate(values):
+            key_id, content = self._split(value)
+            groups.setdefault(key_id, []).append((index, content))
+
+        raw = [None] * sum(len(group) for group in groups.values())
+        for key_id, group in groups.items():
+            decrypted = self.get_cipher(key_id).decrypt_many(
+                (content for _, content in group), workers)
+            for (index, _), value in zip(group, decrypted):
+                raw[index] = value
+
+        current = self.ciphers[self._prefix[:-1]]
+        return [self._prefix + enc
+                for enc in current.encrypt_many(raw, workers)]
+
+
+def _read_full(src, size):
+    """Read ``size`` bytes from a file-like object, less only at the end."""
+    data = src.read(size)
+    if len(data) == size or not data:
+        return data
+    buffer = bytearray(data)
+    while len(buffer) < size:
+        data = src.read(size - len(buffer))
+        if not data:
+            break
+        buffer += data
+    return bytes(buffer)
+
+
+class _ChunkReader(object):
+
+    """File-like object that reads from an iterable of chunks of bytes."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def read(self, size):
+        # The iterable is always read to its end, decrypt_stream checks
+        # there's nothing after the last chunk once it's yielded
+        while not self.buffer:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return b''
+            self.buffer = chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class StreamCipher(object):
+
+    """Authenticated encryption of streams of any size in constant memory.
+
+    The content is read a chunk at a time and every chunk is encrypted with
+    AES-GCM, using a key derived for that stream only from the current key
+    of the ring. The header, with the id of that key, and the position and
+    length of each chunk, and which one is the last, are authenticated with
+    it, so a stream can't be modified, reordered or truncated without the
+    decryption failing. Streams are decrypted with the key of their header,
+    like the values of the ``KeyRing``.
+
+    Args:
+        keyring (KeyRing): Keys of the streams.
+        chunk_size (int): Bytes of content per frame.
+    """
+
+    def __init__(self, keyring, chunk_size=64 * 1024):
+        self.keyring = keyring
+        self.chunk_size = chunk_size
+
+    def encrypt_stream(self, src, dst):
+        """Encrypt everything that can be read from ``src`` into ``dst``.
+
+        Returns:
+            int: Number of bytes of content encrypted.
+        """
+        key_id = str(self.keyring.current).encode('ascii')
+        salt = get_random_bytes(16)
+        prefix = get_random_bytes(8)
+        header = (STREAM_HEADER.pack(STREAM_MAGIC, STREAM_VERSION,
+                                     self.chunk_size, salt, prefix) +
+                  KEY_ID_HEADER.pack(len(key_id)) + key_id)
+        key = HKDF(self.keyring.get_cipher(key_id).key, 32, salt, SHA256)
+        dst.write(header)
+
+        total = 0
+        counter = 0
+        chunk = _read_full(src, self.chunk_size)
+        while True:
+            # Read ahead to know if this is the last chunk
+            following = b''
+            if len(chunk) == self.chunk_size:
+                following = _read_full(src, self.chunk_size)
+            flags = 0 if following else FINAL_FRAME
+            frame = FRAME_HEADER.pack(len(chunk) | flags)
+            cipher = self._cipher(key, prefix, counter, header + frame)
+            ciphertext, tag = cipher.encrypt_and_digest(chunk)
+            dst.write(frame)
+            dst.write(ciphertext)
+            dst.write(tag)
+            total += len(chunk)
+            if not following:
+                return total
+            chunk = following
+            counter += 1
+
+    def decrypt_stream(self, src):
+        """Decrypt a stream, yielding the content a chunk at a time.
+
+        Every chunk is authenticated before it's yielded.
+
+        Raises:
+            ValueError: If the stream is not valid, has been modified or is
+                truncated.
+            KeyError: If the key of the stream is not in the ring.
+        """
+        header, key_id, chunk_size, salt, prefix = self._read_header(src)
+        key = HKDF(self.keyring.get_cipher(key_id).key, 32, salt, SHA256)
+
+        counter = 0
+        while True:
+            frame = _read_full(src, FRAME_HEADER.size)
+            if len(frame) != FRAME_HEADER.size:
+                raise ValueError("Truncated stream")
+            length, = FRAME_HEADER.unpack(frame)
+            final = bool(length & FINAL_FRAME)
+            length &= ~FINAL_FRAME
+            if length > chunk_size:
+                raise ValueError("Invalid frame length")
+            body = _read_full(src, length + TAG_SIZE)
+            if len(body) != length + TAG_SIZE:
+                raise ValueError("Truncated stream")
+            cipher = self._cipher(key, prefix, counter, header + frame)
+            yield cipher.decrypt_and_verify(body[:length], body[length:])
+            if final:
+                break
+            counter += 1
+
+        if src.read(1):
+            raise ValueError("Unexpected data after the end of the stream")
+
+    def rotate_stream(self, src, dst):
+        """Encrypt a stream again with the current key, into ``dst``.
+
+        The stream is decrypted and encrypted a chunk at a time, so the
+        memory used doesn't depend on its size.
+
+        Returns:
+            int: Number of bytes of content encrypted.
+        """
+        return self.encrypt_stream(_ChunkReader(self.decrypt_stream(src)), dst)
+
+    def key_id(self, src):
+        """Get the id of the key of a stream, None if it has none.
+
+        Only the header is read from ``src``.
+        """
+        key_id = self._read_header(src)[1]
+        return key_id.decode('ascii') if key_id is not None else None
+
+    def needs_rotation(self, src):
+        """Check if a stream is not encrypted with the current key."""
+        return self.key_id(src) != str(self.keyring.current)
+
+    @staticmethod
+    def _read_header(src):
+        """Read the header of a stream.
+
+        Returns:
+            tuple: The whole header, to authenticate it, key id (None in
+                version 1), chunk size, key salt and nonce prefix.
+        """
+        header = _read_full(src, STREAM_HEADER.size)
+        if len(header) != STREAM_HEADER.size:
+            raise ValueError("Truncated stream header")
+        magic, version, chunk_size, salt, prefix = STREAM_HEADER.unpack(header)
+        if magic != STREAM_MAGIC or version not in STREAM_VERSIONS:
+            raise ValueError("Unknown stream format")
+        if version == 1:
+            return header, None, chunk_size, salt, prefix
+        key_id_header = _read_full(src, KEY_ID_HEADER.size)
+        if len(key_id_header) != KEY_ID_HEADER.size:
+            raise ValueError("Truncated stream header")
+        key_id_size, = KEY_ID_HEADER.unpack(key_id_header)
+        key_id = _read_full(src, key_id_size)
+        if len(key_id) != key_id_size or not key_id.isalnum():
+            raise ValueError("Invalid stream key id")
+        return (header + key_id_header + key_id, key_id, chunk_size, salt,
+                prefix)
+
+    @staticmethod
+    def _cipher(key, prefix, counter, associated_data):
+        """Get the cipher of a chunk, bound to its position and frame."""
+        if counter > 0xFFFFFFFF:
+            raise ValueError("Stream too long")
+        cipher = AES.new(key, AES.MODE_GCM,
+                         nonce=prefix + struct.pack('>I', counter),
+                         mac_len=TAG_SIZE)
+        cipher.update(associated_data + struct.pack('>I', counter))
+        return cipher
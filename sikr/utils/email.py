@@ -1,45 +1,367 @@
 """Email sender.
 
-Basic module to send emails from the platform using the standard Python SMTP
-mechanishm.
+The emails are never sent inside a request. ``send_email`` stores them in the
+outbox table and a dispatcher sends them from background threads, so they
+survive a restart and the requests don't wait for the SMTP server.
+
+Every thread of the dispatcher keeps its own connection to the SMTP server
+open between emails and takes the pending emails in batches of
+EMAIL_BATCH_SIZE. A batch is claimed in a short transaction, so several
+threads and processes can share the outbox without sending an email twice,
+and sent outside of any transaction. An email that fails is tried again
+later, waiting EMAIL_RETRY_BACKOFF seconds doubled on every attempt, until
+it fails EMAIL_MAX_ATTEMPTS times.
+
+With EMAIL_DISPATCHER_ACTIVE every worker process starts a dispatcher the
+first time it queues an email. The dispatcher can also run on its own with
+``python app.py --send-emails``.
 """
 
+from datetime import date, datetime, timedelta
 from email.mime.text import MIMEText
-from datetime import date
+import atexit
+import logging
+import os
 import smtplib
+import threading
+import time
 from urllib.parse import urlparse
+import uuid
+
+from sqlalchemy import event
+
+from sikr import settings
+from sikr.db.connector import Session, engine
+from sikr.models.emails import OutboxEmail
 
-from sikre import settings
-from sikre.utils.logs import logger
+logger = logging.getLogger(__name__)
 
 from_addr = settings.DEFAULT_EMAIL_FROM
 site_domain = urlparse(settings.SITE_DOMAIN).netloc
 EMAIL_SPACE = ", "
 
 
-def send_email(subject='', to_address=[], from_address=from_addr, content=''):
+def build_message(subject, to_address, from_address, content):
+    """Build the MIME message of an email."""
+    msg = MIMEText(content)
+    msg['Subject'] = "[{0}] {1} {2}".format(site_domain, subject,
+                                            date.today().strftime("%Y%m%d"))
+    msg['To'] = EMAIL_SPACE.join(to_address)
+    msg['From'] = from_address
+    return msg
+
+
+def _outbox_row(subject='', to_address=[], from_address=from_addr, content=''):
+    """Row of the outbox table for an email."""
+    return {'active': True, 'from_address': from_address,
+            'to_address': ','.join(to_address), 'attempts': 0,
+            'next_attempt': datetime.utcnow(),
+            'message': build_message(subject, to_address, from_address,
+                                     content).as_string()}
+
+
+def send_email(subject='', to_address=[], from_address=from_addr, content='',
+               session=None):
     """Send an email to a specified user or users.
 
-    This is a basic wrapper around python's STMPLIB library that allows us to
-    send emails to the users in case it's necessary. Any failure of this
-    script is considered fatal.
+    The email is queued in the outbox and sent by the dispatcher.
+
+    Args:
+        session (Session): Session to add the email to. The email is only
+            sent if the session is committed, with the rest of the changes
+            of the request. Without a session the email is committed at once.
+    """
+    send_emails([{'subject': subject, 'to_address': to_address,
+                  'from_address': from_address, 'content': content}],
+                session=session)
+
+
+def send_emails(emails, session=None):
+    """Send many emails, queued in a single statement.
+
+    Args:
+        emails (list): The arguments of ``send_email`` for every email, as
+            dictionaries.
+        session (Session): As in ``send_email``.
+    """
+    rows = [_outbox_row(**email) for email in emails]
+    if not rows:
+        return
+    dispatcher = get_dispatcher()
+    if session is not None:
+        session.execute(OutboxEmail.__table__.insert(), rows)
+        if dispatcher is not None:
+            event.listen(session, 'after_commit',
+                         lambda session: dispatcher.wakeup.set(), once=True)
+    else:
+        own_session = Session(bind=engine)
+        try:
+            own_session.execute(OutboxEmail.__table__.insert(), rows)
+            own_session.commit()
+        finally:
+            own_session.close()
+        if dispatcher is not None:
+            dispatcher.wakeup.set()
+    logger.debug("%s emails queued", len(rows))
+
+
+def _is_permanent(error):
+    """Check if the SMTP server refused an email for good (5xx answers)."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+
+class SMTPConnection(object):
+
+    """Connection to the SMTP server, kept open between emails.
+
+    The connection is opened to send the first email and closed after
+    EMAIL_SMTP_IDLE seconds without sending. If the server closed it, a new
+    one is opened.
     """
+
+    def __init__(self):
+        self._smtp = None
+        self._last_used = 0
+
+    @property
+    def connected(self):
+        return self._smtp is not None
+
+    def _connect(self):
+        smtp = smtplib.SMTP(settings.SMTP_SERVER, settings.SMTP_PORT,
+                            timeout=settings.EMAIL_SMTP_TIMEOUT)
+        try:
+            if settings.SMTP_TLS:
+                smtp.starttls()
+            if settings.SMTP_USER:
+                smtp.login(settings.SMTP_USER, settings.SMTP_PASSWORD)
+        except Exception:
+            smtp.close()
+            raise
+        logger.debug("Connected to the SMTP server")
+        return smtp
+
+    def send(self, from_address, to_address, message):
+        """Send an email.
+
+        Raises:
+            smtplib.SMTPException: If the server refused the email, the
+                connection is kept.
+            Exception: If the server can't be reached, the connection is
+                closed.
+        """
+        try:
+            if self._smtp is None:
+                self._smtp = self._connect()
+            try:
+                self._smtp.sendmail(from_address, to_address, message)
+            except smtplib.SMTPServerDisconnected:
+                # The server closed the connection while it was idle
+                self._smtp = None
+                self._smtp = self._connect()
+                self._smtp.sendmail(from_address, to_address, message)
+        except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+            raise
+        except Exception:
+            self.reset()
+            raise
+        self._last_used = time.monotonic()
+
+    def close_if_idle(self):
+        if time.monotonic() - self._last_used > settings.EMAIL_SMTP_IDLE:
+            self.close()
+
+    def close(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._smtp = None
+
+    def reset(self):
+        """Drop the connection without saying goodbye to the server."""
+        if self._smtp is not None:
+            self._smtp.close()
+            self._smtp = None
+
+
+def _postpone(email, error, now, permanent=False):
+    """Schedule the next attempt to send an email that failed."""
+    email.attempts = settings.EMAIL_MAX_ATTEMPTS if permanent else email.attempts + 1
+    email.next_attempt = now + timedelta(
+        seconds=settings.EMAIL_RETRY_BACKOFF * 2 ** (email.attempts - 1))
+    email.last_error = str(error)[:255]
+    email.claimed_by = None
+    if email.attempts >= settings.EMAIL_MAX_ATTEMPTS:
+        logger.error("Email %s to %s dropped: %s", email.id, email.to_address,
+                     error)
+
+
+def _claim_batch(session, now):
+    """Claim a batch of the pending emails for this dispatcher.
+
+    The claim is a conditional update committed at once, a row claimed by
+    another dispatcher meanwhile no longer matches it. The claim moves the
+    next attempt EMAIL_CLAIM_TIMEOUT seconds ahead, so the emails of a
+    dispatcher that dies are sent by another one after that time.
+
+    The session must not expire its objects on commit, the emails are
+    returned loaded and without an open transaction.
+
+    Returns:
+        list: The claimed emails.
+    """
+    claim = uuid.uuid4().hex
+    pending = (OutboxEmail.attempts < settings.EMAIL_MAX_ATTEMPTS,
+               OutboxEmail.next_attempt <= now)
+    ids = [email_id for email_id, in
+           session.query(OutboxEmail.id)
+                  .filter(*pending)
+                  .order_by(OutboxEmail.id)
+                  .limit(settings.EMAIL_BATCH_SIZE)
+                  .with_for_update(skip_locked=True)]
+    if not ids:
+        session.commit()
+        return []
+    (session.query(OutboxEmail)
+            .filter(OutboxEmail.id.in_(ids), *pending)
+            .update({'claimed_by': claim,
+                     'next_attempt': now + timedelta(
+                         seconds=settings.EMAIL_CLAIM_TIMEOUT)},
+                    synchronize_session=False))
+    session.commit()
+    emails = (session.query(OutboxEmail)
+                     .filter(OutboxEmail.claimed_by == claim)
+                     .order_by(OutboxEmail.id)
+                     .all())
+    # End the transaction of the read, the emails stay loaded
+    session.commit()
+    return emails
+
+
+def dispatch_batch(connection):
+    """Send a batch of the pending emails.
+
+    The batch is claimed and committed before sending, no transaction is
+    open while the SMTP server answers. The sent emails are deleted
+    afterwards. If the SMTP server can't be reached, the rest of the batch
+    fails with the email that found it.
+
+    Returns:
+        int: The number of emails taken from the outbox.
+    """
+    session = Session(bind=engine, expire_on_commit=False)
+    try:
+        now = datetime.utcnow()
+        emails = _claim_batch(session, now)
+        error = None
+        for email in emails:
+            if error is None or connection.connected:
+                try:
+                    connection.send(email.from_address, email.recipients,
+                                    email.message)
+                except Exception as e:
+                    error = e
+                    logger.warning("Email %s to %s failed: %s", email.id,
+                                   email.to_address, e)
+                else:
+                    session.delete(email)
+                    continue
+            # Only trust the answer of the server if the connection works
+            _postpone(email, error, now,
+                      permanent=connection.connected and _is_permanent(error))
+        session.commit()
+        return len(emails)
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+class EmailDispatcher(object):
+
+    """Send the emails of the outbox from EMAIL_CONNECTIONS threads.
+
+    The threads look for pending emails every EMAIL_POLL_INTERVAL seconds,
+    or right away when ``wakeup`` is set.
+    """
+
+    def __init__(self):
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def start(self):
+        for number in range(settings.EMAIL_CONNECTIONS):
+            thread = threading.Thread(target=self.run, daemon=True,
+                                      name="sikr-email-{0}".format(number))
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+    def run(self):
+        connection = SMTPConnection()
+        try:
+            while not self.stopped.is_set():
+                try:
+                    taken = dispatch_batch(connection)
+                except Exception as e:
+                    logger.error("Email dispatch failed. Error: %s", e)
+                    taken = 0
+                if not taken:
+                    connection.close_if_idle()
+                    self.wakeup.wait(settings.EMAIL_POLL_INTERVAL)
+                    self.wakeup.clear()
+        finally:
+            connection.close()
+
+
+_dispatcher = None
+_dispatcher_pid = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    """Get the dispatcher of this process, starting it the first time.
+
+    Returns:
+        EmailDispatcher: The dispatcher, or None without EMAIL_DISPATCHER_ACTIVE.
+    """
+    global _dispatcher, _dispatcher_pid
+    if not settings.EMAIL_DISPATCHER_ACTIVE:
+        return None
+    pid = os.getpid()
+    if _dispatcher_pid != pid:
+        with _dispatcher_lock:
+            if _dispatcher_pid != pid:
+                _dispatcher = EmailDispatcher()
+                _dispatcher.start()
+                atexit.register(_dispatcher.stop)
+                _dispatcher_pid = pid
+    return _dispatcher
+
+
+def run_dispatcher():
+    """Send the emails of the outbox until the process is interrupted."""
+    start_msg = "Sending the emails of the outbox, press Ctrl+C to stop..."
+    print(f"[ --  ] {start_msg}")
+    logger.info(start_msg)
+    dispatcher = EmailDispatcher()
+    dispatcher.start()
     try:
-        msg = MIMEText(content)
-        msg['Subject'] = "[{0}] {1} {2}".format(site_domain, subject,
-                                                date.today().strftime("%Y%m%d"))
-        msg['To'] = EMAIL_SPACE.join(to_address)
-        msg['From'] = from_address
-        logger.debug("All parameters set")
-        mail = smtplib.SMTP(settings.SMTP_SERVER, settings.SMTP_PORT)
-        logger.debug("Instantiated the SMTP")
-        if settings.SMTP_TLS:
-            mail.starttls()
-            logger.debug("Started SMTP TLS connection")
-        mail.login(settings.SMTP_USER, settings.SMTP_PASSWORD)
-        logger.debug("Login success")
-        mail.sendmail(from_addr, to_address, msg.as_string())
-        logger.debug("Sent email")
-        mail.quit()
-    except Exception as e:
-        logger.error("Email send failed. Error: {0}".format(e))
+        while any(thread.is_alive() for thread in dispatcher.threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        dispatcher.stop()
+        for thread in dispatcher.threads:
+            thread.join()
+    end_msg = "Email dispatcher stopped"
+    print(f"[ OK  ] {end_msg}")
+    logger.info(end_msg)
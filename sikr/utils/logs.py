@@ -1,13 +1,75 @@
 """Log activator for the platform.
 
-This module activates the logging mechanism of the platform. It must be
-imported in all modules that need to declare logs.
+This module activates the logging mechanism of the platform with LOG_CONFIG.
+It's imported once when the application starts, the modules log with their
+own logger, ``logging.getLogger(__name__)``, a child of the "sikr" logger
+that writes the records. The level of every module can be set in LOG_CONFIG.
+
+With LOG_ASYNC the handlers of the "sikr" logger are moved to a background
+thread, the requests only put the records in a queue and never wait for the
+disk. Log with %-style arguments (``logger.debug("User %s", user_id)``) so
+the message is only built if the level of the logger lets it through.
 """
 
+import atexit
+import copy
 import logging
 import logging.config
+import os
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
 
 from sikr import settings
 
+
+class AsyncHandler(QueueHandler):
+
+    """Queue the records and write them with ``handlers`` from a thread.
+
+    The thread is started the first time a record is logged in each process,
+    so every worker forked by the application server gets its own.
+
+    The records are queued as they are, the message and the traceback are
+    only formatted by the handlers in the thread. Because of that, pass
+    values that won't change (ids, strings, numbers) as the arguments of the
+    message, not objects that may be modified after the call.
+    """
+
+    def __init__(self, handlers):
+        super().__init__(queue.Queue(-1))
+        self.handlers = handlers
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def prepare(self, record):
+        # QueueHandler.prepare formats the whole record in the calling thread,
+        # a shallow copy keeps the handlers of the thread from sharing it
+        return copy.copy(record)
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        self.queue.put_nowait(record)
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # The queue of the parent process may hold records it didn't write
+            self.queue = queue.Queue(-1)
+            listener = QueueListener(self.queue, *self.handlers,
+                                     respect_handler_level=True)
+            listener.start()
+            atexit.register(listener.stop)
+            self._pid = os.getpid()
+
+
 logging.config.dictConfig(settings.LOG_CONFIG)
 logger = logging.getLogger("sikr")
+
+if settings.LOG_ASYNC and logger.handlers:
+    handlers = logger.handlers[:]
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(AsyncHandler(handlers))
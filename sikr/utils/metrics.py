@@ -0,0 +1,218 @@
+"""Metrics of the platform, shared between processes.
+
+The application server runs several worker processes and any of them can
+answer the request to the metrics endpoint, so the values can't live in the
+memory of each process. Every process writes its values to its own file in
+METRICS_DIR, mapped in memory so an update is just a write to memory, and
+the endpoint reads and adds up the files of all the processes.
+
+The files are kept when a worker dies, so the counters of the workers that
+uWSGI restarts are not lost. Empty METRICS_DIR when the application is
+restarted.
+
+The values are exposed in the Prometheus text format. All the functions do
+nothing unless METRICS_ACTIVE is set.
+"""
+
+from collections import defaultdict
+import glob
+import mmap
+import os
+import re
+import struct
+import threading
+
+from sikr import settings
+
+# Help and type of every metric
+METRICS = {
+    'sikr_requests_total': ("Requests answered", 'counter'),
+    'sikr_request_duration_seconds': ("Time to answer the requests", 'histogram'),
+    'sikr_errors_total': ("Requests answered with an error status", 'counter'),
+    'sikr_db_pool_checkouts_total': ("Connections taken from the pool", 'counter'),
+    'sikr_db_pool_timeouts_total': ("Waits for a connection that timed out", 'counter'),
+    'sikr_db_pool_wait_seconds': ("Time waiting for a connection from the pool", 'histogram'),
+    'sikr_cache_hits_total': ("Cache lookups that found the key", 'counter'),
+    'sikr_cache_misses_total': ("Cache lookups that didn't find the key", 'counter'),
+}
+POOL_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+# Bound of a histogram bucket, always its last label
+LE_LABEL = re.compile(r'[{,]le="([^"]+)"}$')
+
+# Layout of the files: the bytes in use, then entries made of the length of
+# the key, the key padded to 8 bytes and the value
+USED = struct.Struct('Q')
+KEY_LENGTH = struct.Struct('I')
+VALUE = struct.Struct('d')
+INITIAL_SIZE = 64 * 1024
+
+
+def _entry_size(key):
+    """Bytes taken by an entry, the value is aligned to 8 bytes."""
+    size = KEY_LENGTH.size + len(key)
+    return size + (-size % 8) + VALUE.size
+
+
+def _read_entries(data, used):
+    """Yield the key, value and value position of every entry."""
+    position = USED.size
+    while position < used:
+        length = KEY_LENGTH.unpack_from(data, position)[0]
+        start = position + KEY_LENGTH.size
+        key = bytes(data[start:start + length]).decode('utf-8')
+        position = start + length
+        position += -position % 8
+        yield key, VALUE.unpack_from(data, position)[0], position
+        position += VALUE.size
+
+
+class MmapValues(object):
+
+    """Float values by key, stored in a file mapped in memory.
+
+    Only one process writes to each file. An entry is written before the
+    count of bytes in use is updated, so a reader never sees half an entry.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'a+b')
+        size = os.fstat(self._file.fileno()).st_size
+        if size == 0:
+            size = INITIAL_SIZE
+            self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._used = USED.unpack_from(self._map, 0)[0]
+        if not self._used:
+            self._used = USED.size
+            USED.pack_into(self._map, 0, self._used)
+        self._positions = {key: position for key, _, position
+                           in _read_entries(self._map, self._used)}
+        self._lock = threading.Lock()
+
+    def _position(self, key):
+        """Get the position of the value of a key, adding it if it's new."""
+        position = self._positions.get(key)
+        if position is not None:
+            return position
+
+        encoded = key.encode('utf-8')
+        size = _entry_size(encoded)
+        if self._used + size > len(self._map):
+            new_size = len(self._map)
+            while self._used + size > new_size:
+                new_size *= 2
+            self._file.truncate(new_size)
+            self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), new_size)
+
+        KEY_LENGTH.pack_into(self._map, self._used, len(encoded))
+        start = self._used + KEY_LENGTH.size
+        self._map[start:start + len(encoded)] = encoded
+        position = self._used + size - VALUE.size
+        VALUE.pack_into(self._map, position, 0.0)
+        self._used += size
+        USED.pack_into(self._map, 0, self._used)
+        self._positions[key] = position
+        return position
+
+    def inc(self, key, amount=1.0):
+        """Add to the value of a key."""
+        with self._lock:
+            position = self._position(key)
+            value = VALUE.unpack_from(self._map, position)[0]
+            VALUE.pack_into(self._map, position, value + amount)
+
+
+_values = None
+_values_pid = None
+_values_lock = threading.Lock()
+
+
+def _get_values():
+    """Get the values file of this process, opening it after a fork."""
+    global _values, _values_pid
+    pid = os.getpid()
+    if _values_pid != pid:
+        with _values_lock:
+            if _values_pid != pid:
+                os.makedirs(settings.METRICS_DIR, exist_ok=True)
+                _values = MmapValues(os.path.join(
+                    settings.METRICS_DIR, 'metrics_{0}.db'.format(pid)))
+                _values_pid = pid
+    return _values
+
+
+def _key(name, labels=()):
+    """Name of a sample with its labels, as in the text format."""
+    if not labels:
+        return name
+    return '{0}{{{1}}}'.format(name, ','.join(
+        '{0}="{1}"'.format(label, value) for label, value in labels))
+
+
+def inc(name, labels=(), amount=1.0):
+    """Add to a counter.
+
+    Args:
+        name (str): Name of the metric, one of METRICS.
+        labels (tuple): Pairs of label and value, always in the same order.
+    """
+    if settings.METRICS_ACTIVE:
+        _get_values().inc(_key(name, labels), amount)
+
+
+def observe(name, value, labels=(), buckets=None):
+    """Add an observation to a histogram."""
+    if not settings.METRICS_ACTIVE:
+        return
+    values = _get_values()
+    for bound in buckets or settings.METRICS_BUCKETS:
+        if value <= bound:
+            values.inc(_key(name + '_bucket', labels + (('le', bound),)))
+    values.inc(_key(name + '_bucket', labels + (('le', '+Inf'),)))
+    values.inc(_key(name + '_sum', labels), value)
+    values.inc(_key(name + '_count', labels))
+
+
+def collect():
+    """Add up the values of all the processes."""
+    totals = defaultdict(float)
+    for path in glob.glob(os.path.join(settings.METRICS_DIR, 'metrics_*.db')):
+        with open(path, 'rb') as values_file:
+            data = values_file.read()
+        if len(data) < USED.size:
+            continue
+        used = min(USED.unpack_from(data, 0)[0], len(data))
+        for key, value, _ in _read_entries(data, used):
+            totals[key] += value
+    return totals
+
+
+def _sample_order(key):
+    """Sort the samples by name and labels, and the buckets by their bound.
+
+    The bounds are compared as numbers, with +Inf last.
+    """
+    match = LE_LABEL.search(key)
+    if match is None:
+        return key, 0.0
+    return key[:match.start()], float(match.group(1))
+
+
+def render(totals):
+    """Write the values in the Prometheus text format."""
+    samples = defaultdict(list)
+    for key in sorted(totals, key=_sample_order):
+        name = key.split('{', 1)[0]
+        for suffix in ('_bucket', '_sum', '_count'):
+            if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+                name = name[:-len(suffix)]
+        samples[name].append('{0} {1!r}'.format(key, totals[key]))
+
+    lines = []
+    for name, (description, metric_type) in sorted(METRICS.items()):
+        if samples[name]:
+            lines.append('# HELP {0} {1}'.format(name, description))
+            lines.append('# TYPE {0} {1}'.format(name, metric_type))
+            lines.extend(samples[name])
+    return '\n'.join(lines) + '\n'
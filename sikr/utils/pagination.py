@@ -0,0 +1,73 @@
+"""Listing helpers.
+
+Functions shared by the listing resources to paginate their queries with a
+keyset (cursor) on the primary key and to project only the fields that the
+client asked for.
+"""
+
+import falcon
+
+from sikr import settings
+
+# Header used to send the cursor of the next page back to the client
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+
+def get_page(req):
+    """Get the page size and cursor requested by the client.
+
+    The ``limit`` parameter defaults to PAGE_SIZE and is capped at
+    MAX_PAGE_SIZE. The ``after`` parameter is the id of the last row of the
+    previous page.
+
+    Returns:
+        tuple: A (limit, after) pair, ``after`` is None for the first page.
+    """
+    limit = req.get_param_as_int('limit', min=1, max=settings.MAX_PAGE_SIZE)
+    after = req.get_param_as_int('after', min=0)
+    return limit or settings.PAGE_SIZE, after
+
+
+def get_fields(req, allowed):
+    """Get the fields requested by the client through ``fields=a,b,c``.
+
+    Raises:
+        HTTP Bad Request: If any of the fields is not in ``allowed``
+
+    Returns:
+        list: The requested fields in the order of ``allowed``, or all of
+              them if the client didn't ask for any in particular.
+    """
+    fields = req.get_param_as_list('fields')
+    if not fields:
+        return list(allowed)
+    unknown = set(fields).difference(allowed)
+    if unknown:
+        raise falcon.HTTPBadRequest(title="Bad request",
+                                    description="Unknown fields: {0}".format(
+                                        ", ".join(sorted(unknown))),
+                                    href=settings.__docs__)
+    return [field for field in allowed if field in fields]
+
+
+def paginate(query, column, limit, after):
+    """Restrict a query to one page, ordered by ``column``.
+
+    One extra row is fetched so ``split_page`` can tell if there's a next
+    page without running a COUNT.
+    """
+    if after is not None:
+        query = query.filter(column > after)
+    return query.order_by(column).limit(limit + 1)
+
+
+def split_page(rows, limit, key='id'):
+    """Split the rows returned by ``paginate`` into the page and next cursor.
+
+    Returns:
+        tuple: A (rows, cursor) pair, ``cursor`` is None on the last page.
+    """
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, rows[-1][key]
+    return rows, None
@@ -0,0 +1,155 @@
+"""Incremental readers for uploaded files.
+
+Each reader takes a binary file-like object (usually ``req.bounded_stream``)
+and yields its records one by one, reading the file a piece at a time, so
+big uploads are never held in memory. Malformed content raises ValueError.
+
+Wrap the stream in a ``LimitedStream`` to stop reading files that are too
+big, even when the client didn't send their size.
+"""
+
+import csv
+import io
+import json
+
+from sikr.utils import codec
+
+READ_SIZE = 64 * 1024
+WHITESPACE = ' \t\n\r'
+NUMBER_CHARS = '0123456789.eE+-'
+# Biggest element of a JSON array, in characters
+MAX_RECORD_SIZE = 1024 * 1024
+
+
+class StreamTooLarge(Exception):
+
+    """The stream is bigger than the limit of its ``LimitedStream``."""
+
+
+class LimitedStream(io.RawIOBase):
+
+    """Binary stream that fails when more than ``limit`` bytes are read.
+
+    Args:
+        stream: The binary file-like object to read from.
+        limit (int): Most bytes that can be read.
+
+    Raises:
+        StreamTooLarge: When a read goes over the limit.
+    """
+
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.count = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        # Ask for a byte more than allowed to notice an overflow
+        size = min(len(buffer), self.limit - self.count + 1)
+        data = self.stream.read(size)
+        self.count += len(data)
+        if self.count > self.limit:
+            raise StreamTooLarge("The stream is bigger than {0} bytes".format(
+                self.limit))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def _text(stream):
+    """Decode a binary stream as UTF-8 text.
+
+    Only \\n, \\r and \\r\\n end the lines, the rest of the Unicode line
+    boundaries (like U+2028) are content. The line endings are kept, as the
+    csv module requires.
+    """
+    return io.TextIOWrapper(stream, encoding='utf-8', newline='')
+
+
+def read_csv(stream):
+    """Yield the rows of a CSV file with a header row, as dictionaries."""
+    yield from csv.DictReader(_text(stream))
+
+
+def read_ndjson(stream):
+    """Yield the objects of a newline delimited JSON file."""
+    for line in _text(stream):
+        line = line.strip()
+        if line:
+            yield codec.loads(line)
+
+
+def read_json_array(stream):
+    """Yield the elements of a JSON array, decoding one element at a time.
+
+    Raises:
+        ValueError: If the content is not a JSON array, or an element is
+            bigger than MAX_RECORD_SIZE.
+    """
+    decoder = json.JSONDecoder()
+    reader = _text(stream)
+    buffer = ''
+    position = 0
+    # What can come next: '[', a value or ']', a value, or ',' or ']'
+    state = 'start'
+
+    while True:
+        while position < len(buffer) and buffer[position] in WHITESPACE:
+            position += 1
+        if position == len(buffer):
+            buffer, position = _read_more(reader, buffer, position)
+            continue
+
+        char = buffer[position]
+        if state == 'start':
+            if char != '[':
+                raise ValueError("A JSON array is required")
+            state = 'first'
+            position += 1
+        elif char == ']' and state in ('first', 'separator'):
+            position += 1
+            break
+        elif state == 'separator':
+            if char != ',':
+                raise ValueError("Expected ',' or ']' in the JSON array")
+            state = 'value'
+            position += 1
+        else:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # The element may be cut at the end of the buffer
+                buffer, position = _read_more(reader, buffer, position)
+                continue
+            if (not isinstance(value, (dict, list, str)) and
+                    (end == len(buffer) or buffer[end] in NUMBER_CHARS)):
+                # A number may continue in the next piece of the file
+                more = reader.read(READ_SIZE)
+                if more:
+                    buffer = buffer[position:] + more
+                    position = 0
+                    continue
+            yield value
+            position = end
+            state = 'separator'
+
+    rest = buffer[position:]
+    while True:
+        if rest.strip(WHITESPACE):
+            raise ValueError("Unexpected data after the JSON array")
+        rest = reader.read(READ_SIZE)
+        if not rest:
+            break
+
+
+def _read_more(reader, buffer, position):
+    """Append the next piece of the file to the unread part of the buffer."""
+    more = reader.read(READ_SIZE)
+    if not more:
+        raise ValueError("Unexpected end of the JSON array")
+    buffer = buffer[position:] + more
+    if len(buffer) > MAX_RECORD_SIZE:
+        raise ValueError("JSON array element too big")
+    return buffer, 0
@@ -0,0 +1,126 @@
+"""Streamed responses.
+
+Big listings can't be built in memory and dumped in one go, so instead of
+setting ``res.body`` the resources can put a ``JSONStream`` (or an
+``NDJSONStream``) in ``req.context['stream']``. The JSON middleware hands it
+to the WSGI server as the response stream and the rows get encoded a batch at
+a time while they are read from the database.
+"""
+
+import zlib
+
+from sikr import settings
+from sikr.utils import codec
+
+
+class JSONStream(object):
+
+    """Encode an iterable of rows as a JSON array, incrementally.
+
+    Args:
+        rows (iterable): The rows to encode, usually a generator reading from
+            a server side cursor.
+        envelope (dict): Optional object to wrap the array into. The array
+            will be set as the ``key`` attribute of this object.
+        key (string): Name of the attribute of ``envelope`` that holds the
+            array.
+        on_close (callable): Called once the stream is exhausted or closed by
+            the server. The session middleware sets it to release the
+            database session.
+    """
+
+    def __init__(self, rows, envelope=None, key=None, on_close=None):
+        self.rows = rows
+        self.envelope = envelope
+        self.key = key
+        self.on_close = on_close
+
+    def __iter__(self):
+        batch_size = settings.STREAM_CHUNK_SIZE
+        try:
+            yield self._head()
+            batch = []
+            separator = b''
+            for row in self.rows:
+                batch.append(codec.dumpb(row))
+                if len(batch) >= batch_size:
+                    yield separator + b','.join(batch)
+                    separator = b','
+                    batch = []
+            if batch:
+                yield separator + b','.join(batch)
+            yield b']}' if self.key else b']'
+        finally:
+            self.close()
+
+    def close(self):
+        """Release the resources of the stream, only the first time.
+
+        The WSGI server calls it when the response is sent or the client goes
+        away, even if the rows weren't read.
+        """
+        close_rows = getattr(self.rows, 'close', None)
+        if close_rows is not None:
+            close_rows()
+        on_close, self.on_close = self.on_close, None
+        if on_close is not None:
+            on_close()
+
+    def _head(self):
+        """Opening of the document, up to the start of the array."""
+        if not self.key:
+            return b'['
+        head = codec.dumpb(self.envelope or {})[:-1]
+        if self.envelope:
+            head += b','
+        return head + codec.dumpb(self.key) + b':['
+
+
+class NDJSONStream(object):
+
+    """Encode an iterable of rows as newline delimited JSON, incrementally.
+
+    Args:
+        rows (iterable): The rows to encode, one per line.
+        compress (bool): Compress the output with gzip while it's sent.
+        on_close (callable): Called once the stream is exhausted or closed by
+            the server, see ``JSONStream``.
+    """
+
+    def __init__(self, rows, compress=False, on_close=None):
+        self.rows = rows
+        self.compress = compress
+        self.on_close = on_close
+
+    def __iter__(self):
+        batch_size = settings.STREAM_CHUNK_SIZE
+        # wbits=31 writes the gzip header and trailer
+        compressor = zlib.compressobj(wbits=31) if self.compress else None
+        try:
+            batch = []
+            for row in self.rows:
+                batch.append(codec.dumpb(row))
+                if len(batch) >= batch_size:
+                    batch.append(b'')
+                    data = b'\n'.join(batch)
+                    batch = []
+                    if compressor is not None:
+                        data = compressor.compress(data)
+                    if data:
+                        yield data
+            data = b'\n'.join(batch + [b'']) if batch else b''
+            if compressor is not None:
+                data = compressor.compress(data) + compressor.flush()
+            if data:
+                yield data
+        finally:
+            self.close()
+
+    def close(self):
+        """Release the resources of the stream, see ``JSONStream.close``."""
+        close_rows = getattr(self.rows, 'close', None)
+        if close_rows is not None:
+            close_rows()
+        on_close, self.on_close = self.on_close, None
+        if on_close is not None:
+            on_close()
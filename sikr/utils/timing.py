@@ -0,0 +1,130 @@
+"""Timing of the phases of a request.
+
+The timing middleware starts a ``RequestStats`` for every request, in a
+thread local, and the instrumented code adds its time to it: the SQL
+statements through the engine events, the JSON encoding and parsing through
+the codec, and any block of code wrapped in ``phase(name)``. Outside of a
+timed request (or with the middleware disabled) the instrumentation does
+nothing.
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+import functools
+import threading
+import time
+
+from sqlalchemy import event
+
+from sikr.utils import codec
+
+_local = threading.local()
+_instrumented = set()
+
+
+class RequestStats(object):
+
+    """Timings and statements of a request.
+
+    Attributes:
+        start (float): ``time.perf_counter()`` when the request started.
+        marks (dict): Named points of the request, as perf counters.
+        phases (Counter): Seconds spent in every named phase.
+        queries (int): SQL statements executed.
+        db_time (float): Seconds spent executing them.
+        statements (Counter): Executions of every statement.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.marks = {}
+        self.phases = Counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.statements = Counter()
+
+
+def start_request():
+    """Start timing a request in this thread."""
+    _local.stats = RequestStats()
+    return _local.stats
+
+
+def end_request():
+    """Stop timing the request of this thread and return its stats."""
+    stats = getattr(_local, 'stats', None)
+    _local.stats = None
+    return stats
+
+
+def current():
+    """Get the stats of the request timed in this thread, if any."""
+    return getattr(_local, 'stats', None)
+
+
+@contextmanager
+def phase(name):
+    """Add the time spent in the block to a phase of the current request."""
+    stats = current()
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.phases[name] += time.perf_counter() - start
+
+
+def _timed(function, name):
+    """Wrap a function to add its time to a phase of the current request."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        stats = current()
+        if stats is None:
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stats.phases[name] += time.perf_counter() - start
+    return wrapper
+
+
+def instrument_codec():
+    """Time the JSON encoding and parsing done through the codec.
+
+    Streamed responses are encoded after the request finishes, so
+    ``dumpb`` is left alone.
+    """
+    if 'codec' in _instrumented:
+        return
+    codec.dumps = _timed(codec.dumps, 'serialize')
+    codec.loads = _timed(codec.loads, 'parse')
+    _instrumented.add('codec')
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if current() is not None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    stats = current()
+    starts = conn.info.get('query_start')
+    if stats is None or not starts:
+        return
+    stats.queries += 1
+    stats.db_time += time.perf_counter() - starts.pop()
+    stats.statements[statement] += 1
+
+
+def instrument_engine(engine):
+    """Count the statements of an engine and the time they take."""
+    if id(engine) in _instrumented:
+        return
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    _instrumented.add(id(engine))
@@ -1,27 +1,26 @@
 """Invitation token generator.
 
-This module generrate the invitation tokens based off a uuid4 web-safe
-function.
+The tokens come from the operating system CSPRNG with 256 bits of entropy, so
+they never repeat in practice and a new token doesn't need to be checked
+against the database. Only the hash of a token is stored.
 """
 
-import uuid
+import hashlib
+import secrets
 
-from sikre.models.shares import ShareToken
+# Random bytes of every token, the token is their URL safe base64 encoding
+TOKEN_BYTES = 32
 
 
 def generate_token():
-    """Generate a unique token.
+    """Generate a unique token."""
+    return secrets.token_urlsafe(TOKEN_BYTES)
 
-    Generate a new token based of the HEX version of a UUID and check if it
-    already exists. If that's the case generate a new one.
+
+def hash_token(token):
+    """Hash a token to store it or to look it up.
+
+    The tokens are random, so a plain SHA-256 is enough to keep them from
+    being recovered from the database.
     """
-    duplicated = True
-
-    while duplicated:
-        try:
-            token = uuid.uuid4().hex
-            share_token = ShareToken.get(token=token)
-            duplicated = True
-        except ShareToken.DoesNotExist:
-            duplicated = False
-            return token
+    return hashlib.sha256(token.encode('utf-8')).digest()
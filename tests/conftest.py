@@ -0,0 +1,68 @@
+"""Fixtures of the tests.
+
+The tests run against a SQLite database in a temporary directory. The
+settings are changed before the application is imported, the database
+engine is created with them.
+"""
+
+import os
+import tempfile
+
+import pytest
+
+from sikr import settings
+
+TEST_DIR = tempfile.mkdtemp(prefix='sikr-tests-')
+settings.DATABASE.clear()
+settings.DATABASE.update({'ENGINE': 'sqlite',
+                          'NAME': os.path.join(TEST_DIR, 'sikr.db')})
+settings.LOG_ASYNC = False
+settings.LOG_CONFIG['handlers']['logfile']['filename'] = os.path.join(
+    TEST_DIR, 'sikr.log')
+settings.EMAIL_DISPATCHER_ACTIVE = False
+
+import app  # noqa: E402
+from falcon import testing  # noqa: E402
+
+from sikr.db import syncdb  # noqa: E402,F401 registers every model
+from sikr.db.connector import Base, Session, engine  # noqa: E402
+from sikr.models.users import User, identity_cache, user_cache  # noqa: E402
+from sikr.resources.auth.utils import create_jwt_token  # noqa: E402
+
+
+@pytest.fixture
+def session():
+    """Session on an empty database."""
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    user_cache.clear()
+    identity_cache.clear()
+    session = Session(bind=engine)
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def client():
+    return testing.TestClient(app.api)
+
+
+@pytest.fixture
+def make_user(session):
+    """Create users, committed."""
+    def make_user(username):
+        user = User(active=True, username=username, name=username,
+                    email=username + '@example.com')
+        session.add(user)
+        session.commit()
+        return user
+    return make_user
+
+
+@pytest.fixture
+def auth_headers():
+    """Headers of the requests of a user."""
+    def auth_headers(user):
+        return {'Authorization': 'Bearer ' + create_jwt_token(user),
+                'Content-Type': 'application/json'}
+    return auth_headers
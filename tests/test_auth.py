@@ -0,0 +1,134 @@
+"""Tests of the tokens and the linking of the OAuth accounts."""
+
+import json
+from datetime import datetime, timedelta
+
+import falcon
+import jwt
+import pytest
+from falcon import testing
+
+from sikr import settings
+from sikr.models.users import User, UserIdentity
+from sikr.resources.auth import google, utils
+
+ITEMS_URL = '/v1/items'
+
+
+def make_token(user_id, issuer=None, issued=None, expires=None):
+    now = datetime.now()
+    payload = {'iss': issuer or settings.SITE_DOMAIN, 'sub': user_id,
+               'iat': issued or now, 'exp': expires or now + timedelta(hours=1)}
+    return jwt.encode(payload, settings.SECRET).decode('ascii')
+
+
+def make_request(authorization=None):
+    headers = {'Authorization': authorization} if authorization else {}
+    return falcon.Request(testing.create_environ(headers=headers))
+
+
+@pytest.fixture
+def user(make_user):
+    return make_user('owner')
+
+
+def invalid_authorizations(user_id):
+    past = datetime.now() - timedelta(hours=settings.SESSION_EXPIRES + 1)
+    return [
+        'Bearer ' + make_token(user_id, expires=datetime.now() - timedelta(hours=1)),
+        'Bearer ' + make_token(user_id, issued=past),
+        'Bearer ' + make_token(user_id, issuer='https://example.com'),
+        'Bearer ' + jwt.encode({'sub': user_id}, 'other').decode('ascii'),
+        'Bearer not-a-token',
+        'Basic',
+    ]
+
+
+def test_login_required_accepts_valid_token(client, auth_headers, user):
+    result = client.simulate_get(ITEMS_URL, headers=auth_headers(user))
+
+    assert result.status_code == 200
+
+
+def test_login_required_rejects_invalid_tokens(client, user):
+    for authorization in invalid_authorizations(user.id):
+        result = client.simulate_get(ITEMS_URL, headers={
+            'Authorization': authorization, 'Content-Type': 'application/json'})
+
+        assert result.status_code == 401, authorization
+
+
+def test_validate_token_rejects_invalid_tokens(session, user):
+    for authorization in invalid_authorizations(user.id):
+        with pytest.raises(jwt.InvalidTokenError):
+            utils.validate_token(make_request(authorization))
+
+
+def test_link_identity_to_logged_in_user(session, user):
+    req = make_request('Bearer ' + make_token(user.id))
+
+    linked = utils._link_identity(session, req, 'github', 1, {'username': 'gh'})
+    session.commit()
+
+    assert linked.id == user.id
+    assert session.query(UserIdentity).one().user_id == user.id
+
+
+def test_link_identity_with_invalid_token_fails(session, user):
+    for authorization in invalid_authorizations(user.id):
+        with pytest.raises(falcon.HTTPError) as error:
+            utils._link_identity(session, make_request(authorization),
+                                 'github', 1, {'username': 'gh'})
+
+        assert error.value.status == falcon.HTTP_401
+    session.rollback()
+    assert session.query(User).count() == 1
+    assert session.query(UserIdentity).count() == 0
+
+
+def test_link_identity_without_token_creates_user(session, user):
+    linked = utils._link_identity(session, make_request(), 'github', 1,
+                                  {'username': 'owner', 'email': 'owner@example.com'})
+    session.commit()
+
+    assert linked.id != user.id
+    assert linked.username == 'github:1'
+    assert linked.email is None
+
+
+class GoogleClient(object):
+
+    """Replacement of the client of Google that answers with an ID token."""
+
+    def __init__(self, id_token):
+        self.id_token = id_token
+
+    def discover(self):
+        return {'token_endpoint': 'https://example.com/token',
+                'userinfo_endpoint': 'https://example.com/userinfo'}
+
+    def post(self, endpoint, **kwargs):
+        return Response(json.dumps({'id_token': self.id_token,
+                                    'access_token': 'access'}))
+
+
+class Response(object):
+
+    def __init__(self, content):
+        self.content = content
+
+
+@pytest.mark.parametrize('claims', [
+    {'sub': '1', 'aud': 'other client'},
+    {'sub': '1', 'aud': 'client', 'exp': datetime.utcnow() - timedelta(hours=1)},
+])
+def test_google_rejects_invalid_id_token(client, session, monkeypatch, claims):
+    id_token = jwt.encode(claims, 'google').decode('ascii')
+    monkeypatch.setattr(google, 'get_client', lambda name: GoogleClient(id_token))
+
+    result = client.simulate_post('/v1/auth/google', body=json.dumps({
+        'clientId': 'client', 'redirectUri': 'https://example.com',
+        'code': 'code'}), headers={'Content-Type': 'application/json'})
+
+    assert result.status_code == 400
+    assert session.query(User).count() == 0
@@ -0,0 +1,160 @@
+"""Tests of the email outbox and its dispatcher."""
+
+import smtplib
+from datetime import datetime, timedelta
+
+import pytest
+
+from sikr import settings
+from sikr.db.connector import Session, engine
+from sikr.models.emails import OutboxEmail
+from sikr.utils import email as outbox
+
+
+@pytest.fixture
+def claim_session(session):
+    """Session like the one of the dispatcher, on the empty database."""
+    claim_session = Session(bind=engine, expire_on_commit=False)
+    yield claim_session
+    claim_session.close()
+
+
+def queue(session, count, **fields):
+    """Add emails to the outbox, committed, and return their ids."""
+    emails = [OutboxEmail(active=True, from_address='noreply@example.com',
+                          to_address='user{0}@example.com'.format(number),
+                          message='Message', **fields)
+              for number in range(count)]
+    session.add_all(emails)
+    session.commit()
+    return [email.id for email in emails]
+
+
+def test_claim_batch_takes_pending_emails(session, claim_session, monkeypatch):
+    monkeypatch.setattr(settings, 'EMAIL_BATCH_SIZE', 2)
+    now = datetime.utcnow()
+    ids = queue(session, 3, next_attempt=now)
+    queue(session, 1, next_attempt=now + timedelta(hours=1))
+    queue(session, 1, next_attempt=now, attempts=settings.EMAIL_MAX_ATTEMPTS)
+
+    emails = outbox._claim_batch(claim_session, now)
+
+    assert [email.id for email in emails] == ids[:2]
+    claims = {email.claimed_by for email in emails}
+    assert len(claims) == 1 and None not in claims
+    assert {email.next_attempt for email in emails} == {
+        now + timedelta(seconds=settings.EMAIL_CLAIM_TIMEOUT)}
+
+
+def test_claimed_emails_are_not_claimed_again(session, claim_session):
+    now = datetime.utcnow()
+    ids = queue(session, 2, next_attempt=now)
+
+    first = outbox._claim_batch(claim_session, now)
+    second = outbox._claim_batch(claim_session, now)
+
+    assert [email.id for email in first] == ids
+    assert second == []
+
+
+def test_claim_expires(session, claim_session):
+    now = datetime.utcnow()
+    ids = queue(session, 1, next_attempt=now)
+    first_claim = outbox._claim_batch(claim_session, now)[0].claimed_by
+
+    later = now + timedelta(seconds=settings.EMAIL_CLAIM_TIMEOUT)
+    second = outbox._claim_batch(claim_session, later)
+
+    assert [email.id for email in second] == ids
+    assert second[0].claimed_by != first_claim
+
+
+def test_postpone_backs_off(monkeypatch):
+    monkeypatch.setattr(settings, 'EMAIL_RETRY_BACKOFF', 60)
+    monkeypatch.setattr(settings, 'EMAIL_MAX_ATTEMPTS', 5)
+    now = datetime.utcnow()
+    email = OutboxEmail(attempts=0, claimed_by='claim')
+
+    delays = []
+    for _ in range(3):
+        outbox._postpone(email, Exception('Timeout'), now)
+        delays.append((email.next_attempt - now).total_seconds())
+
+    assert delays == [60, 120, 240]
+    assert email.attempts == 3
+    assert email.claimed_by is None
+    assert email.last_error == 'Timeout'
+
+
+def test_postpone_drops_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(settings, 'EMAIL_MAX_ATTEMPTS', 2)
+    email = OutboxEmail(attempts=1)
+
+    outbox._postpone(email, Exception('Timeout'), datetime.utcnow())
+
+    assert email.attempts == settings.EMAIL_MAX_ATTEMPTS
+
+
+def test_postpone_permanent_failure():
+    email = OutboxEmail(attempts=0)
+
+    outbox._postpone(email, Exception('x' * 300), datetime.utcnow(),
+                     permanent=True)
+
+    assert email.attempts == settings.EMAIL_MAX_ATTEMPTS
+    assert len(email.last_error) == 255
+
+
+def test_is_permanent():
+    assert outbox._is_permanent(smtplib.SMTPRecipientsRefused(
+        {'a@example.com': (550, b'No such user')}))
+    assert not outbox._is_permanent(smtplib.SMTPRecipientsRefused(
+        {'a@example.com': (550, b'No such user'), 'b@example.com': (451, b'Later')}))
+    assert outbox._is_permanent(smtplib.SMTPDataError(554, b'Rejected'))
+    assert not outbox._is_permanent(smtplib.SMTPDataError(451, b'Later'))
+    assert not outbox._is_permanent(ConnectionRefusedError())
+
+
+class Connection(object):
+
+    """Replacement of ``SMTPConnection`` that fails with the given errors."""
+
+    def __init__(self, errors, connected=True):
+        self.errors = errors
+        self.connected = connected
+        self.sent = []
+
+    def send(self, from_address, recipients, message):
+        error = self.errors.get(recipients[0])
+        if error is not None:
+            raise error
+        self.sent.append(recipients[0])
+
+
+def test_dispatch_batch(session):
+    queue(session, 3, next_attempt=datetime.utcnow())
+    connection = Connection({
+        'user1@example.com': smtplib.SMTPDataError(451, b'Later'),
+        'user2@example.com': smtplib.SMTPDataError(554, b'Rejected')})
+
+    assert outbox.dispatch_batch(connection) == 3
+
+    assert connection.sent == ['user0@example.com']
+    session.expire_all()
+    left = {email.to_address: email for email in session.query(OutboxEmail)}
+    assert sorted(left) == ['user1@example.com', 'user2@example.com']
+    assert left['user1@example.com'].attempts == 1
+    assert left['user2@example.com'].attempts == settings.EMAIL_MAX_ATTEMPTS
+    assert all(email.claimed_by is None for email in left.values())
+
+
+def test_dispatch_batch_without_server_is_not_permanent(session):
+    queue(session, 2, next_attempt=datetime.utcnow())
+    error = smtplib.SMTPConnectError(554, b'Go away')
+    connection = Connection({'user0@example.com': error}, connected=False)
+
+    outbox.dispatch_batch(connection)
+
+    assert connection.sent == []
+    session.expire_all()
+    assert [email.attempts for email in session.query(OutboxEmail)] == [1, 1]
@@ -0,0 +1,187 @@
+"""Tests of the streamed encryption and the files of the services."""
+
+import io
+import os
+
+import pytest
+
+from sikr import settings
+from sikr.models.entries import Service
+from sikr.utils.cryptofunctions import (FRAME_HEADER, KEY_ID_HEADER,
+                                        STREAM_HEADER, TAG_SIZE, KeyRing,
+                                        StreamCipher)
+
+KEYRING = KeyRing({'1': 'test secret'}, '1')
+CHUNK_SIZE = 16
+# Header of the streams encrypted with KEYRING
+HEADER_SIZE = STREAM_HEADER.size + KEY_ID_HEADER.size + 1
+
+
+def encrypt(content, chunk_size=CHUNK_SIZE):
+    dst = io.BytesIO()
+    StreamCipher(KEYRING, chunk_size).encrypt_stream(io.BytesIO(content), dst)
+    return dst.getvalue()
+
+
+def decrypt(data):
+    return b''.join(StreamCipher(KEYRING).decrypt_stream(io.BytesIO(data)))
+
+
+def frame_ends(data):
+    """Offsets where every frame of an encrypted stream ends."""
+    ends = []
+    offset = HEADER_SIZE
+    while offset < len(data):
+        length, = FRAME_HEADER.unpack_from(data, offset)
+        offset += FRAME_HEADER.size + (length & 0x7FFFFFFF) + TAG_SIZE
+        ends.append(offset)
+    return ends
+
+
+@pytest.mark.parametrize('size', [0, 1, CHUNK_SIZE, CHUNK_SIZE * 3 + 5])
+def test_stream_round_trip(size):
+    content = os.urandom(size)
+
+    assert decrypt(encrypt(content)) == content
+
+
+def test_stream_uses_a_new_key_every_time():
+    content = b'x' * CHUNK_SIZE
+
+    assert encrypt(content) != encrypt(content)
+
+
+def test_tampered_frame_fails():
+    data = bytearray(encrypt(b'x' * CHUNK_SIZE * 2))
+    data[HEADER_SIZE + FRAME_HEADER.size] ^= 1
+
+    with pytest.raises(ValueError):
+        decrypt(bytes(data))
+
+
+def test_reordered_frames_fail():
+    data = encrypt(b'a' * CHUNK_SIZE + b'b' * CHUNK_SIZE + b'c')
+    first, second = frame_ends(data)[:2]
+    reordered = (data[:HEADER_SIZE] + data[first:second] +
+                 data[HEADER_SIZE:first] + data[second:])
+
+    with pytest.raises(ValueError):
+        decrypt(reordered)
+
+
+def test_truncation_at_frame_boundary_fails():
+    data = encrypt(b'x' * CHUNK_SIZE * 3)
+
+    for end in frame_ends(data)[:-1]:
+        with pytest.raises(ValueError):
+            decrypt(data[:end])
+
+
+def test_truncated_header_fails():
+    with pytest.raises(ValueError):
+        decrypt(encrypt(b'x')[:HEADER_SIZE - 1])
+
+
+def test_trailing_data_fails():
+    with pytest.raises(ValueError):
+        decrypt(encrypt(b'x' * CHUNK_SIZE) + b'extra')
+
+
+def test_wrong_key_fails():
+    data = encrypt(b'x')
+    keyring = KeyRing({'1': 'other secret'}, '1')
+
+    with pytest.raises(ValueError):
+        b''.join(StreamCipher(keyring).decrypt_stream(io.BytesIO(data)))
+
+
+def test_tampered_key_id_fails():
+    data = bytearray(encrypt(b'x'))
+    data[HEADER_SIZE - 1] = ord('2')
+    keyring = KeyRing({'1': 'test secret', '2': 'test secret'}, '1')
+
+    with pytest.raises(ValueError):
+        b''.join(StreamCipher(keyring).decrypt_stream(io.BytesIO(bytes(data))))
+
+
+@pytest.fixture
+def upload_dir(tmpdir, monkeypatch):
+    monkeypatch.setattr(settings, 'UPLOAD_DIR', str(tmpdir))
+    return str(tmpdir)
+
+
+@pytest.fixture
+def owner(make_user):
+    return make_user('owner')
+
+
+@pytest.fixture
+def service(session, owner):
+    service = Service(active=True, name='server')
+    service.allowed_users.append(owner)
+    session.add(service)
+    session.commit()
+    return service.id
+
+
+def file_url(service_id):
+    return '/v1/services/{0}/file'.format(service_id)
+
+
+def upload(client, headers, service_id, content, filename='server.pem'):
+    return client.simulate_put(file_url(service_id), headers=headers,
+                               query_string='filename=' + filename,
+                               body=content)
+
+
+def test_upload_and_download(client, session, auth_headers, owner, service,
+                             upload_dir):
+    content = os.urandom(100000)
+
+    result = upload(client, auth_headers(owner), service, content)
+
+    assert result.status_code == 200
+    with open(os.path.join(upload_dir, str(service)), 'rb') as stored:
+        assert content not in stored.read()
+    assert session.query(Service).get(service).ssl_filename == 'server.pem'
+
+    result = client.simulate_get(file_url(service),
+                                 headers=auth_headers(owner))
+
+    assert result.status_code == 200
+    assert result.content == content
+    assert 'filename="server.pem"' in result.headers['Content-Disposition']
+
+
+def test_upload_rejects_extension(client, auth_headers, owner, service,
+                                  upload_dir):
+    result = upload(client, auth_headers(owner), service, b'x',
+                    filename='server.exe')
+
+    assert result.status_code == 400
+    assert os.listdir(upload_dir) == []
+
+
+def test_file_requires_access(client, auth_headers, owner, service,
+                              upload_dir, make_user):
+    upload(client, auth_headers(owner), service, b'secret')
+    stranger = make_user('stranger')
+
+    assert upload(client, auth_headers(stranger), service,
+                  b'other').status_code == 403
+    assert client.simulate_get(file_url(service),
+                               headers=auth_headers(stranger)).status_code == 403
+
+
+def test_delete(client, session, auth_headers, owner, service, upload_dir):
+    upload(client, auth_headers(owner), service, b'secret')
+
+    result = client.simulate_delete(file_url(service),
+                                    headers=auth_headers(owner))
+
+    assert result.status_code == 200
+    assert os.listdir(upload_dir) == []
+    session.expire_all()
+    assert session.query(Service).get(service).ssl_filename == ''
+    assert client.simulate_get(file_url(service),
+                               headers=auth_headers(owner)).status_code == 404
@@ -0,0 +1,213 @@
+"""Tests of the incremental readers and the imports."""
+
+import io
+import json
+
+import pytest
+
+from sikr import settings
+from sikr.models.entries import Entry, Group, Service
+from sikr.models.permissions import has_permission
+from sikr.utils import readers
+from sikr.utils.readers import (LimitedStream, StreamTooLarge, read_csv,
+                                read_json_array, read_ndjson)
+
+IMPORT_URL = '/v1/import'
+
+
+class PieceStream(io.RawIOBase):
+
+    """Binary stream that returns a few bytes per read, and counts them."""
+
+    def __init__(self, data, piece=3):
+        self.data = data
+        self.piece = piece
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.data[self.position:self.position + min(len(buffer),
+                                                             self.piece)]
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+@pytest.fixture
+def small_reads(monkeypatch):
+    monkeypatch.setattr(readers, 'READ_SIZE', 4)
+
+
+def test_json_array_is_read_incrementally(small_reads):
+    records = [{'item': 'a' * 10}, {'item': 'b', 'port': '22'}, [1, 2], 'c',
+               1234567, -1.5e10, True, None]
+    stream = PieceStream(json.dumps(records).encode('utf-8'))
+    reader = read_json_array(stream)
+
+    assert next(reader) == records[0]
+    assert stream.position < len(stream.data)
+    assert [records[0]] + list(reader) == records
+
+
+@pytest.mark.parametrize('content', ['[]', ' [ ] ', '\n[\n]\n'])
+def test_empty_json_array(small_reads, content):
+    assert list(read_json_array(PieceStream(content.encode('utf-8')))) == []
+
+
+@pytest.mark.parametrize('content', ['{}', '[1, 2', '[1 2]', '[1,, 2]',
+                                     '[1] 2', '"text"', ''])
+def test_malformed_json_array_fails(small_reads, content):
+    with pytest.raises(ValueError):
+        list(read_json_array(PieceStream(content.encode('utf-8'))))
+
+
+def test_json_array_element_too_big(small_reads, monkeypatch):
+    monkeypatch.setattr(readers, 'MAX_RECORD_SIZE', 20)
+
+    with pytest.raises(ValueError):
+        list(read_json_array(PieceStream(b'[{"item": "' + b'a' * 30 + b'"}]')))
+
+
+def test_json_array_multibyte_characters(small_reads):
+    records = [{'item': 'ñandú   \U0001f511'}]
+
+    stream = PieceStream(json.dumps(records, ensure_ascii=False).encode('utf-8'))
+
+    assert list(read_json_array(stream)) == records
+
+
+def test_ndjson_is_read_incrementally(small_reads):
+    stream = PieceStream(b'{"item": "a"}\n\n{"item": "b"}\r\n{"item": "c"}')
+    reader = read_ndjson(stream)
+
+    assert next(reader) == {'item': 'a'}
+    assert stream.position < len(stream.data)
+    assert list(reader) == [{'item': 'b'}, {'item': 'c'}]
+
+
+def test_malformed_ndjson_fails():
+    with pytest.raises(ValueError):
+        list(read_ndjson(io.BytesIO(b'{"item": "a"}\n{"item"\n')))
+
+
+def test_csv_is_read_incrementally():
+    content = 'item,password\na,"multi\nline"\nb, x\n'.encode('utf-8')
+    stream = PieceStream(content + b'c,d\n' * 10000, piece=1024)
+    reader = read_csv(stream)
+
+    assert next(reader) == {'item': 'a', 'password': 'multi\nline'}
+    assert next(reader) == {'item': 'b', 'password': ' x'}
+    assert stream.position < len(stream.data)
+    assert sum(1 for _ in reader) == 10000
+
+
+def test_limited_stream_reads_up_to_the_limit():
+    stream = LimitedStream(io.BytesIO(b'x' * 10), 10)
+
+    assert stream.read() == b'x' * 10
+
+
+def test_limited_stream_fails_over_the_limit():
+    stream = LimitedStream(io.BytesIO(b'x' * 11), 10)
+
+    with pytest.raises(StreamTooLarge):
+        stream.read()
+
+
+def test_limited_stream_stops_the_readers():
+    content = json.dumps([{'item': 'a'}] * 100).encode('utf-8')
+
+    with pytest.raises(StreamTooLarge):
+        list(read_json_array(LimitedStream(io.BytesIO(content), 100)))
+
+
+@pytest.fixture
+def owner(make_user):
+    return make_user('owner')
+
+
+def import_records(client, headers, records, file_format='ndjson'):
+    if file_format == 'ndjson':
+        body = '\n'.join(json.dumps(record) for record in records)
+    else:
+        body = json.dumps(records)
+    return client.simulate_post(IMPORT_URL, headers=headers, body=body,
+                                query_string='format=' + file_format)
+
+
+def test_import_reports_chunks(client, session, auth_headers, owner,
+                               monkeypatch):
+    monkeypatch.setattr(settings, 'IMPORT_CHUNK_SIZE', 2)
+    records = [{'category': 'servers', 'item': 'web', 'service': 'ssh'},
+               {'category': 'servers', 'item': 'web', 'service': 'http'},
+               {'item': 'missing category'},
+               {'category': 'servers', 'port': 'x'},
+               {'category': 'mail', 'item': 'smtp', 'password': 'secret'}]
+
+    result = import_records(client, auth_headers(owner), records)
+
+    assert result.status_code == 201
+    assert result.json['records'] == 5
+    assert result.json['imported'] == 4
+    assert result.json['invalid'] == 1
+    assert [error['record'] for error in result.json['errors']] == [4]
+    assert [(chunk['chunk'], chunk['records'], chunk['last_record'],
+             chunk['categories'], chunk['items'], chunk['services'])
+            for chunk in result.json['chunks']] == [(1, 2, 2, 1, 1, 2),
+                                                    (2, 2, 5, 1, 2, 2)]
+    assert sorted(service.password for service in session.query(Service)) == [
+        '', '', '', 'secret']
+    for model in (Group, Entry, Service):
+        ids = [id for id, in session.query(model.id)]
+        assert all(has_permission(session, owner.id, model, id) for id in ids)
+
+
+def test_import_inserts_more_rows_than_a_statement(client, session,
+                                                   auth_headers, owner):
+    records = [{'category': 'servers', 'item': 'item {0}'.format(number)}
+               for number in range(300)]
+
+    result = import_records(client, auth_headers(owner), records, 'json')
+
+    assert result.status_code == 201
+    services = (session.query(Service.name, Entry.name)
+                       .join(Entry, Service.entry_id == Entry.id))
+    assert sorted(services) == sorted((record['item'], record['item'])
+                                      for record in records)
+
+
+def test_import_again_reuses_items(client, session, auth_headers, owner):
+    records = [{'category': 'servers', 'item': 'web', 'service': 'ssh'},
+               {'item': 'notes', 'service': 'wifi'}]
+    import_records(client, auth_headers(owner), records)
+
+    result = import_records(client, auth_headers(owner), records)
+
+    assert result.status_code == 201
+    assert result.json['chunks'][0]['categories'] == 0
+    assert result.json['chunks'][0]['items'] == 0
+    assert session.query(Entry).count() == 2
+    assert session.query(Service).count() == 4
+
+
+def test_import_does_not_reuse_other_users_items(client, session,
+                                                 auth_headers, owner,
+                                                 make_user):
+    records = [{'item': 'web'}]
+    import_records(client, auth_headers(owner), records)
+
+    result = import_records(client, auth_headers(make_user('other')), records)
+
+    assert result.json['chunks'][0]['items'] == 1
+    assert session.query(Entry).count() == 2
+
+
+def test_import_too_large(client, session, auth_headers, owner, monkeypatch):
+    monkeypatch.setattr(settings, 'MAX_IMPORT_SIZE', 10)
+
+    result = import_records(client, auth_headers(owner), [{'item': 'web'}] * 5)
+
+    assert result.status_code == 413
+    assert session.query(Entry).count() == 0
@@ -0,0 +1,186 @@
+"""Tests of the keyring and the rotation of the encryption keys."""
+
+import io
+import json
+import os
+
+import pytest
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF
+from sqlalchemy import String, select, type_coerce
+
+from sikr import settings
+from sikr.db import rotate, types
+from sikr.db.connector import engine
+from sikr.models.entries import Service
+from sikr.utils.cryptofunctions import (FINAL_FRAME, FRAME_HEADER,
+                                        STREAM_HEADER, STREAM_MAGIC, AESCipher,
+                                        KeyRing, StreamCipher, derive_key)
+
+OLD_SECRET = 'old secret'
+NEW_SECRET = 'new secret'
+
+
+def test_keyring_reads_legacy_values():
+    keyring = KeyRing({'1': NEW_SECRET}, '1', legacy=OLD_SECRET)
+    legacy = AESCipher(OLD_SECRET).encrypt('password')
+
+    assert keyring.key_id(legacy) is None
+    assert keyring.needs_rotation(legacy)
+    assert keyring.decrypt(legacy) == 'password'
+
+
+def test_keyring_without_legacy_key_fails():
+    keyring = KeyRing({'1': NEW_SECRET}, '1')
+
+    with pytest.raises(KeyError):
+        keyring.decrypt(AESCipher(OLD_SECRET).encrypt('password'))
+
+
+def test_keyring_reads_values_of_every_key():
+    old = KeyRing({'1': OLD_SECRET}, '1')
+    keyring = KeyRing({'1': OLD_SECRET, '2': NEW_SECRET}, '2')
+    value = old.encrypt('password')
+
+    assert value.startswith(b'1$')
+    assert keyring.needs_rotation(value)
+    assert keyring.decrypt(value) == 'password'
+    assert keyring.encrypt('password').startswith(b'2$')
+    assert not keyring.needs_rotation(keyring.encrypt('password'))
+
+
+def test_keyring_rejects_invalid_ids():
+    with pytest.raises(ValueError):
+        KeyRing({'1$': OLD_SECRET}, '1$')
+    with pytest.raises(ValueError):
+        KeyRing({'1': OLD_SECRET}, '2')
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_rotate_many(workers):
+    keyring = KeyRing({'1': OLD_SECRET, '2': NEW_SECRET}, '2',
+                      legacy=OLD_SECRET)
+    values = [AESCipher(OLD_SECRET).encrypt('a'),
+              KeyRing({'1': OLD_SECRET}, '1').encrypt('b'),
+              keyring.encrypt('c')]
+
+    rotated = keyring.rotate_many(values, workers)
+
+    assert [keyring.key_id(value) for value in rotated] == ['2', '2', '2']
+    assert [keyring.decrypt(value) for value in rotated] == ['a', 'b', 'c']
+
+
+def legacy_stream(secret, content):
+    """Stream of version 1, without key id, as the files were encrypted."""
+    salt = os.urandom(16)
+    prefix = os.urandom(8)
+    header = STREAM_HEADER.pack(STREAM_MAGIC, 1, 64, salt, prefix)
+    frame = FRAME_HEADER.pack(len(content) | FINAL_FRAME)
+    key = HKDF(derive_key(secret), 32, salt, SHA256)
+    cipher = StreamCipher._cipher(key, prefix, 0, header + frame)
+    ciphertext, tag = cipher.encrypt_and_digest(content)
+    return header + frame + ciphertext + tag
+
+
+def test_stream_reads_legacy_files():
+    data = legacy_stream(OLD_SECRET, b'content')
+    cipher = StreamCipher(KeyRing({'1': NEW_SECRET}, '1', legacy=OLD_SECRET))
+
+    assert cipher.key_id(io.BytesIO(data)) is None
+    assert cipher.needs_rotation(io.BytesIO(data))
+    assert b''.join(cipher.decrypt_stream(io.BytesIO(data))) == b'content'
+
+
+@pytest.fixture
+def old_keyring(monkeypatch):
+    keyring = KeyRing({'1': OLD_SECRET}, '1', legacy=OLD_SECRET)
+    monkeypatch.setattr(types, 'keyring', keyring)
+    monkeypatch.setattr(rotate, 'keyring', keyring)
+    return keyring
+
+
+@pytest.fixture
+def new_keyring(monkeypatch, old_keyring):
+    """Switch to a new key, once the data is stored with the old one."""
+    def new_keyring():
+        keyring = KeyRing({'1': OLD_SECRET, '2': NEW_SECRET}, '2',
+                          legacy=OLD_SECRET)
+        monkeypatch.setattr(types, 'keyring', keyring)
+        monkeypatch.setattr(rotate, 'keyring', keyring)
+        return keyring
+    return new_keyring
+
+
+def stored_key_ids(keyring):
+    """Key id of the password of every service, by id."""
+    table = Service.__table__
+    query = select([table.c.id, type_coerce(table.c.password, String)])
+    with engine.connect() as connection:
+        return {id: keyring.key_id(password)
+                for id, password in connection.execute(query)}
+
+
+def test_rotate_keys_resumes_from_checkpoint(session, tmpdir, monkeypatch,
+                                             old_keyring, new_keyring):
+    monkeypatch.setattr(settings, 'UPLOAD_DIR', str(tmpdir.join('files')))
+    session.add_all([Service(active=True, name=str(number),
+                             password='password {0}'.format(number))
+                     for number in range(5)])
+    session.commit()
+    ids = sorted(service.id for service in session.query(Service))
+    keyring = new_keyring()
+    checkpoint_path = str(tmpdir.join('rotation.json'))
+    with open(checkpoint_path, 'w') as checkpoint_file:
+        json.dump({'key': '2', 'tables': {'sikr_service': ids[1]},
+                   'files': 0}, checkpoint_file)
+
+    rotate.rotate_keys(batch_size=2, pause=0, checkpoint_path=checkpoint_path)
+
+    key_ids = stored_key_ids(keyring)
+    assert [key_ids[id] for id in ids] == ['1', '1', '2', '2', '2']
+    assert not os.path.exists(checkpoint_path)
+    session.expire_all()
+    assert sorted(service.password for service in session.query(Service)) == [
+        'password {0}'.format(number) for number in range(5)]
+
+
+def test_checkpoint_of_another_key_is_discarded(session, tmpdir, old_keyring,
+                                                new_keyring, monkeypatch):
+    monkeypatch.setattr(settings, 'UPLOAD_DIR', str(tmpdir.join('files')))
+    session.add(Service(active=True, name='a', password='password'))
+    session.commit()
+    keyring = new_keyring()
+    checkpoint_path = str(tmpdir.join('rotation.json'))
+    with open(checkpoint_path, 'w') as checkpoint_file:
+        json.dump({'key': '1', 'tables': {'sikr_service': 1000},
+                   'files': 1000}, checkpoint_file)
+
+    rotate.rotate_keys(pause=0, checkpoint_path=checkpoint_path)
+
+    assert set(stored_key_ids(keyring).values()) == {'2'}
+
+
+def test_rotate_keys_rotates_files(session, tmpdir, monkeypatch, old_keyring,
+                                   new_keyring):
+    upload_dir = tmpdir.mkdir('files')
+    monkeypatch.setattr(settings, 'UPLOAD_DIR', str(upload_dir))
+    for service_id in (1, 2, 3):
+        with open(str(upload_dir.join(str(service_id))), 'wb') as dst:
+            StreamCipher(old_keyring).encrypt_stream(
+                io.BytesIO(b'file %d' % service_id), dst)
+    keyring = new_keyring()
+    checkpoint_path = str(tmpdir.join('rotation.json'))
+    with open(checkpoint_path, 'w') as checkpoint_file:
+        json.dump({'key': '2', 'tables': {}, 'files': 1}, checkpoint_file)
+
+    rotate.rotate_keys(pause=0, checkpoint_path=checkpoint_path)
+
+    cipher = StreamCipher(keyring)
+    key_ids = []
+    for service_id in (1, 2, 3):
+        with open(str(upload_dir.join(str(service_id))), 'rb') as src:
+            key_ids.append(cipher.key_id(src))
+            src.seek(0)
+            assert b''.join(cipher.decrypt_stream(src)) == b'file %d' % service_id
+    assert key_ids == ['1', '2', '2']
+    assert sorted(os.listdir(str(upload_dir))) == ['1', '2', '3']
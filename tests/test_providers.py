@@ -0,0 +1,137 @@
+"""Tests of the circuit breaker of the OAuth providers."""
+
+import falcon
+import pytest
+import requests
+
+from sikr.resources.auth import providers
+from sikr.resources.auth.providers import CircuitBreaker, ProviderClient
+
+
+class Clock(object):
+
+    """Replacement of ``time.monotonic`` that only moves when told."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(providers.time, 'monotonic', clock)
+    return clock
+
+
+def test_breaker_opens_after_failures_in_a_row(clock):
+    breaker = CircuitBreaker(failures=3, reset_timeout=10)
+
+    for _ in range(2):
+        breaker.failure()
+        assert breaker.allow()
+    breaker.failure()
+
+    assert not breaker.allow()
+    assert breaker.retry_after() == 10
+
+
+def test_breaker_success_resets_the_count(clock):
+    breaker = CircuitBreaker(failures=2, reset_timeout=10)
+
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+
+    assert breaker.allow()
+    assert breaker.retry_after() == 0
+
+
+def test_breaker_lets_a_single_test_call_through(clock):
+    breaker = CircuitBreaker(failures=1, reset_timeout=10)
+    breaker.failure()
+
+    clock.now += 9
+    assert not breaker.allow()
+    assert breaker.retry_after() == 1
+    clock.now += 1
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+def test_breaker_closes_when_the_test_call_succeeds(clock):
+    breaker = CircuitBreaker(failures=1, reset_timeout=10)
+    breaker.failure()
+    clock.now += 10
+    breaker.allow()
+
+    breaker.success()
+
+    assert breaker.allow()
+    assert breaker.allow()
+
+
+def test_breaker_opens_again_when_the_test_call_fails(clock):
+    breaker = CircuitBreaker(failures=3, reset_timeout=10)
+    for _ in range(3):
+        breaker.failure()
+    clock.now += 10
+    breaker.allow()
+
+    breaker.failure()
+
+    assert not breaker.allow()
+    assert breaker.retry_after() == 10
+    clock.now += 10
+    assert breaker.allow()
+
+
+class Response(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class Session(object):
+
+    """Replacement of ``requests.Session`` that answers from a list."""
+
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        answer = self.answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return Response(answer)
+
+
+def test_client_stops_calling_a_failing_provider(clock, monkeypatch):
+    monkeypatch.setattr(providers.settings, 'OAUTH_BREAKER_FAILURES', 2)
+    monkeypatch.setattr(providers.settings, 'OAUTH_BREAKER_RESET', 30)
+    session = Session(requests.ConnectionError(), 503, 200)
+    client = ProviderClient('github', {'token': 'https://example.com'}, session)
+
+    for _ in range(3):
+        with pytest.raises(falcon.HTTPServiceUnavailable):
+            client.get('token')
+
+    assert session.calls == 2
+    clock.now += 30
+    assert client.get('token').status_code == 200
+    assert client.breaker.allow()
+
+
+def test_client_rejected_request_does_not_open_the_circuit(clock, monkeypatch):
+    monkeypatch.setattr(providers.settings, 'OAUTH_BREAKER_FAILURES', 1)
+    client = ProviderClient('github', {'token': 'https://example.com'},
+                            Session(400, 200))
+
+    with pytest.raises(falcon.HTTPBadRequest):
+        client.get('token')
+
+    assert client.get('token').status_code == 200
@@ -0,0 +1,157 @@
+"""Tests of the bulk sharing and the permissions table."""
+
+import json
+
+import pytest
+
+from sikr.models.entries import Service
+from sikr.models.permissions import has_permission, permission_table
+from sikr.models.shares import issue_share_tokens, redeem_share_token
+from sikr.models.users import UserGroup
+
+BULK_URL = '/v1/share/bulk'
+
+
+@pytest.fixture
+def owner(make_user):
+    return make_user('owner')
+
+
+@pytest.fixture
+def services(session, owner):
+    """Two services shared with their owner."""
+    services = [Service(active=True, name=name) for name in ('a', 'b')]
+    for service in services:
+        service.allowed_users.append(owner)
+    session.add_all(services)
+    session.commit()
+    return [service.id for service in services]
+
+
+def bulk(client, headers, action, ids, users=(), usergroups=()):
+    return client.simulate_post(BULK_URL, headers=headers, body=json.dumps({
+        'action': action, 'type': 'service', 'ids': ids,
+        'users': list(users), 'usergroups': list(usergroups)}))
+
+
+def permission_rows(session, user_id):
+    columns = permission_table.c
+    return sorted(session.query(columns.object_id, columns.usergroup_id)
+                         .filter(columns.user_id == user_id,
+                                 columns.object_type == 'service'))
+
+
+def test_grant_refreshes_permissions(client, session, auth_headers, owner,
+                                     services, make_user):
+    guest = make_user('guest')
+    assert not has_permission(session, guest.id, Service, services[0])
+
+    result = bulk(client, auth_headers(owner), 'grant', services, [guest.id])
+
+    assert result.status_code == 200
+    assert result.json['changed'] == {'users': 2, 'usergroups': 0}
+    assert permission_rows(session, guest.id) == [(services[0], 0),
+                                                  (services[1], 0)]
+
+
+def test_grant_twice_adds_nothing(client, auth_headers, owner, services,
+                                  make_user):
+    guest = make_user('guest')
+    bulk(client, auth_headers(owner), 'grant', services, [guest.id])
+
+    result = bulk(client, auth_headers(owner), 'grant', services, [guest.id])
+
+    assert result.json['changed'] == {'users': 0, 'usergroups': 0}
+
+
+def test_grant_requires_access_to_every_object(client, session, auth_headers,
+                                               services, make_user):
+    stranger = make_user('stranger')
+
+    result = bulk(client, auth_headers(stranger), 'grant', services,
+                  [stranger.id])
+
+    assert result.status_code == 403
+    assert permission_rows(session, stranger.id) == []
+
+
+def test_grant_to_usergroup_gives_access_to_members(client, session,
+                                                    auth_headers, owner,
+                                                    services, make_user):
+    member = make_user('member')
+    group = UserGroup(active=True, name='team', users=[member])
+    session.add(group)
+    session.commit()
+
+    bulk(client, auth_headers(owner), 'grant', services[:1],
+         usergroups=[group.id])
+
+    assert permission_rows(session, member.id) == [(services[0], group.id)]
+
+
+def test_revoke_own_grant(client, session, auth_headers, owner, services,
+                          make_user):
+    guest = make_user('guest')
+    bulk(client, auth_headers(owner), 'grant', services, [guest.id])
+
+    result = bulk(client, auth_headers(owner), 'revoke', services, [guest.id])
+
+    assert result.status_code == 200
+    assert result.json['changed'] == {'users': 2, 'usergroups': 0}
+    assert permission_rows(session, guest.id) == []
+
+
+def test_revoke_skips_shares_granted_by_others(client, session, auth_headers,
+                                               owner, services, make_user):
+    guest = make_user('guest')
+    other = make_user('other')
+    bulk(client, auth_headers(owner), 'grant', services, [guest.id, other.id])
+
+    result = bulk(client, auth_headers(guest), 'revoke', services,
+                  [owner.id, other.id])
+
+    assert result.json['changed'] == {'users': 0, 'usergroups': 0}
+    assert has_permission(session, owner.id, Service, services[0])
+    assert has_permission(session, other.id, Service, services[0])
+
+
+def test_revoke_own_access(client, session, auth_headers, owner, services,
+                           make_user):
+    guest = make_user('guest')
+    bulk(client, auth_headers(owner), 'grant', services, [guest.id])
+
+    result = bulk(client, auth_headers(guest), 'revoke', services, [guest.id])
+
+    assert result.json['changed'] == {'users': 2, 'usergroups': 0}
+    assert permission_rows(session, guest.id) == []
+
+
+def test_revoke_usergroup_refreshes_members(client, session, auth_headers,
+                                            owner, services, make_user):
+    member = make_user('member')
+    group = UserGroup(active=True, name='team', users=[member])
+    session.add(group)
+    session.commit()
+    bulk(client, auth_headers(owner), 'grant', services, usergroups=[group.id])
+
+    result = bulk(client, auth_headers(owner), 'revoke', services,
+                  usergroups=[group.id])
+
+    assert result.json['changed'] == {'users': 0, 'usergroups': 2}
+    assert permission_rows(session, member.id) == []
+
+
+def test_invitation_can_be_revoked_by_its_sender(client, session, auth_headers,
+                                                 owner, services, make_user):
+    guest = make_user('guest')
+    tokens = issue_share_tokens(session, owner.id, Service, services[0],
+                                [guest.email])
+    assert redeem_share_token(session, tokens[guest.email], guest)
+    session.commit()
+    assert has_permission(session, guest.id, Service, services[0])
+
+    result = bulk(client, auth_headers(owner), 'revoke', services[:1],
+                  [guest.id])
+
+    assert result.json['changed'] == {'users': 1, 'usergroups': 0}
+    assert not has_permission(session, guest.id, Service, services[0])